@@ -0,0 +1,50 @@
+"""Daily activity counts, an example projection of the outbox.
+
+The `daily_activity` consumer counts events per day and topic (messages
+posted, likes, follows, sign-ups...) into `daily_activity`, for the admin
+jobs page. It is kept off the request path entirely: the views only emit
+events (see outbox.py), and `flask outbox-consume` applies them here. To
+rebuild it from every retained event:
+
+    flask outbox-replay daily_activity
+"""
+
+from collections import Counter
+from datetime import datetime, timedelta
+
+from models import db, DailyActivity
+import outbox
+
+
+def clear():
+    DailyActivity.query.delete(synchronize_session=False)
+
+
+@outbox.consumer("daily_activity", reset=clear)
+def count_events(events):
+    counts = Counter((event.created_at.date(), event.topic) for event in events)
+
+    existing = {(row.day, row.topic): row for row in (DailyActivity
+                                                      .query
+                                                      .filter(DailyActivity.day.in_(
+                                                          {day for day, _ in counts})))}
+
+    for key, n in counts.items():
+        if key in existing:
+            existing[key].count += n
+        else:
+            day, topic = key
+            db.session.add(DailyActivity(day=day, topic=topic, count=n))
+
+
+def recent(days=7, today=None):
+    """[(day, {topic: count})] for the last `days` days, newest first."""
+
+    today = today or datetime.utcnow().date()
+    since = today - timedelta(days=days - 1)
+
+    by_day = {since + timedelta(days=n): {} for n in range(days)}
+    for row in DailyActivity.query.filter(DailyActivity.day >= since):
+        by_day.setdefault(row.day, {})[row.topic] = row.count
+
+    return sorted(by_day.items(), reverse=True)
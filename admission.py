@@ -0,0 +1,136 @@
+"""Adaptive concurrency limiting and load shedding.
+
+When the database slows down, requests pile up in a worker until they
+all time out. `AdmissionController` wraps the WSGI app and admits a
+request only while fewer than a limit are in flight in this process;
+past it, the request is refused at once with a 503 and Retry-After,
+before any session, user or database work.
+
+The limit adapts to observed latency, gradient-style: it keeps a fast
+moving average of request latency and a slow one (the latency the app
+manages when it isn't overloaded). While the fast average stays within
+ADMISSION_TOLERANCE times the slow one the limit grows by about its
+square root; when latency climbs, the limit shrinks in proportion:
+
+    limit = limit * min(1, tolerance * slow / fast) + sqrt(limit)
+
+Routes have priorities (ADMISSION_PRIORITIES, by endpoint) and each
+priority may use a share of the limit, so under load expensive work is
+shed first and cheap, critical routes keep working:
+
+    critical    login, sign-up, posting, static files, /metrics    100%
+    normal      everything else                                      85%
+    expensive   user search, exports, deep pages (?before=)          50%
+
+The limit is per worker process, across its threads; a process serving
+one request at a time can't queue, so run threaded workers (gunicorn
+--threads) to benefit.
+"""
+
+import math
+import threading
+import time
+
+from werkzeug.exceptions import HTTPException
+
+from metrics import metrics
+
+SHARES = {"critical": 1.0, "normal": 0.85, "expensive": 0.5}
+
+# Weights of each new latency sample in the fast and slow averages
+FAST_WEIGHT = 0.1
+SLOW_WEIGHT = 0.005
+
+
+class AdmissionController:
+    """WSGI middleware admitting requests up to an adaptive concurrency limit."""
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.fast = None
+        self.slow = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.limit = float(app.config['ADMISSION_INITIAL_LIMIT'])
+        self.min_limit = app.config['ADMISSION_MIN_LIMIT']
+        self.max_limit = app.config['ADMISSION_MAX_LIMIT']
+        self.tolerance = app.config['ADMISSION_TOLERANCE']
+        self.priorities = app.config['ADMISSION_PRIORITIES']
+
+        app.extensions['admission'] = self
+        app.wsgi_app = self
+
+    def __call__(self, environ, start_response):
+        priority = self.priority(environ)
+
+        with self.lock:
+            allowed = max(1, int(self.limit * SHARES[priority]))
+            admitted = self.in_flight < allowed
+            if admitted:
+                self.in_flight += 1
+
+        if not admitted:
+            metrics.inc("warbler_requests_shed_total", (("priority", priority),))
+            start_response("503 Service Unavailable",
+                           [("Content-Type", "text/plain"), ("Retry-After", "1")])
+            return [b"Busy; try again shortly.\n"]
+
+        started = time.perf_counter()
+        latency = None
+        try:
+            body = self.wsgi_app(environ, start_response)
+            latency = time.perf_counter() - started
+            return body
+        finally:
+            # The slot covers producing the response; a streamed body
+            # (exports) is sent after it is freed
+            self.release(latency)
+
+    def priority(self, environ):
+        """The request's priority, from its endpoint and query string."""
+
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return "normal"
+
+        priority = self.priorities.get(endpoint, "normal")
+        if priority == "normal" and "before=" in environ.get("QUERY_STRING", ""):
+            return "expensive"
+        return priority
+
+    def release(self, latency):
+        """Free a slot and, given its latency, adapt the limit."""
+
+        with self.lock:
+            self.in_flight -= 1
+            if latency is None:
+                return
+
+            if self.fast is None:
+                self.fast = self.slow = latency
+            else:
+                self.fast += FAST_WEIGHT * (latency - self.fast)
+                self.slow += SLOW_WEIGHT * (latency - self.slow)
+
+            # After a slow spell, don't let a stale slow average hide the next
+            if self.slow > 2 * self.fast:
+                self.slow = 2 * self.fast
+
+            gradient = max(0.5, min(1.0, self.tolerance * self.slow / self.fast))
+            limit = self.limit * gradient + math.sqrt(self.limit)
+
+            # Don't grow a limit that isn't being used
+            if gradient == 1.0 and self.in_flight + 1 < self.limit / 2:
+                limit = self.limit
+
+            self.limit = max(self.min_limit, min(self.max_limit,
+                                                 0.8 * self.limit + 0.2 * limit))
+
+        metrics.set("warbler_admission_limit", value=self.limit)
+
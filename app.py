@@ -1,41 +1,179 @@
+"""Warbler: a Twitter clone.
+
+`create_app()` builds an app from one of the profiles in config.py; the
+views live on the `bp` blueprint. For servers and the flask CLI, the
+module also has a default `app`, created on first access:
+
+    FLASK_APP=app.py flask run
+    gunicorn 'app:create_app("production")'
+"""
+
+import time
+
+_import_started = time.perf_counter()
+
 import os
-import pdb
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+import click
+from datetime import datetime
+
+from flask import (Blueprint, Flask, render_template, request, flash, redirect, session,
+                   g, abort, Response, current_app, url_for, stream_with_context, jsonify)
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import func, select
 from sqlalchemy.exc import IntegrityError
 
-from forms import UserAddForm, LoginForm, MessageForm, EditUserForm
-from models import db, connect_db, User, Message, Likes
+import config
+from admission import AdmissionController
+import availability
+from cache import make_cache
+from forms import UserAddForm, LoginForm, MessageForm, EditUserForm, ProfilerForm
+from models import (db, bcrypt, connect_db, User, Message, Likes, Follows, Job, UserDeletion,
+                    Tag)
+import deletion
+import export
+import hot_messages
+import hydration
+import images
+import jobs
+import like_buffer
+from ratelimit import RateLimiter
+import message_stats
+import activity
+import notifications
+import outbox
+import page_cache
+from metrics import metrics
+from profiler import SamplingProfiler
+import tagging
+import trending
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+bp = Blueprint('warbler', __name__)
+
+
+def create_app(profile=None, overrides=None):
+    """Build a Warbler app.
+
+    `profile` names a config profile ("development", "testing" or
+    "production"; default: the WARBLER_ENV environment variable, else
+    "development"). `overrides` is a dict of settings applied last.
+    """
+
+    started = time.perf_counter()
+    profile = profile or os.environ.get('WARBLER_ENV', 'development')
+
+    app = Flask(__name__)
+    app.config.from_object(config.PROFILES[profile])
+    app.config.update(config.from_environ(profile))
+    app.config.update(overrides or {})
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError(f"Set SECRET_KEY to run the {profile!r} profile")
+
+    # Take the client address, scheme and host from the trusted proxies' headers
+    if app.config['TRUSTED_PROXIES']:
+        from werkzeug.contrib.fixers import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=app.config['TRUSTED_PROXIES'])
+
+    connect_db(app)
+    bcrypt.init_app(app)
+
+    # Only development pays for importing the toolbar
+    if app.config['DEBUG_TOOLBAR']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    app.extensions['cache'] = make_cache(app.config['CACHE_URL'])
+
+    app.extensions['trending'] = trending.TrendingBoard()
+
+    if app.config['LIKE_WRITE_BEHIND']:
+        app.extensions['like_buffer'] = like_buffer.LikeBuffer(
+            app, app.config['LIKE_JOURNAL_DIR'],
+            interval=app.config['LIKE_FLUSH_INTERVAL'],
+            max_items=app.config['LIKE_FLUSH_MAX'])
+
+    app.extensions['images'] = images.ImageCache(
+        app.config['IMAGE_CACHE_DIR'], app.config['IMAGE_CACHE_MAX_BYTES'],
+        static_folder=app.static_folder, timeout=app.config['IMAGE_FETCH_TIMEOUT'],
+        max_source_bytes=app.config['IMAGE_MAX_SOURCE_BYTES'],
+        allow_private_hosts=app.config['IMAGE_ALLOW_PRIVATE_HOSTS'])
+
+    availability.Availability(app)
+
+    # Before the hooks that may refuse a request, so refusals are measured
+    metrics.init_app(app, engine_getter=lambda: db.get_engine(app))
+
+    RateLimiter(CURR_USER_KEY, app)
+
+    if app.config['ADMISSION_CONTROL']:
+        AdmissionController(app)
+
+    app.extensions['profiler'] = SamplingProfiler()
+    app.extensions['profiler'].init_app(app)
+
+    # Before the blueprint's add_user_to_g, so a cached page needs no query
+    page_cache.PageCache(CURR_USER_KEY, app)
+
+    app.register_blueprint(bp)
+
+    app.cli.add_command(jobs_worker)
+    app.cli.add_command(trending_rebuild)
+    app.cli.add_command(graph_stats_command)
+    app.cli.add_command(hot_messages_rebuild)
+    app.cli.add_command(stats_reconcile)
+    app.cli.add_command(tags_backfill)
+    app.cli.add_command(export_user_command)
+    app.cli.add_command(outbox_consume)
+    app.cli.add_command(outbox_replay)
+
+    app.jinja_env.filters['linkify'] = tagging.linkify
+    app.jinja_env.filters['image'] = images.image_filter
+
+    if app.config['JINJA_BYTECODE_CACHE_DIR']:
+        os.makedirs(app.config['JINJA_BYTECODE_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            app.config['JINJA_BYTECODE_CACHE_DIR'])
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
+    if app.config['PRECOMPILE_TEMPLATES']:
+        for name in app.jinja_env.list_templates(extensions=["html"]):
+            app.jinja_env.get_template(name)
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+    metrics.set("warbler_boot_seconds", (("phase", "import"),), _import_seconds)
+    metrics.set("warbler_boot_seconds", (("phase", "create_app"),),
+                time.perf_counter() - started)
+    app.logger.info("Created %s app in %.3fs (module import took %.3fs)",
+                    profile, time.perf_counter() - started, _import_seconds)
 
-connect_db(app)
+    return app
+
+
+def __getattr__(name):
+    """Create the default app the first time `app.app` is used."""
+
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = (User
+                  .query
+                  .filter_by(id=session[CURR_USER_KEY], deleted_at=None)
+                  .first())
 
     else:
         g.user = None
@@ -54,7 +192,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -69,6 +207,15 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # Turn away taken names before paying for bcrypt and an INSERT
+        names = current_app.extensions['availability']
+        if names.taken("username", form.username.data):
+            flash("Username already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+        if names.taken("email", form.email.data):
+            flash("Email already registered", 'danger')
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -76,12 +223,15 @@ def signup():
                 email=form.email.data,
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
+            db.session.flush()
+            outbox.emit("user.created", user_id=user.id)
             db.session.commit()
 
         except IntegrityError:
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        names.add(user)
         do_login(user)
 
         return redirect("/")
@@ -90,7 +240,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -110,7 +260,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -127,7 +277,7 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@bp.route('/users')
 def list_users():
     """Page with listing of users.
 
@@ -136,43 +286,36 @@ def list_users():
 
     search = request.args.get('q')
 
+    users = User.query.filter(User.deleted_at.is_(None))
+
     if not search:
-        users = User.query.all()
+        users = users.all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = users.filter(User.username.like(f"%{search}%")).all()
 
     return render_template('users/index.html', users=users)
 
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.query.filter_by(id=user_id, deleted_at=None).first_or_404()
+    page_cache.tag(f"user:{user.id}")
 
-    # snagging messages in order from the database;
+    # snagging message ids in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    message_ids = hot_messages.timeline([user_id], limit=100)
+    messages = hydration.hydrate_messages(message_ids)
                 
-    # Get the number of likes by the user 
-    total_likes = Likes.query.all()
-    user_likes = []
-    
-    for like in total_likes:
-        if like.user_id == session[CURR_USER_KEY]:
-            user_likes.append(like)
-    
-    total_user_likes = len(user_likes)
-    
-    return render_template('users/show.html', user=user, messages=messages, like_count=total_user_likes)
+    # Get the number of likes by the user
+    total_user_likes = Likes.query.filter_by(user_id=user.id).count()
+
+    return render_template('users/show.html', user=user, messages=messages, like_count=total_user_likes,
+                           stats=message_stats.get_many(message_ids))
 
 
-@app.route('/users/<int:user_id>/following')
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -180,11 +323,11 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = User.query.filter_by(id=user_id, deleted_at=None).first_or_404()
     return render_template('users/following.html', user=user)
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -192,11 +335,11 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = User.query.filter_by(id=user_id, deleted_at=None).first_or_404()
     return render_template('users/followers.html', user=user)
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -204,14 +347,18 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
+    followed_user = (User
+                     .query
+                     .filter_by(id=follow_id, deleted_at=None)
+                     .first_or_404())
     g.user.following.append(followed_user)
+    outbox.emit("follow.created", follower_id=g.user.id, followed_id=followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -221,12 +368,13 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    outbox.emit("follow.deleted", follower_id=g.user.id, followed_id=followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -255,6 +403,16 @@ def profile():
             newEmail = form.email.data 
             newImageUrl = form.image_url.data 
             newHeaderImageUrl = form.header_image_url.data 
+
+            # Check for taken names; the unique constraints catch races
+            names = current_app.extensions['availability']
+            if newUsername != user.username and names.taken("username", newUsername):
+                flash("Username already taken", "danger")
+                return render_template("/users/edit.html", form=form)
+            if newEmail != user.email and names.taken("email", newEmail):
+                flash("Email already registered", "danger")
+                return render_template("/users/edit.html", form=form)
+            oldUsername, oldEmail = user.username, user.email
             
             # Edit the user 
             user.username = newUsername 
@@ -263,7 +421,18 @@ def profile():
             user.header_image_url = newHeaderImageUrl
             
             db.session.add(user)
-            db.session.commit()
+            outbox.emit("user.updated", user_id=user.id,
+                        fields=sorted(attr.key for attr in db.inspect(user).attrs
+                                      if attr.history.has_changes()))
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                flash("Username or email already taken", "danger")
+                return render_template("/users/edit.html", form=form)
+            names.rename(user, oldUsername, oldEmail)
+            hydration.users.invalidate([user.id])
+            page_cache.purge(f"user:{user.id}")
             
             # Flash a success message and navigate back to user profile 
             flash("Successfully updated!")
@@ -276,7 +445,25 @@ def profile():
         return render_template("/users/edit.html", form=form)
 
 
-@app.route('/users/delete', methods=["POST"])
+@bp.route('/users/available')
+def users_available():
+    """Is `?username=` (or `?email=`) free? For the sign-up and profile forms.
+
+    Answered from memory; see availability.py.
+    """
+
+    kind = next((kind for kind in availability.KINDS if request.args.get(kind)), None)
+    if kind is None:
+        abort(400)
+
+    value = request.args[kind]
+    own = g.user is not None and getattr(g.user, kind) == value
+    taken = not own and current_app.extensions['availability'].is_taken(kind, value)
+
+    return jsonify({kind: value, "available": not taken})
+
+
+@bp.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -286,16 +473,78 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # Hide the user now; their rows are purged by a background job
+    deletion.delete_account(g.user)
+    outbox.emit("user.deleted", user_id=g.user.id)
     db.session.commit()
+    hydration.users.invalidate([g.user.id])
+    page_cache.purge(f"user:{g.user.id}")
 
     return redirect("/signup")
 
 
+@bp.route('/users/export')
+def export_user():
+    """Download the current user's data as NDJSON (default) or CSV.
+
+    Gzipped if the client accepts it; `?cursor=` resumes after a record.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    format = request.args.get('format', 'ndjson')
+    cursor = request.args.get('cursor')
+    if format not in export.FORMATS:
+        abort(400)
+    try:
+        export.parse_cursor(cursor)
+    except ValueError:
+        abort(400)
+
+    body = export.encode(export.records(g.user.id, cursor), format)
+    headers = {"Content-Disposition":
+               f"attachment; filename=warbler-{g.user.username}.{format}",
+               "Vary": "Accept-Encoding"}
+    if request.accept_encodings['gzip']:
+        body = export.gzipped(body)
+        headers["Content-Encoding"] = "gzip"
+
+    mimetype = "text/csv" if format == "csv" else "application/x-ndjson"
+    return Response(stream_with_context(body), mimetype=mimetype, headers=headers)
+
+
+@bp.route('/images/<variant>/<signature>')
+def image_proxy(variant, signature):
+    """Serve a resized, cached copy of the image at `?url=`; see images.py."""
+
+    url = request.args.get('url', '')
+    if variant not in images.VARIANTS or not images.verify(url, signature):
+        abort(404)
+
+    try:
+        data, digest, result = current_app.extensions['images'].get(url, variant)
+    except images.ImageError as exc:
+        current_app.logger.info("Image proxy: %s", exc)
+        metrics.inc("warbler_image_requests_total", (("result", "error"),))
+        default = images.DEFAULT_HEADER if variant == "header" else images.DEFAULT_IMAGE
+        if url == default:
+            abort(404)
+        return redirect(images.image_filter(default, variant))
+
+    metrics.inc("warbler_image_requests_total", (("result", result),))
+
+    resp = Response(data, mimetype=images.mimetype(data))
+    resp.headers['Cache-Control'] = f"public, max-age={images.MAX_AGE}, immutable"
+    resp.set_etag(f"{digest[:16]}-{variant}")
+    return resp.make_conditional(request)
+
+
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -311,22 +560,33 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+
+        tagging.index_messages([(msg.id, msg.text)])
+        outbox.emit("message.created", message_id=msg.id, user_id=g.user.id)
         db.session.commit()
+        page_cache.purge(f"user:{g.user.id}")
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@bp.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = Message.query.get_or_404(message_id)
+
+    if msg.user.deleted_at:
+        abort(404)
+    page_cache.tag(f"message:{msg.id}", f"user:{msg.user_id}")
+
+    return render_template('messages/show.html', message=msg,
+                           stats=message_stats.get_many([msg.id])[msg.id])
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -335,8 +595,12 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    tagging.unindex_messages([msg.id])
     db.session.delete(msg)
+    outbox.emit("message.deleted", message_id=msg.id, user_id=msg.user_id)
     db.session.commit()
+    hydration.messages.invalidate([message_id])
+    page_cache.purge(f"message:{message_id}", f"user:{msg.user_id}")
 
     return redirect(f"/users/{g.user.id}")
 
@@ -345,7 +609,7 @@ def messages_destroy(message_id):
 # Homepage and error pages
 
 
-@app.route('/')
+@bp.route('/')
 def homepage():
     """Show homepage:
 
@@ -354,50 +618,30 @@ def homepage():
     """
 
     if g.user:
-        # Get a list of all the users that the current user follows 
-        following_list = User.query.get(session[CURR_USER_KEY]).following 
-        
-        # Get the ids of all the users following 
-        following_ids = set()
-        for user in following_list:
-            following_ids.add(user.id)
-        
-        # Get all messages from all users, ordered by timestamp 
-        messages = (Message
-                    .query
-                    .order_by(Message.timestamp.desc())
-                    .all())
-                    
-        # Filter out messages not by users that the user follows 
-        filtered_messages = []
-        for message in messages:
-            if message.user_id in following_ids:
-                filtered_messages.append(message)
-        
-        # Get the user's likes 
-        users_likes = Likes.query.all()
-        
-        # Get the message ids from user's likes 
-        liked_message_ids = []
-        for like in users_likes:
-            if like.user_id == session[CURR_USER_KEY]:
-                liked_message_ids.append(like.message_id)
-        
-        # Shorten to only show the latest 100 if there are more than 100 posts 
-        if len(filtered_messages) < 100:
-            return render_template('home.html', messages=filtered_messages, likes=liked_message_ids)
-        else:
-            shortened_messages = []
-            for i in range(0, 100):
-                shortened_messages.append(filtered_messages[i])
-                return render_template('home.html', messages=shortened_messages, likes=liked_message_ids)
+        # Get the ids of all the users the current user follows
+        following_ids = [user.id for user in g.user.following]
+
+        # The latest 100 messages by those users
+        message_ids = hot_messages.timeline(following_ids, limit=100)
+        messages = hydration.hydrate_messages(message_ids)
+
+        # Get the message ids from user's likes
+        liked_message_ids = [id for (id,) in (db.session
+                                              .query(Likes.message_id)
+                                              .filter(Likes.user_id == g.user.id))]
+
+        stats = message_stats.get_many(message_ids)
+        liked_message_ids = like_buffer.overlay(g.user.id, liked_message_ids, stats)
+
+        return render_template('home.html', messages=messages, likes=liked_message_ids,
+                               stats=stats)
     else:
         return render_template('home-anon.html')
         
 ###############################################################################
 # Like Routes 
 
-@app.route("/users/add_like/<msgId>", methods=["POST"])
+@bp.route("/users/add_like/<msgId>", methods=["POST"])
 def add_remove_like(msgId):
     """Adds/Removes a like"""
     # First, get the message to determine who wrote it 
@@ -405,6 +649,11 @@ def add_remove_like(msgId):
     
     # Only allow like if message is NOT written by current user 
     if message.user_id != session[CURR_USER_KEY]:
+
+        # In write-behind mode, buffer the toggle and return right away
+        if 'like_buffer' in current_app.extensions:
+            current_app.extensions['like_buffer'].toggle(session[CURR_USER_KEY], message.id)
+            return redirect('/')
         
         # Get the ids of all the messages that user has already liked 
         user_likes = User.query.get(session[CURR_USER_KEY]).likes
@@ -414,32 +663,456 @@ def add_remove_like(msgId):
         
         # If user has already liked message, unlike it 
         if message.id not in user_msg_ids:
-            like = Likes(user_id=session[CURR_USER_KEY], message_id=msgId)
+            like = Likes(user_id=session[CURR_USER_KEY], message_id=msgId,
+                         timestamp=datetime.utcnow())
             
             db.session.add(like)
+            log_score = trending.record_like(message.id, like.timestamp)
+            message_stats.bump(message.id, "likes", 1)
+            outbox.emit("like.created", user_id=like.user_id, message_id=message.id)
             db.session.commit()
             
         else:
             like = Likes.query.filter_by(user_id=session[CURR_USER_KEY], message_id=message.id).first()
             
             db.session.delete(like)
+            log_score = trending.record_unlike(message.id, like.timestamp)
+            message_stats.bump(message.id, "likes", -1)
+            outbox.emit("like.deleted", user_id=like.user_id, message_id=message.id)
             db.session.commit()
 
+        current_app.extensions['trending'].update(message.id, log_score)
+
     return redirect('/')
 
-@app.route('/users/<userId>/likes')
+@bp.route('/users/<userId>/likes')
 def get_likes_page(userId):
     """Displays the likes page"""
-    # Get all liked messages 
-    liked_messages = User.query.get(userId).likes 
-    
-    # Get just the ids of liked messages 
-    ids = []
-    for like in liked_messages:
-        ids.append(like.id)
-    
-    return render_template("/users/likes.html", messages=liked_messages, likes=ids)
+    user = User.query.filter_by(id=userId, deleted_at=None).first_or_404()
+    page_cache.tag(f"user:{user.id}")
+
+    # Get just the ids of liked messages
+    ids = [id for (id,) in (db.session
+                            .query(Likes.message_id)
+                            .filter(Likes.user_id == user.id)
+                            .order_by(Likes.id))]
+
+    # Hydrating leaves out messages by deleted users
+    liked_messages = hydration.hydrate_messages(ids)
+
+    return render_template("/users/likes.html", messages=liked_messages, likes=ids,
+                           stats=message_stats.get_many(msg.id for msg in liked_messages))
+
+
+@bp.route('/trending')
+def trending_page():
+    """Show the messages with the most recent likes."""
+
+    message_ids = current_app.extensions['trending'].top()
+    messages = hydration.hydrate_messages(message_ids)
+
+    stats = message_stats.get_many(message_ids)
+
+    liked_message_ids = []
+    if g.user:
+        liked_message_ids = [id for (id,) in (db.session
+                                              .query(Likes.message_id)
+                                              .filter(Likes.user_id == g.user.id))]
+        liked_message_ids = like_buffer.overlay(g.user.id, liked_message_ids, stats)
+
+    return render_template('trending.html', messages=messages, likes=liked_message_ids,
+                           stats=stats)
+
+
+@bp.route('/notifications')
+def notifications_page():
+    """Show the logged-in user's notifications, latest first, and mark them read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    try:
+        rows, before = notifications.page(g.user.id, request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+    cards = notifications.cards(rows)
+
+    # The cards keep which ones were new; the nav shows none left
+    if g.user.unread_notifications:
+        notifications.mark_read(g.user)
+
+    html = render_template('notifications.html', notifications=cards,
+                           next_url=url_for('warbler.notifications_page', before=before)
+                           if before else None)
+    db.session.commit()
+
+    return html
+
+
+@bp.route('/tags/<tag>')
+def tag_timeline(tag):
+    """Show messages using a hashtag, newest first."""
+
+    tag = Tag.query.filter_by(name=tag.lower()).first_or_404()
+    message_ids, before = tagging.tag_page(tag.id, request.args.get('before', type=int))
+
+    return render_feed(f"#{tag.name}", f"{tag.message_count} warbles", message_ids,
+                       url_for('warbler.tag_timeline', tag=tag.name, before=before)
+                       if before else None)
+
+
+@bp.route('/users/<int:user_id>/mentions')
+def user_mentions(user_id):
+    """Show messages mentioning a user, newest first."""
+
+    user = User.query.filter_by(id=user_id, deleted_at=None).first_or_404()
+    message_ids, before = tagging.mention_page(user.id, request.args.get('before', type=int))
+
+    return render_feed(f"Mentioning @{user.username}", None, message_ids,
+                       url_for('warbler.user_mentions', user_id=user.id, before=before)
+                       if before else None)
+
+
+def render_feed(title, subtitle, message_ids, next_url):
+    """Render one page of a message feed."""
+
+    messages = hydration.hydrate_messages(message_ids)
+    stats = message_stats.get_many(message_ids)
+
+    liked_message_ids = []
+    if g.user:
+        liked_message_ids = [id for (id,) in (db.session
+                                              .query(Likes.message_id)
+                                              .filter(Likes.user_id == g.user.id,
+                                                      Likes.message_id.in_(message_ids)))]
+        liked_message_ids = like_buffer.overlay(g.user.id, liked_message_ids, stats)
 
+    return render_template('messages/feed.html', title=title, subtitle=subtitle,
+                           messages=messages, likes=liked_message_ids, stats=stats,
+                           next_url=next_url)
+
+
+##############################################################################
+# JSON versions of the read-heavy pages (asgi.py serves these too)
+
+
+@bp.route('/api/timeline')
+def api_timeline():
+    """The logged-in user's homepage timeline."""
+
+    if not g.user:
+        return jsonify(error="Log in to see your timeline"), 401
+
+    message_ids = hot_messages.timeline([user.id for user in g.user.following], limit=100)
+    messages = hydration.hydrate_messages(message_ids)
+    stats = message_stats.get_many(message_ids)
+    liked_message_ids = [id for (id,) in (db.session
+                                          .query(Likes.message_id)
+                                          .filter(Likes.user_id == g.user.id,
+                                                  Likes.message_id.in_(message_ids)))]
+    liked_message_ids = like_buffer.overlay(g.user.id, liked_message_ids, stats)
+
+    return jsonify(messages=[message_json(msg, stats[msg.id]) for msg in messages],
+                   liked=sorted(liked_message_ids))
+
+
+@bp.route('/api/users')
+def api_users():
+    """Users, optionally matching the 'q' param, as on /users."""
+
+    users = User.query.filter(User.deleted_at.is_(None))
+    if request.args.get('q'):
+        users = users.filter(User.username.like(f"%{request.args['q']}%"))
+
+    return jsonify(users=[user_json(user) for user in users])
+
+
+@bp.route('/api/users/<int:user_id>')
+def api_user(user_id):
+    """A user's profile, counts and latest messages."""
+
+    user = User.query.filter_by(id=user_id, deleted_at=None).first_or_404()
+
+    message_ids = hot_messages.timeline([user_id], limit=100)
+    messages = hydration.hydrate_messages(message_ids)
+    stats = message_stats.get_many(message_ids)
+    counts = db.session.execute(counts_query(user_id)).first()
+
+    return jsonify(dict(user_json(user, counts),
+                        messages=[message_json(msg, stats[msg.id]) for msg in messages]))
+
+
+@bp.route('/api/messages/<int:message_id>')
+def api_message(message_id):
+    """One message."""
+
+    msg = hydration.hydrate_messages([message_id])
+    if not msg:
+        abort(404)
+
+    return jsonify(message_json(msg[0], message_stats.get_many([message_id])[message_id]))
+
+
+def counts_query(user_id):
+    """SELECT a user's messages, following, followers and likes counts, as one row."""
+
+    def count(column, name):
+        return select([func.count()]).where(column == user_id).as_scalar().label(name)
+
+    return select([count(Message.__table__.c.user_id, "messages"),
+                   count(Follows.__table__.c.user_following_id, "following"),
+                   count(Follows.__table__.c.user_being_followed_id, "followers"),
+                   count(Likes.__table__.c.user_id, "likes")])
+
+
+def user_json(user, counts=None):
+    """A user (a User or a row with its columns) for the JSON API."""
+
+    data = {"id": user.id, "username": user.username, "image_url": user.image_url,
+            "header_image_url": user.header_image_url, "bio": user.bio,
+            "location": user.location}
+    if counts is not None:
+        data["counts"] = {name: counts[name]
+                          for name in ("messages", "following", "followers", "likes")}
+    return data
+
+
+def message_json(msg, stats):
+    """A hydration.MessageCard, and its Stats, for the JSON API."""
+
+    return {"id": msg.id, "text": msg.text, "timestamp": msg.timestamp.isoformat(),
+            "likes": stats.likes,
+            "user": {"id": msg.user.id, "username": msg.user.username,
+                     "image_url": msg.user.image_url}}
+
+
+##############################################################################
+# Admin pages and background jobs
+
+
+def is_admin():
+    """Is the logged in user allowed to see admin pages?"""
+
+    return bool(g.user) and g.user.username in current_app.config['ADMIN_USERNAMES']
+
+
+@bp.route('/admin/jobs')
+def admin_jobs():
+    """Show background job queue status and the most recent failures."""
+
+    if not is_admin():
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    stats = jobs.queue_stats()
+    failures = (Job
+                .query
+                .filter(Job.last_error.isnot(None))
+                .order_by(Job.id.desc())
+                .limit(20)
+                .all())
+
+    deletions = (UserDeletion
+                 .query
+                 .filter(UserDeletion.finished_at.is_(None))
+                 .order_by(UserDeletion.requested_at)
+                 .limit(20)
+                 .all())
+
+    return render_template('admin/jobs.html', stats=stats, failures=failures,
+                           deletions=deletions, consumer_lag=outbox.lag(),
+                           activity=activity.recent())
+
+
+@bp.route('/admin/profiler', methods=["GET", "POST"])
+def admin_profiler():
+    """Show profiler status; start a capture on POST."""
+
+    if not is_admin():
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    profiler = current_app.extensions['profiler']
+    form = ProfilerForm()
+
+    if form.validate_on_submit():
+        endpoint = form.endpoint.data or None
+
+        # Accept view names without the blueprint prefix
+        if endpoint and f"{bp.name}.{endpoint}" in current_app.view_functions:
+            endpoint = f"{bp.name}.{endpoint}"
+
+        if endpoint and endpoint not in current_app.view_functions:
+            flash(f"No such endpoint: {endpoint}", "danger")
+        elif profiler.start(rate=form.rate.data, endpoint=endpoint,
+                            duration=form.duration.data):
+            flash("Profiling started.", "success")
+        else:
+            flash("A capture is already running.", "danger")
+
+        return redirect("/admin/profiler")
+
+    return render_template('admin/profiler.html', form=form, status=profiler.status,
+                           stacks=profiler.top(20))
+
+
+@bp.route('/admin/profiler/stop', methods=["POST"])
+def admin_profiler_stop():
+    """Stop the running profiler capture."""
+
+    if not is_admin():
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    current_app.extensions['profiler'].stop()
+    return redirect("/admin/profiler")
+
+
+@bp.route('/admin/profiler/download')
+def admin_profiler_download():
+    """Download the captured samples as collapsed stacks."""
+
+    if not is_admin():
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return Response(
+        current_app.extensions['profiler'].collapsed(),
+        mimetype="text/plain",
+        headers={"Content-Disposition":
+                 f"attachment; filename=warbler-{os.getpid()}.collapsed"})
+
+
+@bp.route('/metrics')
+def metrics_page():
+    """Expose metrics in the Prometheus text format."""
+
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        abort(401)
+
+    return Response(metrics.render(),
+                    mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+
+@click.command('jobs-worker')
+@click.option('--concurrency', default=4, help="Jobs to run at once.")
+@click.option('--once', is_flag=True, help="Run one batch and exit.")
+@with_appcontext
+def jobs_worker(concurrency, once):
+    """Run the background job worker."""
+
+    worker = jobs.Worker(current_app._get_current_object(), concurrency=concurrency)
+
+    if once:
+        click.echo(f"Ran {worker.run_once()} job(s).")
+    else:
+        click.echo(f"Worker {worker.worker_id} waiting for jobs.")
+        worker.run()
+
+
+@click.command('trending-rebuild')
+@with_appcontext
+def trending_rebuild():
+    """Recompute trending scores from likes."""
+
+    click.echo(f"{trending.rebuild()} message(s) trending.")
+
+
+@click.command('graph-stats')
+@click.option('--workers', default=1, help="Processes for PageRank and clustering.")
+@with_appcontext
+def graph_stats_command(workers):
+    """Compute follow-graph metrics for every user."""
+
+    # NumPy and SciPy are only needed here; keep them out of the web workers
+    import graph_stats
+
+    report = graph_stats.run(workers)
+    click.echo(f"{report['users']} user(s), {report['edges']} follow(s): "
+               f"load {report['load_seconds']:.1f}s, compute {report['compute_seconds']:.1f}s, "
+               f"save {report['save_seconds']:.1f}s, total {report['total_seconds']:.1f}s; "
+               f"peak memory {report['peak_mb']:.0f} MB "
+               f"(workers {report['peak_worker_mb']:.0f} MB)")
+
+
+@click.command('hot-messages-rebuild')
+@with_appcontext
+def hot_messages_rebuild():
+    """Refill the hot timeline tier from messages."""
+
+    click.echo(f"{hot_messages.rebuild()} message(s) in the hot tier.")
+
+
+@click.command('stats-reconcile')
+@with_appcontext
+def stats_reconcile():
+    """Queue a recount of every message's counters."""
+
+    jobs.enqueue("reconcile_message_stats")
+    db.session.commit()
+    click.echo("Queued; a jobs-worker will recount message counters.")
+
+
+@click.command('tags-backfill')
+@click.option('--chunk', default=tagging.BACKFILL_CHUNK, help="Messages per transaction.")
+@with_appcontext
+def tags_backfill(chunk):
+    """Index the hashtags and mentions of every message."""
+
+    click.echo(f"Indexed {tagging.backfill(chunk)} message(s).")
+
+
+@click.command('export-user')
+@click.argument('username')
+@click.option('--format', type=click.Choice(export.FORMATS), default='ndjson')
+@click.option('--cursor', help="Carry on after this record's cursor.")
+@click.option('--gzip', 'compress', is_flag=True, help="Gzip the output.")
+@click.option('--output', type=click.File('wb'), default='-', help="File to write.")
+@with_appcontext
+def export_user_command(username, format, cursor, compress, output):
+    """Write a user's data as NDJSON or CSV."""
+
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.BadParameter(f"No user {username!r}", param_hint="USERNAME")
+    try:
+        export.parse_cursor(cursor)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc), param_hint="--cursor")
+
+    body = export.encode(export.records(user.id, cursor), format)
+    for piece in export.gzipped(body) if compress else (piece.encode() for piece in body):
+        output.write(piece)
+
+
+@click.command('outbox-consume')
+@click.option('--consumer', 'names', multiple=True, type=click.Choice(sorted(outbox.CONSUMERS)),
+              help="Run only this consumer (repeatable).")
+@click.option('--once', is_flag=True, help="Catch up once and exit.")
+@with_appcontext
+def outbox_consume(names, once):
+    """Feed outbox events to their consumers."""
+
+    runner = outbox.Runner(current_app._get_current_object(), list(names) or None)
+
+    if once:
+        click.echo(f"Consumed {runner.run_once()} event(s).")
+    else:
+        click.echo(f"Following the outbox for {', '.join(runner.names)}.")
+        runner.run()
+
+
+@click.command('outbox-replay')
+@click.argument('name', type=click.Choice(sorted(outbox.CONSUMERS)))
+@with_appcontext
+def outbox_replay(name):
+    """Clear a consumer's projection and replay every event into it."""
+
+    outbox.replay(name)
+    click.echo(f"Rewound {name}; outbox-consume will rebuild it.")
 
 ##############################################################################
 # Turn off all caching in Flask
@@ -448,12 +1121,19 @@ def get_likes_page(userId):
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@bp.after_app_request
 def add_header(req):
     """Add non-caching headers on every request."""
 
+    # Except where a view has said its response never changes (images)
+    if "immutable" in req.headers.get("Cache-Control", ""):
+        return req
+
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
     req.headers['Cache-Control'] = 'public, max-age=0'
     return req
+
+
+_import_seconds = time.perf_counter() - _import_started
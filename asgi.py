@@ -0,0 +1,378 @@
+"""The read-heavy pages, served by an ASGI app with an async database pool.
+
+Under WSGI a worker thread holds its database connection for the whole
+request and sits idle while each query round-trips, so a worker serves
+as many pages at once as it has threads. `create_asgi_app()` builds a
+Starlette app that serves
+
+    /                   homepage            /api/timeline
+    /users              list_users          /api/users
+    /users/<id>         users_show          /api/users/<id>
+    /messages/<id>      messages_show       /api/messages/<id>
+
+from an event loop instead: queries go through `databases` (asyncpg on
+Postgres, from a pool of ASYNC_DB_POOL_SIZE connections; aiosqlite on
+SQLite, which has no pool and opens a connection per query), a
+connection is held only while its query runs, and a page's independent
+queries run at once. Every other route is handed to the Flask app, on a
+thread pool, so one server runs the whole site:
+
+    uvicorn --factory asgi:create_asgi_app --workers 4
+
+The two share everything but the views. Queries are SQLAlchemy Core
+built from the same tables, mostly by the same functions the sync views
+use (`hot_messages.hot_query`, `EntityCache.select`, ...); snapshots come
+from the same cache, so invalidations by the Flask views apply here too.
+Pages are rendered by the Flask app's Jinja environment, in a request
+context whose `g.user` is a `UserView`, and the login is read from the
+Flask session cookie. Flashed messages wait for the next page the Flask
+app renders.
+
+Compare the two on the same routes with the benchmark:
+
+    python benchmark.py run --mode server --concurrency 32 --route warbler.homepage
+    python benchmark.py run --mode asgi --concurrency 32 --route warbler.homepage
+"""
+
+import asyncio
+import contextlib
+import functools
+import time
+from types import SimpleNamespace
+
+from a2wsgi import WSGIMiddleware
+from databases import Database
+from flask import g, render_template
+from itsdangerous import BadSignature
+from sqlalchemy import and_, select
+from sqlalchemy.engine.url import make_url
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import HTMLResponse, JSONResponse
+from starlette.routing import Mount, Route
+
+from app import create_app, CURR_USER_KEY, counts_query, message_json, user_json
+import hot_messages
+import hydration
+import like_buffer
+import message_stats
+from metrics import metrics
+from models import Follows, Likes, User
+
+TIMELINE_LIMIT = 100
+
+USER_COLUMNS = ("id", "username", "image_url", "header_image_url", "bio", "location",
+                "unread_notifications")
+
+# As the Flask app's add_header sets them
+HEADERS = {"Cache-Control": "public, max-age=0", "Pragma": "no-cache", "Expires": "0"}
+
+
+def create_asgi_app(profile=None, overrides=None):
+    """Build the ASGI app, around a Flask app built with the same arguments."""
+
+    pages = Pages(create_app(profile, overrides))
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        await pages.database.connect()
+        try:
+            yield
+        finally:
+            await pages.database.disconnect()
+
+    app = Starlette(routes=[
+        pages.route("/", pages.homepage),
+        pages.route("/users", pages.list_users),
+        pages.route("/users/{user_id:int}", pages.users_show),
+        pages.route("/messages/{message_id:int}", pages.messages_show),
+        pages.route("/api/timeline", pages.api_timeline),
+        pages.route("/api/users", pages.api_users),
+        pages.route("/api/users/{user_id:int}", pages.api_user),
+        pages.route("/api/messages/{message_id:int}", pages.api_message),
+        Mount("", app=WSGIMiddleware(pages.flask_app)),
+    ], lifespan=lifespan)
+    app.state.flask_app = pages.flask_app
+    return app
+
+
+def database_url(config):
+    """ASYNC_DATABASE_URL, or the app's database URL without its driver."""
+
+    if config['ASYNC_DATABASE_URL']:
+        return config['ASYNC_DATABASE_URL']
+
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    url.drivername = url.get_backend_name()
+    return str(url)
+
+
+class UserView(SimpleNamespace):
+    """A users row, standing in for a User in the templates.
+
+    They only ever count `messages`, `following` and `followers`, so
+    `count()` fills those in with ranges of the right lengths.
+    """
+
+    @classmethod
+    def from_row(cls, row, following_ids=frozenset()):
+        return cls(following_ids=following_ids, **{col: row[col] for col in USER_COLUMNS})
+
+    def count(self, counts):
+        for name in ("messages", "following", "followers"):
+            setattr(self, name, range(counts[name]))
+
+    def is_following(self, other):
+        return other.id in self.following_ids
+
+
+class Pages:
+    """The async views, and the Flask app whose templates and settings they use."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+
+        url = database_url(flask_app.config)
+        self.sqlite = url.startswith("sqlite")
+        pool = {} if self.sqlite else {
+            "min_size": 1, "max_size": flask_app.config['ASYNC_DB_POOL_SIZE']}
+        self.database = Database(url, **pool)
+
+        self.serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+        self.session_max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+
+    def route(self, path, view):
+        """A GET route for `view`, timed like the Flask views are."""
+
+        endpoint = f"asgi.{view.__name__}"
+
+        @functools.wraps(view)
+        async def timed(request):
+            started = time.perf_counter()
+            status = 500
+            try:
+                # Without a pool, opening a connection per query costs more
+                # than running a request's queries one at a time
+                async with (self.database.connection() if self.sqlite
+                            else contextlib.nullcontext()):
+                    response = await view(request)
+                response.headers.update(HEADERS)
+                status = response.status_code
+                return response
+            except HTTPException as exc:
+                status = exc.status_code
+                raise
+            finally:
+                metrics.observe("warbler_http_request_duration_seconds",
+                                (("endpoint", endpoint), ("method", request.method),
+                                 ("status", str(status))),
+                                time.perf_counter() - started)
+
+        return Route(path, timed, methods=["GET"], name=view.__name__)
+
+    def render(self, request, template, viewer, **context):
+        # Nothing awaits while the contexts are pushed, so no other
+        # request's can be interleaved with them
+        with self.flask_app.test_request_context(request.url.path,
+                                                 query_string=request.url.query):
+            g.user = viewer
+            return HTMLResponse(render_template(template, **context))
+
+    ##########################################################################
+    # Pages
+
+    async def homepage(self, request):
+        viewer = await self.viewer(request)
+        if viewer is None:
+            return self.render(request, "home-anon.html", None)
+
+        (messages, stats, likes), counts = await asyncio.gather(
+            self.feed(viewer, viewer.following_ids), self.counts(viewer.id))
+        viewer.count(counts)
+
+        return self.render(request, "home.html", viewer, messages=messages, likes=likes,
+                           stats=stats)
+
+    async def list_users(self, request):
+        viewer, users = await asyncio.gather(self.viewer(request),
+                                             self.search(request.query_params.get("q")))
+        return self.render(request, "users/index.html", viewer, users=users)
+
+    async def users_show(self, request):
+        user_id = request.path_params["user_id"]
+        viewer, user, counts, message_ids = await asyncio.gather(
+            self.viewer(request), self.user(user_id), self.counts(user_id),
+            self.timeline([user_id]))
+        if user is None:
+            raise HTTPException(404)
+
+        messages, stats = await asyncio.gather(self.hydrate(message_ids),
+                                               self.stats(message_ids))
+        user.count(counts)
+
+        return self.render(request, "users/show.html", viewer, user=user, messages=messages,
+                           stats=stats, like_count=counts["likes"])
+
+    async def messages_show(self, request):
+        message_id = request.path_params["message_id"]
+        viewer, messages, stats = await asyncio.gather(
+            self.viewer(request), self.hydrate([message_id]), self.stats([message_id]))
+        if not messages:
+            raise HTTPException(404)
+
+        return self.render(request, "messages/show.html", viewer, message=messages[0],
+                           stats=stats[message_id])
+
+    ##########################################################################
+    # JSON
+
+    async def api_timeline(self, request):
+        viewer = await self.viewer(request)
+        if viewer is None:
+            return JSONResponse({"error": "Log in to see your timeline"}, 401)
+
+        messages, stats, likes = await self.feed(viewer, viewer.following_ids)
+        return JSONResponse({"messages": [message_json(msg, stats[msg.id]) for msg in messages],
+                             "liked": sorted(likes)})
+
+    async def api_users(self, request):
+        users = await self.search(request.query_params.get("q"))
+        return JSONResponse({"users": [user_json(user) for user in users]})
+
+    async def api_user(self, request):
+        user_id = request.path_params["user_id"]
+        user, counts, message_ids = await asyncio.gather(
+            self.user(user_id), self.counts(user_id), self.timeline([user_id]))
+        if user is None:
+            raise HTTPException(404)
+
+        messages, stats = await asyncio.gather(self.hydrate(message_ids),
+                                               self.stats(message_ids))
+        return JSONResponse(dict(user_json(user, counts),
+                                 messages=[message_json(msg, stats[msg.id])
+                                           for msg in messages]))
+
+    async def api_message(self, request):
+        message_id = request.path_params["message_id"]
+        messages, stats = await asyncio.gather(self.hydrate([message_id]),
+                                               self.stats([message_id]))
+        if not messages:
+            raise HTTPException(404)
+
+        return JSONResponse(message_json(messages[0], stats[message_id]))
+
+    ##########################################################################
+    # Queries
+
+    async def viewer(self, request):
+        """The logged-in user, with the ids they follow, or None."""
+
+        cookie = request.cookies.get(self.flask_app.session_cookie_name)
+        if not cookie:
+            return None
+        try:
+            user_id = self.serializer.loads(cookie, max_age=self.session_max_age).get(
+                CURR_USER_KEY)
+        except BadSignature:
+            return None
+        if user_id is None:
+            return None
+
+        follows = Follows.__table__
+        user, rows = await asyncio.gather(
+            self.user(user_id),
+            self.database.fetch_all(select([follows.c.user_being_followed_id])
+                                    .where(follows.c.user_following_id == user_id)))
+        if user is not None:
+            user.following_ids = {row[0] for row in rows}
+        return user
+
+    async def user(self, user_id):
+        """A UserView of a user who isn't deleted, or None."""
+
+        users = User.__table__
+        row = await self.database.fetch_one(
+            select([users.c[col] for col in USER_COLUMNS])
+            .where(and_(users.c.id == user_id, users.c.deleted_at.is_(None))))
+        return UserView.from_row(row) if row is not None else None
+
+    async def search(self, q):
+        """UserViews of users, matching `q` if given, as on /users."""
+
+        users = User.__table__
+        query = (select([users.c[col] for col in USER_COLUMNS])
+                 .where(users.c.deleted_at.is_(None)))
+        if q:
+            query = query.where(users.c.username.like(f"%{q}%"))
+        return [UserView.from_row(row) for row in await self.database.fetch_all(query)]
+
+    async def counts(self, user_id):
+        return await self.database.fetch_one(counts_query(user_id))
+
+    async def feed(self, viewer, user_ids):
+        """(MessageCards, {id: Stats}, liked ids) for the timeline of `user_ids`."""
+
+        message_ids = await self.timeline(user_ids)
+
+        likes = Likes.__table__
+        messages, stats, rows = await asyncio.gather(
+            self.hydrate(message_ids), self.stats(message_ids),
+            self.database.fetch_all(select([likes.c.message_id])
+                                    .where(and_(likes.c.user_id == viewer.id,
+                                                likes.c.message_id.in_(message_ids)))))
+
+        with self.flask_app.app_context():
+            liked = like_buffer.overlay(viewer.id, [row[0] for row in rows], stats)
+        return messages, stats, liked
+
+    async def timeline(self, user_ids):
+        """As hot_messages.timeline(user_ids, limit=TIMELINE_LIMIT)."""
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return []
+
+        cutoff = hot_messages.boundary()
+        rows = await self.database.fetch_all(
+            hot_messages.hot_query(user_ids, TIMELINE_LIMIT, cutoff))
+        ids = [row[0] for row in rows]
+        metrics.inc("warbler_timeline_reads_total", (("tier", "hot"),))
+
+        if len(ids) < TIMELINE_LIMIT:
+            rows = await self.database.fetch_all(
+                hot_messages.archive_query(user_ids, TIMELINE_LIMIT - len(ids), cutoff))
+            ids += [row[0] for row in rows]
+            metrics.inc("warbler_timeline_reads_total", (("tier", "archive"),))
+
+        return ids
+
+    async def hydrate(self, ids):
+        """As hydration.hydrate_messages(ids)."""
+
+        found = await self.snapshots(hydration.messages, ids)
+        authors = await self.snapshots(hydration.users,
+                                       (user_id for (_, _, user_id) in found.values()))
+        return hydration.message_cards(
+            ids, found, {id: hydration.UserCard(id, *values) for id, values in authors.items()})
+
+    async def snapshots(self, entities, ids):
+        """As entities.get_many(ids), for a hydration.EntityCache."""
+
+        with self.flask_app.app_context():
+            found, misses = entities.lookup(ids)
+
+        if misses:
+            rows = await self.database.fetch_all(entities.select(misses))
+            with self.flask_app.app_context():
+                found.update(entities.store(rows))
+
+        return found
+
+    async def stats(self, ids):
+        """As message_stats.get_many(ids)."""
+
+        stats = dict.fromkeys(ids, message_stats.EMPTY)
+        if ids:
+            rows = await self.database.fetch_all(message_stats.select_many(ids))
+            stats.update((row[0], message_stats.Stats(row[1], row[2], row[3])) for row in rows)
+        return stats
@@ -0,0 +1,263 @@
+"""Fast checks of whether a username or email is taken.
+
+Every worker keeps, for usernames and for emails, a Bloom filter in
+front of a sorted array of 64-bit hashes of every value in `users`
+(deleted users' too, as their names are held until the purge). A lookup
+that misses the filter is answered "free" at once; one that hits it is
+confirmed by a binary search of the hashes. Neither touches the
+database: with a million users each column takes about 10MB, and a
+lookup a few microseconds.
+
+The sets are built when the app is created, by streaming `users` (a few
+seconds per million users), so no request waits for them, and kept
+current in this worker by `add()`, `rename()` and `remove()` calls from
+the views and the purge. A background thread in each worker process
+does the rest, off the request path: every AVAILABILITY_REFRESH_INTERVAL
+seconds it adds other workers' signups (users with ids past the highest
+seen), and every AVAILABILITY_REBUILD_INTERVAL seconds it rebuilds the
+sets, or as soon as it can if the first build failed (say, before the
+tables existed); until then the database answers.
+
+Renames and purges in other workers only arrive with the rebuild. Until
+then this worker still reports the old name taken (`taken()` confirms
+against the database, so that costs a query, not a refusal) and the new
+name free, so a signup for it gets as far as the unique constraint,
+which stays the last word. The answers are advisory.
+"""
+
+import bisect
+import logging
+import math
+import os
+import threading
+import time
+from array import array
+
+from flask import current_app
+
+from deletion import purge_hook
+from metrics import metrics
+from models import db, User
+
+KINDS = ("username", "email")
+
+# Target false positive rate, and the fewest values a filter is sized for
+ERROR_RATE = 0.01
+MIN_CAPACITY = 1024
+
+BUILD_CHUNK = 10_000
+
+log = logging.getLogger(__name__)
+
+
+def value_hash(value):
+    # The sets live in one process, so its (seeded) str hash will do
+    return hash(value) & 0xFFFFFFFFFFFFFFFF
+
+
+class NameSet:
+    """A Bloom filter over a sorted array of value hashes.
+
+    The filter's bits are derived from the stored hash alone, so it can be
+    rebuilt (larger) from the array. Removing a value only removes its
+    hash from the array; its bits stay set until the next rebuild.
+    """
+
+    def __init__(self, hashes=()):
+        self.hashes = array("Q", sorted(set(hashes)))
+        self._size_filter(max(MIN_CAPACITY, 2 * len(self.hashes)))
+
+    def _size_filter(self, capacity):
+        """Size the filter for `capacity` values and set the bits of every hash."""
+
+        self.capacity = capacity
+        self.bit_count = math.ceil(-capacity * math.log(ERROR_RATE) / math.log(2) ** 2)
+        self.probes = max(1, round(self.bit_count / capacity * math.log(2)))
+
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.set_count = 0
+        for h in self.hashes:
+            self._set_bits(h)
+
+    def _positions(self, h):
+        # Double hashing on the two halves of the hash
+        a, b = h & 0xFFFFFFFF, (h >> 32) | 1
+        return ((a + i * b) % self.bit_count for i in range(self.probes))
+
+    def _set_bits(self, h):
+        for pos in self._positions(h):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.set_count += 1
+
+    def might_contain(self, h):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(h))
+
+    def __contains__(self, h):
+        i = bisect.bisect_left(self.hashes, h)
+        return i < len(self.hashes) and self.hashes[i] == h
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, h):
+        if h in self:
+            return
+        bisect.insort(self.hashes, h)
+        if self.set_count >= self.capacity:
+            self._size_filter(2 * self.capacity)
+        else:
+            self._set_bits(h)
+
+    def remove(self, h):
+        i = bisect.bisect_left(self.hashes, h)
+        if i < len(self.hashes) and self.hashes[i] == h:
+            del self.hashes[i]
+
+
+class Availability:
+    """This worker's sets of taken usernames and emails."""
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.sets = None
+        self.max_id = 0
+        self.built_at = 0.0
+        self.pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.refresh_interval = app.config['AVAILABILITY_REFRESH_INTERVAL']
+        self.rebuild_interval = app.config['AVAILABILITY_REBUILD_INTERVAL']
+        app.extensions['availability'] = self
+
+        try:
+            with app.app_context():
+                self.build()
+        except Exception:
+            log.warning("Couldn't build the availability sets; asking the database until "
+                        "a rebuild works", exc_info=True)
+
+    def is_taken(self, kind, value):
+        """Whether `value` is a taken `kind` ("username" or "email"), from memory."""
+
+        self._start()
+        if self.sets is None:
+            metrics.inc("warbler_availability_checks_total", (("answer", "database"),))
+            return self._in_database(kind, value)
+
+        h = value_hash(value)
+        with self.lock:
+            names = self.sets[kind]
+            if not names.might_contain(h):
+                metrics.inc("warbler_availability_checks_total", (("answer", "filter"),))
+                return False
+            metrics.inc("warbler_availability_checks_total", (("answer", "index"),))
+            return h in names
+
+    def taken(self, kind, value):
+        """Whether `value` is taken, confirming a "taken" against the database."""
+
+        return self.is_taken(kind, value) and self._in_database(kind, value)
+
+    def _in_database(self, kind, value):
+        column = getattr(User, kind)
+        return db.session.query(db.session.query(User.id).filter(column == value)
+                                .exists()).scalar()
+
+    def add(self, user):
+        """Record a new user's username and email."""
+
+        if self.sets is None:
+            return
+        with self.lock:
+            for kind in KINDS:
+                self.sets[kind].add(value_hash(getattr(user, kind)))
+            self.max_id = max(self.max_id, user.id)
+
+    def rename(self, user, old_username, old_email):
+        """Record a change to `user`'s username or email."""
+
+        if self.sets is None:
+            return
+        with self.lock:
+            for kind, old in (("username", old_username), ("email", old_email)):
+                if old != getattr(user, kind):
+                    self.sets[kind].remove(value_hash(old))
+                    self.sets[kind].add(value_hash(getattr(user, kind)))
+
+    def remove(self, username, email):
+        """Free a purged user's username and email."""
+
+        if self.sets is None:
+            return
+        with self.lock:
+            self.sets["username"].remove(value_hash(username))
+            self.sets["email"].remove(value_hash(email))
+
+    def build(self):
+        """Load every username and email, streaming `users` a chunk at a time."""
+
+        hashes = {kind: [] for kind in KINDS}
+        max_id = 0
+        query = (db.session
+                 .query(User.id, User.username, User.email)
+                 .yield_per(BUILD_CHUNK))
+        for id, username, email in query:
+            hashes["username"].append(value_hash(username))
+            hashes["email"].append(value_hash(email))
+            max_id = max(max_id, id)
+
+        sets = {kind: NameSet(hashes[kind]) for kind in KINDS}
+        with self.lock:
+            self.sets, self.max_id = sets, max_id
+            self.built_at = time.monotonic()
+
+        log.info("Availability sets built: %d users", len(sets["username"]))
+
+    def refresh(self):
+        """Add users who signed up (in any worker) since the last build or refresh."""
+
+        new = (db.session
+               .query(User.id, User.username, User.email)
+               .filter(User.id > self.max_id)
+               .all())
+        for user in new:
+            self.add(user)
+
+    def _start(self):
+        """Start keeping the sets current, once per process."""
+
+        if self.refresh_interval is None or self.pid == os.getpid():
+            return
+
+        with self.lock:
+            # A thread inherited across a fork didn't come with it
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+
+        threading.Thread(target=self._run, args=(current_app._get_current_object(),),
+                         name="availability", daemon=True).start()
+
+    def _run(self, app):
+        while True:
+            time.sleep(self.refresh_interval)
+
+            try:
+                with app.app_context():
+                    if (self.sets is None
+                            or time.monotonic() - self.built_at > self.rebuild_interval):
+                        self.build()
+                    else:
+                        self.refresh()
+            except Exception:
+                log.exception("Couldn't update the availability sets; will retry")
+
+
+@purge_hook("user")
+def free_names(user_id, ids):
+    availability = current_app.extensions.get('availability')
+    user = User.query.get(user_id)
+    if availability is not None and user is not None:
+        availability.remove(user.username, user.email)
@@ -0,0 +1,659 @@
+"""Benchmark every Warbler route at several data sizes.
+
+Seed a synthetic dataset, then time every route in the app, either through
+the Flask test client or through a real server with concurrent clients:
+WSGI (`--mode server`) or the ASGI app of asgi.py under uvicorn (`--mode
+asgi`). Results are written as JSON so runs can be compared across
+commits, or the two servers compared on the same routes.
+
+    python benchmark.py seed --scale 100k
+    python benchmark.py run --scale 100k --mode server --concurrency 8 \\
+        --out bench_results/after.json
+    python benchmark.py run --scale 100k --mode asgi --concurrency 64 \\
+        --route warbler.homepage --route warbler.users_show \\
+        --out bench_results/asgi.json
+    python benchmark.py compare bench_results/before.json \\
+        bench_results/after.json --threshold 0.10
+    python benchmark.py graph --users 1000000 --edges 10000000 --workers 2
+
+Set DATABASE_URL to choose the database (default: warbler-bench) and
+WARBLER_ENV to choose the config profile (default: production).
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+from flask import current_app
+from sqlalchemy import func
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-bench")
+
+from app import create_app, bp, CURR_USER_KEY
+from models import db, bcrypt, User, Message, Follows, Likes, MessageStats
+import hot_messages
+import images
+import tagging
+import trending
+
+# Benchmark what production runs (WARBLER_ENV picks another profile), but
+# without rate limits, which would turn most writes into 429s
+PROFILE = os.environ.get('WARBLER_ENV', "production")
+OVERRIDES = {'WTF_CSRF_ENABLED': False, 'RATE_LIMITS': {},
+             'SECRET_KEY': os.environ.get('SECRET_KEY', "benchmark")}
+app = create_app(PROFILE, OVERRIDES)
+
+SCALES = {
+    "1k": dict(users=100, messages=1_000, follows=1_000, likes=2_000),
+    "100k": dict(users=5_000, messages=100_000, follows=100_000, likes=200_000),
+    "1m": dict(users=50_000, messages=1_000_000, follows=1_000_000, likes=2_000_000),
+}
+
+# Rows per bulk insert while seeding
+CHUNK = 10_000
+
+BENCH_USERNAME = "bench-user"
+BENCH_PASSWORD = "bench-password"
+
+# Routes served by extensions rather than app.py
+IGNORED_ENDPOINTS = {"static"}
+
+WORDS = ("warble song tweet chirp nest feather flock branch morning sky "
+         "seed wing call dawn tree river cloud sun rain wind").split()
+
+
+##############################################################################
+# Seeding
+
+
+def _chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _insert(model, rows):
+    for chunk in _chunks(rows):
+        db.session.bulk_insert_mappings(model, chunk)
+        db.session.commit()
+
+
+def seed(scale, rng=None):
+    """Drop and recreate the schema, then fill it with a synthetic dataset."""
+
+    rng = rng or random.Random(42)
+    sizes = SCALES[scale]
+    n_users = sizes["users"]
+
+    db.drop_all()
+    db.create_all()
+
+    # Hashing once at the lowest cost keeps seeding fast; it still checks
+    password = bcrypt.generate_password_hash(BENCH_PASSWORD, 4).decode('UTF-8')
+
+    _insert(User, ({"id": i,
+                    "username": BENCH_USERNAME if i == 1 else f"user{i}",
+                    "email": f"user{i}@warbler-bench.com",
+                    "password": password}
+                   for i in range(1, n_users + 1)))
+
+    start = datetime.utcnow() - timedelta(days=365)
+    _insert(Message, ({"id": i,
+                       "text": _text(rng),
+                       "timestamp": start + timedelta(seconds=rng.randrange(365 * 86400)),
+                       "user_id": rng.randint(1, n_users)}
+                      for i in range(1, sizes["messages"] + 1)))
+
+    def unique_pairs(count, high_a, high_b, first=()):
+        seen = set(first)
+        yield from first
+        while len(seen) < count:
+            pair = (rng.randint(1, high_a), rng.randint(1, high_b))
+            if pair[0] != pair[1] and pair not in seen:
+                seen.add(pair)
+                yield pair
+
+    # The bench user follows 1% of everyone, so their timeline has content
+    bench_follows = [(1, i) for i in range(2, max(3, n_users // 100) + 2)]
+    _insert(Follows, ({"user_following_id": a, "user_being_followed_id": b}
+                      for a, b in unique_pairs(sizes["follows"], n_users, n_users,
+                                               bench_follows)))
+
+    # Likes from the last week, so some messages are trending
+    now = datetime.utcnow()
+    _insert(Likes, ({"user_id": u, "message_id": m,
+                     "timestamp": now - timedelta(seconds=rng.randrange(7 * 86400))}
+                    for u, m in unique_pairs(sizes["likes"], n_users,
+                                             sizes["messages"])))
+
+    db.session.execute(MessageStats.__table__.insert().from_select(
+        ["message_id", "likes"],
+        db.session.query(Likes.message_id, func.count(Likes.id)).group_by(Likes.message_id)))
+    db.session.commit()
+
+    _reset_sequences()
+    trending.rebuild()
+    tagging.backfill(CHUNK)
+    hot_messages.rebuild()
+    app.extensions['availability'].build()
+
+
+def _text(rng):
+    """Twelve words; about one message in four has a hashtag."""
+
+    words = [rng.choice(WORDS) for _ in range(12)]
+    if rng.random() < 0.25:
+        words[rng.randrange(12)] = "#" + rng.choice(WORDS)
+    return " ".join(words)
+
+
+def _reset_sequences():
+    """Point Postgres id sequences past the explicitly inserted ids."""
+
+    if db.engine.dialect.name != "postgresql":
+        return
+
+    for table in ("users", "messages", "likes"):
+        db.session.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"(SELECT COALESCE(MAX(id), 1) FROM {table}))")
+    db.session.commit()
+
+
+##############################################################################
+# Requests for each route
+
+
+class Context:
+    """Ids and helpers shared by the request builders."""
+
+    def __init__(self, rng):
+        # The app whose requests are built, for its SECRET_KEY
+        self.app = current_app._get_current_object()
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.bench_user_id = User.query.filter_by(username=BENCH_USERNAME).one().id
+        self.max_user_id = db.session.query(db.func.max(User.id)).scalar()
+        self.max_message_id = db.session.query(db.func.max(Message.id)).scalar()
+        self.followed_ids = [u.id for u in User.query.get(self.bench_user_id).following]
+        self.counter = 0
+
+    def user_id(self):
+        return self.rng.randint(1, self.max_user_id)
+
+    def message_id(self):
+        return self.rng.randint(1, self.max_message_id)
+
+    def unique(self):
+        with self.lock:
+            self.counter += 1
+            return f"{os.getpid()}-{self.counter}"
+
+    def cookie(self, user_id=None):
+        """A session cookie logging in as `user_id` (the bench user by default)."""
+
+        serializer = self.app.session_interface.get_signing_serializer(self.app)
+        value = serializer.dumps({CURR_USER_KEY: user_id or self.bench_user_id})
+        return f"{self.app.session_cookie_name}={value}"
+
+
+def _new_user(ctx):
+    user = User(username=f"tmp-{ctx.unique()}", email=f"tmp-{ctx.unique()}@warbler-bench.com",
+                password="x")
+    db.session.add(user)
+    db.session.commit()
+    return user.id
+
+
+def _new_message(ctx):
+    msg = Message(text="to be deleted", user_id=ctx.bench_user_id)
+    db.session.add(msg)
+    db.session.commit()
+    return msg.id
+
+
+def _set_follow(ctx, followed_id, following):
+    Follows.query.filter_by(user_following_id=ctx.bench_user_id,
+                            user_being_followed_id=followed_id).delete()
+    if following:
+        db.session.add(Follows(user_following_id=ctx.bench_user_id,
+                               user_being_followed_id=followed_id))
+    db.session.commit()
+
+
+def _follow_target(ctx, following):
+    followed_id = ctx.user_id()
+    while followed_id == ctx.bench_user_id or followed_id in ctx.followed_ids:
+        followed_id = ctx.user_id()
+    _set_follow(ctx, followed_id, following)
+    return followed_id
+
+
+# Endpoints that need setup, a body or a particular user. Each builder gets
+# the Context and returns (method, path, form data, cookie); any setup runs
+# before the clock starts.
+BUILDERS = {
+    f"{bp.name}.signup": lambda ctx: ("POST", "/signup", {
+        "username": f"new-{ctx.unique()}",
+        "email": f"new-{ctx.unique()}@warbler-bench.com",
+        "password": BENCH_PASSWORD}, None),
+    f"{bp.name}.login": lambda ctx: ("POST", "/login", {
+        "username": BENCH_USERNAME, "password": BENCH_PASSWORD}, None),
+    f"{bp.name}.add_follow": lambda ctx: (
+        "POST", f"/users/follow/{_follow_target(ctx, False)}", None, ctx.cookie()),
+    f"{bp.name}.stop_following": lambda ctx: (
+        "POST", f"/users/stop-following/{_follow_target(ctx, True)}", None, ctx.cookie()),
+    f"{bp.name}.profile": lambda ctx: ("POST", "/users/profile", {
+        "username": BENCH_USERNAME,
+        "email": "user1@warbler-bench.com",
+        "password": BENCH_PASSWORD,
+        "image_url": "",
+        "header_image_url": ""}, ctx.cookie()),
+    f"{bp.name}.delete_user": lambda ctx: ("POST", "/users/delete", None, ctx.cookie(_new_user(ctx))),
+    f"{bp.name}.messages_add": lambda ctx: ("POST", "/messages/new", {"text": "benchmarking #warble"},
+                                 ctx.cookie()),
+    f"{bp.name}.messages_destroy": lambda ctx: (
+        "POST", f"/messages/{_new_message(ctx)}/delete", None, ctx.cookie()),
+    f"{bp.name}.list_users": lambda ctx: ("GET", "/users?q=user1", None, ctx.cookie()),
+    f"{bp.name}.api_users": lambda ctx: ("GET", "/api/users?q=user1", None, ctx.cookie()),
+    f"{bp.name}.users_available": lambda ctx: (
+        "GET", f"/users/available?username=user{ctx.user_id()}", None, None),
+    f"{bp.name}.image_proxy": lambda ctx: (
+        "GET", f"/images/thumb/{images.sign(ctx.app.config['SECRET_KEY'], images.DEFAULT_IMAGE)}?"
+               + urlencode({"url": images.DEFAULT_IMAGE}), None, None),
+}
+
+# How to fill in URL arguments for everything else
+URL_ARGS = {
+    "user_id": Context.user_id,
+    "userId": Context.user_id,
+    "follow_id": Context.user_id,
+    "message_id": Context.message_id,
+    "msgId": Context.message_id,
+    "tag": lambda ctx: ctx.rng.choice(WORDS),
+}
+
+
+def route_builders():
+    """Map every endpoint in the app to a request builder.
+
+    Raises if a route has an argument we don't know how to fill in, so new
+    routes can't silently drop out of the benchmark.
+    """
+
+    builders = {}
+
+    for rule in app.url_map.iter_rules():
+        endpoint = rule.endpoint
+        if endpoint in IGNORED_ENDPOINTS or endpoint.startswith("_debug_toolbar"):
+            continue
+
+        if endpoint in BUILDERS:
+            builders[endpoint] = BUILDERS[endpoint]
+            continue
+
+        unknown = set(rule.arguments) - set(URL_ARGS)
+        if unknown:
+            raise LookupError(f"Don't know how to benchmark {rule.rule}: "
+                              f"add it to BUILDERS")
+
+        method = "POST" if "POST" in rule.methods and "GET" not in rule.methods else "GET"
+
+        def build(ctx, rule=rule, method=method):
+            values = {arg: URL_ARGS[arg](ctx) for arg in rule.arguments}
+            path = rule.rule
+            for arg, value in values.items():
+                path = path.replace(f"<{arg}>", str(value)).replace(f"<int:{arg}>", str(value))
+            return method, path, None, ctx.cookie()
+
+        builders[endpoint] = build
+
+    return builders
+
+
+##############################################################################
+# Running requests
+
+
+class ClientTransport:
+    """Send requests through the Flask test client."""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def send(self, method, path, data, cookie):
+        if not hasattr(self.local, "client"):
+            # Each request carries its own session cookie
+            self.local.client = app.test_client(use_cookies=False)
+
+        headers = {"Cookie": cookie} if cookie else {}
+        resp = self.local.client.open(path, method=method, data=data, headers=headers)
+        return resp.status_code
+
+
+class ServerTransport:
+    """Send requests over HTTP to a threaded WSGI server in this process."""
+
+    def __init__(self, wsgi_app=None, host="127.0.0.1"):
+        from werkzeug.serving import make_server
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        self.server = make_server(host, 0, wsgi_app or app, threaded=True)
+        self.host, self.port = self.server.server_address[:2]
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+
+    def send(self, method, path, data, cookie):
+        headers = {"Cookie": cookie} if cookie else {}
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            return resp.status
+        finally:
+            conn.close()
+
+
+class AsgiServerTransport(ServerTransport):
+    """Send requests over HTTP to uvicorn serving asgi.py, in this process."""
+
+    def __init__(self, asgi_app, host="127.0.0.1"):
+        import socket
+        import uvicorn
+
+        self.socket = socket.socket()
+        self.socket.bind((host, 0))
+        self.host, self.port = self.socket.getsockname()[:2]
+        self.server = uvicorn.Server(uvicorn.Config(asgi_app, log_level="error"))
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.run,
+                                       kwargs={"sockets": [self.socket]}, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    """Throughput and latency percentiles (ms) for one route."""
+
+    latencies = sorted(latencies)
+    ms = lambda s: None if s is None else round(s * 1000, 3)
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+    }
+
+
+def bench_route(transport, build, ctx, requests, concurrency):
+    """Send `requests` requests from `concurrency` threads; summarize them."""
+
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    remaining = iter(range(requests))
+
+    def worker():
+        nonlocal errors
+        while True:
+            # Setup gets its own app context, so the test client's
+            # requests don't share its DB session
+            with lock, app.app_context():
+                if next(remaining, None) is None:
+                    return
+                method, path, data, cookie = build(ctx)
+
+            started = time.perf_counter()
+            try:
+                status = transport.send(method, path, data, cookie)
+            except OSError:
+                status = 599
+            took = time.perf_counter() - started
+
+            with lock:
+                latencies.append(took)
+                if status >= 500:
+                    errors += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scale, mode="client", requests=200, concurrency=1, only=None, warmup=5):
+    """Benchmark every route and return the results as a dict."""
+
+    builders = route_builders()
+    if only:
+        builders = {name: builders[name] for name in only}
+
+    app.config['ADMIN_USERNAMES'] = set(app.config['ADMIN_USERNAMES']) | {BENCH_USERNAME}
+    if mode == "asgi":
+        # Only needed to serve the ASGI app
+        from asgi import create_asgi_app
+        transport = AsgiServerTransport(create_asgi_app(
+            PROFILE, dict(OVERRIDES, ADMIN_USERNAMES=app.config['ADMIN_USERNAMES'])))
+    elif mode == "server":
+        transport = ServerTransport()
+    else:
+        transport = ClientTransport()
+
+    with app.app_context():
+        ctx = Context(random.Random(7))
+        database = db.engine.dialect.name
+
+    results = {}
+    with transport:
+        for name, build in sorted(builders.items()):
+            bench_route(transport, build, ctx, warmup, 1)
+            results[name] = bench_route(transport, build, ctx, requests, concurrency)
+            print(f"{name:32} {results[name]['throughput_rps']:>9} rps  "
+                  f"p50 {results[name]['p50_ms']:>8} ms  "
+                  f"p95 {results[name]['p95_ms']:>8} ms  "
+                  f"p99 {results[name]['p99_ms']:>8} ms", file=sys.stderr)
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "scale": scale,
+            "mode": mode,
+            "requests": requests,
+            "concurrency": concurrency,
+            "database": database,
+            "python": sys.version.split()[0],
+            "created_at": datetime.utcnow().isoformat(),
+        },
+        "routes": results,
+    }
+
+
+##############################################################################
+# Comparing runs
+
+
+def compare(before, after, threshold=0.10):
+    """List routes that got slower than `threshold` (a fraction) between runs.
+
+    A route regresses if its p95 latency grew, or its throughput fell, by
+    more than the threshold. A route that had numbers before and has none
+    now (no request succeeded) is reported with None; one that had none
+    before has nothing to compare with and is skipped.
+    """
+
+    regressions = []
+
+    for name, new in after["routes"].items():
+        old = before["routes"].get(name)
+        if not old:
+            continue
+
+        if old["p95_ms"] and (new["p95_ms"] is None
+                              or new["p95_ms"] > old["p95_ms"] * (1 + threshold)):
+            regressions.append((name, "p95_ms", old["p95_ms"], new["p95_ms"]))
+
+        if old["throughput_rps"] and (new["throughput_rps"] is None
+                                      or new["throughput_rps"] < old["throughput_rps"] * (1 - threshold)):
+            regressions.append((name, "throughput_rps",
+                                old["throughput_rps"], new["throughput_rps"]))
+
+    return regressions
+
+
+##############################################################################
+# Graph analytics
+
+
+def graph(n_users, n_edges, workers, seed=0):
+    """Time the follow-graph metrics on a random graph; no database needed."""
+
+    # NumPy and SciPy are only needed for graph analytics
+    import numpy as np
+    import graph_stats
+
+    rng = np.random.default_rng(seed)
+    followers = rng.integers(1, n_users + 1, n_edges)
+    followed = rng.integers(1, n_users + 1, n_edges)
+
+    keys = np.unique(followers * (n_users + 1) + followed)
+    followers, followed = np.divmod(keys, n_users + 1)
+    keep = followers != followed
+    followers, followed = followers[keep], followed[keep]
+
+    started = time.perf_counter()
+    user_ids, _ = graph_stats.compute(followers, followed, workers)
+    seconds = time.perf_counter() - started
+
+    peak_mb, peak_worker_mb = graph_stats.peak_memory_mb()
+    return {"users": len(user_ids), "edges": len(followers), "workers": workers,
+            "compute_seconds": round(seconds, 2), "peak_mb": round(peak_mb),
+            "peak_worker_mb": round(peak_worker_mb)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_cmd = commands.add_parser("seed", help="Load a synthetic dataset.")
+    seed_cmd.add_argument("--scale", choices=SCALES, default="1k")
+
+    run_cmd = commands.add_parser("run", help="Benchmark every route.")
+    run_cmd.add_argument("--scale", choices=SCALES, default="1k",
+                         help="Label for the dataset that was seeded.")
+    run_cmd.add_argument("--mode", choices=("client", "server", "asgi"), default="client")
+    run_cmd.add_argument("--requests", type=int, default=200)
+    run_cmd.add_argument("--concurrency", type=int, default=1)
+    run_cmd.add_argument("--route", action="append", dest="only",
+                         help="Only this endpoint (repeatable).")
+    run_cmd.add_argument("--out", help="Write results JSON here.")
+
+    compare_cmd = commands.add_parser("compare", help="Check for regressions.")
+    compare_cmd.add_argument("before")
+    compare_cmd.add_argument("after")
+    compare_cmd.add_argument("--threshold", type=float, default=0.10)
+
+    graph_cmd = commands.add_parser("graph", help="Time follow-graph analytics.")
+    graph_cmd.add_argument("--users", type=int, default=100_000)
+    graph_cmd.add_argument("--edges", type=int, default=1_000_000)
+    graph_cmd.add_argument("--workers", type=int, default=1)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "seed":
+        with app.app_context():
+            seed(args.scale)
+        return 0
+
+    if args.command == "graph":
+        print(json.dumps(graph(args.users, args.edges, args.workers), indent=2))
+        return 0
+
+    if args.command == "run":
+        results = run(args.scale, args.mode, args.requests, args.concurrency, args.only)
+        output = json.dumps(results, indent=2)
+        if args.out:
+            os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+            with open(args.out, "w") as f:
+                f.write(output)
+        else:
+            print(output)
+        return 0
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    regressions = compare(before, after, args.threshold)
+    for name, metric, old, new in regressions:
+        print(f"REGRESSION {name}: {metric} {old} -> {new}")
+    if not regressions:
+        print("No regressions.")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
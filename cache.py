@@ -0,0 +1,683 @@
+"""A cache with interchangeable backends, shareable across worker processes.
+
+Pick a backend with CACHE_URL:
+
+    memory://?max_bytes=67108864          in-process LRU (one copy per worker)
+    shm:///tmp/warbler-cache?size=...     memory-mapped file shared by every
+                                          worker on the host
+    redis://[:password@]host:6379/0       any server speaking the Redis protocol
+
+Every backend supports get/set/add/get_many/set_many/delete with TTLs (in
+seconds), tag-based invalidation and stampede protection:
+
+    cache = current_app.extensions['cache']
+    cache.set("user:1", snapshot, ttl=300, tags=["user:1"])
+    cache.invalidate_tags(["user:1"])
+
+    # Only one caller (in any process) computes a missing key; the rest
+    # wait for its result
+    value = cache.get_or_set("trending", compute_trending, ttl=60)
+
+Tags are versioned: each tag has a version stored in the cache, entries
+remember the versions of their tags when written, and invalidating a tag
+gives it a new version, so stale entries are recognised on read without
+having to find them. Values are pickled; only cache trusted data.
+
+Counters (`incr()`, read with `get_counts()`) are stored as plain
+integers and changed atomically, which is what rate limiting needs.
+
+`cache.namespace("users")` returns a view of the same backend whose keys
+and tags are prefixed with "users:" and whose lookups are reported under
+that name in `warbler_cache_requests_total`.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import socket
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from metrics import metrics
+
+MISSING = object()
+
+
+class CacheError(Exception):
+    """The cache backend couldn't be used."""
+
+
+class Cache:
+    """Serialization, tags and stampede protection over a byte store.
+
+    Subclasses implement `_get_many`, `_set`, `_add`, `_delete_many` and
+    `_incr`.
+    """
+
+    name = "cache"
+
+    ##########################################################################
+    # Backend primitives
+
+    def _get_many(self, keys):
+        """Return {key: bytes} for the keys that are present."""
+
+        raise NotImplementedError
+
+    def _set(self, key, data, ttl):
+        raise NotImplementedError
+
+    def _add(self, key, data, ttl):
+        """Store `data` only if `key` is absent; return whether it was stored."""
+
+        raise NotImplementedError
+
+    def _delete_many(self, keys):
+        raise NotImplementedError
+
+    def _incr(self, key, amount, ttl):
+        """Add `amount` to the counter at `key` and return the new value.
+
+        A missing counter starts at 0 and expires `ttl` seconds after it
+        was created.
+        """
+
+        raise NotImplementedError
+
+    ##########################################################################
+    # Public API
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        """Return {key: value} for the keys that are cached and current."""
+
+        keys = list(keys)
+        found = self._lookup(keys)
+
+        for key in keys:
+            metrics.cache_lookup(self.name, key in found)
+
+        return found
+
+    def set(self, key, value, ttl=None, tags=()):
+        self.set_many({key: value}, ttl=ttl, tags=tags)
+
+    def set_many(self, mapping, ttl=None, tags=()):
+        """Store every value in `mapping`, each with the same TTL and tags."""
+
+        versions = self._tag_versions(tags)
+        for key, value in mapping.items():
+            self._set(key, pickle.dumps((value, versions), pickle.HIGHEST_PROTOCOL), ttl)
+
+    def add(self, key, value, ttl=None):
+        """Store `value` only if `key` is absent; return whether it was stored."""
+
+        return self._add(key, pickle.dumps((value, ()), pickle.HIGHEST_PROTOCOL), ttl)
+
+    def delete(self, key):
+        self._delete_many([key])
+
+    def delete_many(self, keys):
+        self._delete_many(list(keys))
+
+    def invalidate_tags(self, tags):
+        """Make every entry stored with any of `tags` stale."""
+
+        for tag in tags:
+            self._set(f"tag:{tag}", _new_version(), None)
+
+    def get_or_set(self, key, compute, ttl=None, tags=(), lock_timeout=10, poll=0.05):
+        """Return the cached value for `key`, computing it once on a miss.
+
+        The first caller to miss takes a lock key and runs `compute()`;
+        others poll for its result for up to `lock_timeout` seconds before
+        computing it themselves.
+        """
+
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            return value
+
+        lock_key = f"lock:{key}"
+        if self._add(lock_key, b"1", lock_timeout):
+            try:
+                value = compute()
+                self.set(key, value, ttl=ttl, tags=tags)
+                return value
+            finally:
+                self._delete_many([lock_key])
+
+        deadline = time.monotonic() + lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(poll)
+            value = self._lookup([key]).get(key, MISSING)
+            if value is not MISSING:
+                return value
+
+        # Whoever held the lock died or is too slow
+        value = compute()
+        self.set(key, value, ttl=ttl, tags=tags)
+        return value
+
+    def incr(self, key, amount=1, ttl=None):
+        """Atomically add `amount` to a counter; return its new value."""
+
+        return self._incr(key, amount, ttl)
+
+    def get_counts(self, keys):
+        """Return {key: value} for the counters that exist."""
+
+        return {key: int(data) for key, data in self._get_many(list(keys)).items()}
+
+    def namespace(self, name):
+        return Namespace(self, name)
+
+    ##########################################################################
+    # Helpers
+
+    def _lookup(self, keys):
+        """Unpickle the entries for `keys`, dropping those with stale tags."""
+
+        entries = {key: pickle.loads(data) for key, data in self._get_many(keys).items()}
+
+        tags = {tag for _, versions in entries.values() for tag, _ in versions}
+        current = self._current_versions(tags)
+
+        return {key: value
+                for key, (value, versions) in entries.items()
+                if all(current.get(tag, MISSING) == version for tag, version in versions)}
+
+    def _current_versions(self, tags):
+        tags = list(tags)
+        if not tags:
+            return {}
+
+        found = self._get_many([f"tag:{tag}" for tag in tags])
+        return {tag: found[f"tag:{tag}"] for tag in tags if f"tag:{tag}" in found}
+
+    def _tag_versions(self, tags):
+        """The current version of each tag, creating any that are missing."""
+
+        current = self._current_versions(tags)
+
+        for tag in tags:
+            if tag not in current:
+                # If another writer creates it first, use theirs
+                self._add(f"tag:{tag}", _new_version(), None)
+                current[tag] = self._get_many([f"tag:{tag}"]).get(f"tag:{tag}")
+
+        return tuple(sorted(current.items()))
+
+
+def _new_version():
+    return uuid.uuid4().bytes
+
+
+class Namespace(Cache):
+    """A view of another cache with its keys and tags prefixed by `name`."""
+
+    def __init__(self, parent, name):
+        self.parent = parent
+        self.name = name
+        self.prefix = f"{name}:"
+
+    def _get_many(self, keys):
+        found = self.parent._get_many([self.prefix + key for key in keys])
+        return {key[len(self.prefix):]: data for key, data in found.items()}
+
+    def _set(self, key, data, ttl):
+        self.parent._set(self.prefix + key, data, ttl)
+
+    def _add(self, key, data, ttl):
+        return self.parent._add(self.prefix + key, data, ttl)
+
+    def _delete_many(self, keys):
+        self.parent._delete_many([self.prefix + key for key in keys])
+
+    def _incr(self, key, amount, ttl):
+        return self.parent._incr(self.prefix + key, amount, ttl)
+
+
+##############################################################################
+# In-process LRU
+
+
+class LocalCache(Cache):
+    """An LRU in this process, evicting once entries exceed `max_bytes`."""
+
+    name = "local"
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get_many(self, keys):
+        now = time.monotonic()
+        found = {}
+
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+
+                data, expires = entry
+                if expires is not None and expires <= now:
+                    self._remove(key)
+                    continue
+
+                self.entries.move_to_end(key)
+                found[key] = data
+
+        return found
+
+    def _set(self, key, data, ttl):
+        with self.lock:
+            self._store(key, data, ttl)
+
+    def _add(self, key, data, ttl):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                return False
+
+            self._store(key, data, ttl)
+            return True
+
+    def _delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self._remove(key)
+
+    def _incr(self, key, amount, ttl):
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                data, expires = entry
+                value = int(data) + amount
+                ttl = expires - now if expires is not None else None
+            else:
+                value = amount
+
+            self._store(key, b"%d" % value, ttl)
+            return value
+
+    def _store(self, key, data, ttl):
+        if key in self.entries:
+            self._remove(key)
+
+        # Too big to ever fit
+        if len(key) + len(data) > self.max_bytes:
+            return
+
+        expires = time.monotonic() + ttl if ttl is not None else None
+        self.entries[key] = (data, expires)
+        self.size += len(key) + len(data)
+
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        data, _ = self.entries.pop(key)
+        self.size -= len(key) + len(data)
+
+
+##############################################################################
+# Shared memory
+
+
+class SharedMemoryCache(Cache):
+    """A fixed-size hash table in a memory-mapped file.
+
+    Every process that opens the same `path` shares the entries. The file
+    holds a header followed by sets of `ways` fixed-size slots; a key may
+    live in any slot of the set its hash picks. Writing to a full set
+    replaces its expired or oldest entry. Entries bigger than a slot are
+    not cached.
+
+    Each set is guarded by an fcntl lock on its byte range (between
+    processes) and by a thread lock (within this one).
+    """
+
+    name = "shm"
+
+    MAGIC = b"WBLC0001"
+    FILE_HEADER = struct.Struct("<8sIII")     # magic, slot size, ways, sets
+    SLOT_HEADER = struct.Struct("<QddHI")     # hash, expires, written, key len, data len
+
+    def __init__(self, path, size=64 * 1024 * 1024, slot_size=4096, ways=8):
+        self.path = path
+        self.slot_size = slot_size
+        self.ways = ways
+        self.sets = max(1, size // (slot_size * ways))
+        self.set_bytes = slot_size * ways
+        self.length = self.FILE_HEADER.size + self.sets * self.set_bytes
+        self.lock = threading.Lock()
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            expected = self.FILE_HEADER.pack(self.MAGIC, slot_size, ways, self.sets)
+            current = os.pread(self.fd, self.FILE_HEADER.size, 0)
+
+            if current != expected or os.fstat(self.fd).st_size != self.length:
+                # New file, or one laid out differently: start empty
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, self.length)
+                os.pwrite(self.fd, expected, 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+        self.map = mmap.mmap(self.fd, self.length)
+
+    def _get_many(self, keys):
+        now = time.time()
+        found = {}
+
+        for key in keys:
+            encoded = key.encode()
+            key_hash, offset = self._locate(encoded)
+
+            with self._locked(offset, fcntl.LOCK_SH):
+                slot = self._find(offset, key_hash, encoded, now)
+                if slot is not None:
+                    _, _, _, key_len, data_len = self.SLOT_HEADER.unpack_from(self.map, slot)
+                    start = slot + self.SLOT_HEADER.size + key_len
+                    found[key] = self.map[start:start + data_len]
+
+        return found
+
+    def _set(self, key, data, ttl):
+        self._write(key, data, ttl, only_if_absent=False)
+
+    def _add(self, key, data, ttl):
+        return self._write(key, data, ttl, only_if_absent=True)
+
+    def _delete_many(self, keys):
+        for key in keys:
+            encoded = key.encode()
+            key_hash, offset = self._locate(encoded)
+
+            with self._locked(offset, fcntl.LOCK_EX):
+                slot = self._find(offset, key_hash, encoded, time.time())
+                if slot is not None:
+                    self.SLOT_HEADER.pack_into(self.map, slot, 0, 0, 0, 0, 0)
+
+    def _incr(self, key, amount, ttl):
+        encoded = key.encode()
+        now = time.time()
+        key_hash, offset = self._locate(encoded)
+
+        with self._locked(offset, fcntl.LOCK_EX):
+            slot = self._find(offset, key_hash, encoded, now)
+
+            if slot is None:
+                slot = self._victim(offset, now)
+                value, expires = amount, now + ttl if ttl is not None else 0
+            else:
+                _, expires, _, key_len, data_len = self.SLOT_HEADER.unpack_from(self.map, slot)
+                start = slot + self.SLOT_HEADER.size + key_len
+                value = int(self.map[start:start + data_len]) + amount
+
+            data = b"%d" % value
+            self.SLOT_HEADER.pack_into(self.map, slot, key_hash, expires, now,
+                                       len(encoded), len(data))
+            start = slot + self.SLOT_HEADER.size
+            self.map[start:start + len(encoded) + len(data)] = encoded + data
+
+        return value
+
+    def _write(self, key, data, ttl, only_if_absent):
+        encoded = key.encode()
+        if self.SLOT_HEADER.size + len(encoded) + len(data) > self.slot_size:
+            return False
+
+        now = time.time()
+        key_hash, offset = self._locate(encoded)
+
+        with self._locked(offset, fcntl.LOCK_EX):
+            slot = self._find(offset, key_hash, encoded, now)
+
+            if slot is not None and only_if_absent:
+                return False
+
+            if slot is None:
+                slot = self._victim(offset, now)
+
+            expires = now + ttl if ttl is not None else 0
+            self.SLOT_HEADER.pack_into(self.map, slot, key_hash, expires, now,
+                                       len(encoded), len(data))
+            start = slot + self.SLOT_HEADER.size
+            self.map[start:start + len(encoded) + len(data)] = encoded + data
+
+        return True
+
+    def _locate(self, encoded):
+        """The key's hash and the offset of the set it belongs to."""
+
+        # Not hash(): that differs from process to process
+        key_hash = int.from_bytes(hashlib.blake2b(encoded, digest_size=8).digest(), "little")
+        key_hash = key_hash or 1                  # 0 marks an empty slot
+
+        return key_hash, self.FILE_HEADER.size + (key_hash % self.sets) * self.set_bytes
+
+    def _find(self, offset, key_hash, encoded, now):
+        """The offset of the live slot holding `encoded`, or None."""
+
+        for way in range(self.ways):
+            slot = offset + way * self.slot_size
+            slot_hash, expires, _, key_len, _ = self.SLOT_HEADER.unpack_from(self.map, slot)
+
+            if slot_hash != key_hash or (expires and expires <= now):
+                continue
+
+            start = slot + self.SLOT_HEADER.size
+            if self.map[start:start + key_len] == encoded:
+                return slot
+
+        return None
+
+    def _victim(self, offset, now):
+        """The slot to overwrite: empty or expired if possible, else oldest."""
+
+        oldest, oldest_written = None, None
+
+        for way in range(self.ways):
+            slot = offset + way * self.slot_size
+            slot_hash, expires, written, _, _ = self.SLOT_HEADER.unpack_from(self.map, slot)
+
+            if slot_hash == 0 or (expires and expires <= now):
+                return slot
+
+            if oldest is None or written < oldest_written:
+                oldest, oldest_written = slot, written
+
+        return oldest
+
+    @contextmanager
+    def _locked(self, offset, mode):
+        """Hold the thread lock and an fcntl lock on the set at `offset`."""
+
+        with self.lock:
+            fcntl.lockf(self.fd, mode, self.set_bytes, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, self.set_bytes, offset)
+
+
+##############################################################################
+# Redis protocol
+
+
+class RedisCache(Cache):
+    """A client for any server speaking RESP (Redis, KeyDB, Dragonfly...).
+
+    Each thread gets its own connection, opened on first use and reopened
+    after a fork, so pre-forked workers never share a socket.
+    """
+
+    name = "redis"
+
+    def __init__(self, host="localhost", port=6379, db=0, password=None, timeout=1.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def command(self, *args):
+        """Send one command and return its reply."""
+
+        conn = self._connection()
+        try:
+            conn.sendall(_encode(args))
+            return _read_reply(self.local.reader)
+        except (OSError, EOFError) as exc:
+            self._disconnect()
+            raise CacheError(f"redis {self.host}:{self.port}: {exc}") from exc
+
+    def _get_many(self, keys):
+        if not keys:
+            return {}
+
+        values = self.command("MGET", *keys)
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+    def _set(self, key, data, ttl):
+        if ttl is None:
+            self.command("SET", key, data)
+        else:
+            self.command("SET", key, data, "PX", _millis(ttl))
+
+    def _add(self, key, data, ttl):
+        if ttl is None:
+            return self.command("SET", key, data, "NX") is not None
+
+        return self.command("SET", key, data, "NX", "PX", _millis(ttl)) is not None
+
+    def _delete_many(self, keys):
+        if keys:
+            self.command("DEL", *keys)
+
+    def _incr(self, key, amount, ttl):
+        value = self.command("INCRBY", key, amount)
+
+        # We created it; a crash before this leaves a counter that never expires
+        if value == amount and ttl is not None:
+            self.command("PEXPIRE", key, _millis(ttl))
+
+        return value
+
+    def _connection(self):
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.local.pid = os.getpid()
+            self.local.sock = None
+
+        if self.local.sock is None:
+            try:
+                sock = socket.create_connection((self.host, self.port), self.timeout)
+            except OSError as exc:
+                raise CacheError(f"redis {self.host}:{self.port}: {exc}") from exc
+
+            self.local.sock = sock
+            self.local.reader = sock.makefile("rb")
+
+            if self.password:
+                self.command("AUTH", self.password)
+            if self.db:
+                self.command("SELECT", self.db)
+
+        return self.local.sock
+
+    def _disconnect(self):
+        if self.local.sock is not None:
+            self.local.sock.close()
+        self.local.sock = None
+
+
+def _millis(ttl):
+    return max(1, int(ttl * 1000))
+
+
+def _encode(args):
+    """A command as a RESP array of bulk strings."""
+
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+
+    return b"".join(parts)
+
+
+def _read_reply(reader):
+    line = reader.readline()
+    if not line:
+        raise EOFError("connection closed")
+
+    kind, rest = line[:1], line[1:-2]
+
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        raise CacheError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        count = int(rest)
+        if count < 0:
+            return None
+        return [_read_reply(reader) for _ in range(count)]
+
+    raise CacheError(f"unexpected reply {line!r}")
+
+
+##############################################################################
+# Configuration
+
+
+def make_cache(url):
+    """Build a cache from a CACHE_URL (see the module docstring)."""
+
+    parts = urlsplit(url)
+    params = {name: values[-1] for name, values in parse_qs(parts.query).items()}
+
+    if parts.scheme == "memory":
+        return LocalCache(**{name: int(value) for name, value in params.items()})
+
+    if parts.scheme == "shm":
+        return SharedMemoryCache(unquote(parts.path),
+                                 **{name: int(value) for name, value in params.items()})
+
+    if parts.scheme == "redis":
+        return RedisCache(host=parts.hostname or "localhost",
+                          port=parts.port or 6379,
+                          db=int(parts.path.strip("/") or 0),
+                          password=unquote(parts.password) if parts.password else None,
+                          timeout=float(params.get("timeout", 1.0)))
+
+    raise ValueError(f"unknown cache backend in {url!r}")
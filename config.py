@@ -0,0 +1,181 @@
+"""Configuration profiles for Warbler.
+
+Pick one with `create_app("production")` or the WARBLER_ENV environment
+variable. Settings that vary per deployment come from the environment;
+see `from_environ()`.
+"""
+
+import os
+import tempfile
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_DATABASE_URI = 'postgresql:///warbler'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SECRET_KEY = "it's a secret"
+
+    # Usernames allowed to see the admin pages
+    ADMIN_USERNAMES = set()
+
+    # Load the debug toolbar (development only)
+    DEBUG_TOOLBAR = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    # Cache compiled templates on disk, and compile them all at startup so
+    # pre-forked workers share them instead of compiling on first request
+    JINJA_BYTECODE_CACHE_DIR = None
+    PRECOMPILE_TEMPLATES = False
+
+    # Hard caps on any one profiler capture
+    PROFILER_MAX_DURATION = 300
+    PROFILER_MAX_SAMPLES = 100_000
+    PROFILER_MAX_OVERHEAD = 0.02
+
+    # Shared directory for metrics from every worker process, and an
+    # optional bearer token required to scrape /metrics
+    METRICS_DIR = None
+    METRICS_TOKEN = None
+
+    # Cache backend; see cache.py. Production shares one across workers
+    CACHE_URL = "memory://"
+
+    # Buffer like toggles and write them in batches; see like_buffer.py.
+    # The journal directory must be on local, persistent disk
+    LIKE_WRITE_BEHIND = False
+    LIKE_FLUSH_INTERVAL = 0.2
+    LIKE_FLUSH_MAX = 500
+    LIKE_JOURNAL_DIR = os.path.join(tempfile.gettempdir(), "warbler-likes")
+
+    # Resized copies of users' images; see images.py. The directory should
+    # be on local disk shared by the workers
+    IMAGE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "warbler-images")
+    IMAGE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+    IMAGE_FETCH_TIMEOUT = 5
+    IMAGE_MAX_SOURCE_BYTES = 10 * 1024 * 1024
+    IMAGE_ALLOW_PRIVATE_HOSTS = False
+
+    # How often each worker picks up other workers' signups, and rebuilds
+    # its username and email sets, from a background thread; see
+    # availability.py. A refresh interval of None turns the thread off
+    AVAILABILITY_REFRESH_INTERVAL = 5
+    AVAILABILITY_REBUILD_INTERVAL = 3600
+
+    # How long an outbox consumer waits for a missing event id to show up
+    # before moving past it, in seconds; see outbox.py
+    OUTBOX_GAP_GRACE = 10
+
+    # Database and connection pool for the async read path; see asgi.py.
+    # The URL defaults to SQLALCHEMY_DATABASE_URI without its driver
+    ASYNC_DATABASE_URL = None
+    ASYNC_DB_POOL_SIZE = 20
+
+    # Whole pages cached for visitors who aren't logged in; see page_cache.py.
+    # Endpoint: (seconds fresh, further seconds served stale while refreshed)
+    PAGE_CACHE_TTLS = {
+        "warbler.homepage": (60, 600),
+        "warbler.users_show": (10, 60),
+        "warbler.get_likes_page": (10, 60),
+        "warbler.messages_show": (30, 300),
+    }
+
+    # Reverse proxies (load balancers) in front of the app that add to
+    # X-Forwarded-For. The client address that "ip" limits count is the one
+    # the outermost of them saw; 0 means clients connect directly
+    TRUSTED_PROXIES = 0
+
+    # Per-endpoint limits on POSTs; see ratelimit.py
+    RATE_LIMITS = {
+        "warbler.signup": "ip 10/hour",
+        "warbler.login": "ip 20/minute",
+        "warbler.messages_add": "user 30/minute; ip 120/minute",
+        "warbler.add_remove_like": "user 120/minute; ip 600/minute",
+        "warbler.add_follow": "user 60/minute; ip 300/minute",
+    }
+
+    # Adaptive concurrency limit per worker process; see admission.py
+    ADMISSION_CONTROL = True
+    ADMISSION_INITIAL_LIMIT = 20
+    ADMISSION_MIN_LIMIT = 2
+    ADMISSION_MAX_LIMIT = 200
+    ADMISSION_TOLERANCE = 1.5
+    ADMISSION_PRIORITIES = {
+        "static": "critical",
+        "warbler.login": "critical",
+        "warbler.signup": "critical",
+        "warbler.logout": "critical",
+        "warbler.messages_add": "critical",
+        "warbler.metrics_page": "critical",
+        "warbler.list_users": "expensive",
+        "warbler.api_users": "expensive",
+        "warbler.export_user": "expensive",
+    }
+
+
+class DevelopmentConfig(Config):
+    DEBUG_TOOLBAR = True
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'postgresql:///warbler-test'
+    WTF_CSRF_ENABLED = False
+
+    # The cheapest bcrypt cost; hashing at the default cost of 12 would
+    # dominate the run time of the suite
+    BCRYPT_LOG_ROUNDS = 4
+
+    # A test's session is one connection, which a thread can't share
+    AVAILABILITY_REFRESH_INTERVAL = None
+
+
+class ProductionConfig(Config):
+    # Signs sessions and image proxy URLs, so it must not be the one above:
+    # set SECRET_KEY in the environment, or create_app() refuses to start
+    SECRET_KEY = None
+
+    JINJA_BYTECODE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "warbler-jinja")
+    PRECOMPILE_TEMPLATES = True
+    CACHE_URL = "shm://" + os.path.join(tempfile.gettempdir(), "warbler-cache")
+
+
+PROFILES = {
+    "development": DevelopmentConfig,
+    "testing": TestingConfig,
+    "production": ProductionConfig,
+}
+
+
+def from_environ(profile):
+    """Settings from environment variables, for the given profile name."""
+
+    env = os.environ
+    settings = {}
+
+    # Tests get their own variable, so a shell with DATABASE_URL set for
+    # development can't point the suite at real data
+    db_var = 'TEST_DATABASE_URL' if profile == "testing" else 'DATABASE_URL'
+    if env.get(db_var):
+        settings['SQLALCHEMY_DATABASE_URI'] = env[db_var]
+
+    for name in ('SECRET_KEY', 'METRICS_DIR', 'METRICS_TOKEN', 'JINJA_BYTECODE_CACHE_DIR',
+                 'CACHE_URL', 'LIKE_JOURNAL_DIR', 'IMAGE_CACHE_DIR',
+                 'ASYNC_DATABASE_URL'):
+        if env.get(name):
+            settings[name] = env[name]
+
+    if env.get('LIKE_WRITE_BEHIND'):
+        settings['LIKE_WRITE_BEHIND'] = env['LIKE_WRITE_BEHIND'].lower() in ('1', 'true', 'yes')
+
+    if env.get('TRUSTED_PROXIES'):
+        settings['TRUSTED_PROXIES'] = int(env['TRUSTED_PROXIES'])
+
+    if env.get('IMAGE_CACHE_MAX_BYTES'):
+        settings['IMAGE_CACHE_MAX_BYTES'] = int(env['IMAGE_CACHE_MAX_BYTES'])
+
+    if env.get('ADMIN_USERNAMES'):
+        settings['ADMIN_USERNAMES'] = set(filter(None, env['ADMIN_USERNAMES'].split(',')))
+
+    return settings
@@ -0,0 +1,163 @@
+"""Deleting user accounts.
+
+Deleting a busy account in one transaction cascades through thousands of
+messages, likes and follows and holds locks the whole time. Instead,
+`delete_account()` only marks the user as deleted (which hides them from
+every read) and queues a `purge_user` job. The job removes the user's
+rows a small batch at a time, one commit per batch, in this order:
+
+    likes           likes the user made
+    likes_received  likes on the user's messages
+    follows         follows to and from the user
+    messages        the user's messages
+    user            the user row itself
+
+Progress is recorded in `user_deletions`. Anything derived from these rows
+(counters, timelines, indexes) registers a `purge_hook` for the stage it
+cares about and is cleaned up in the same transaction as each batch.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import or_
+
+import jobs
+from models import db, User, Message, Likes, Follows, UserDeletion
+
+BATCH_SIZE = 500
+
+# After this many batches the job re-queues itself, so one huge account
+# can't hold a worker (or outlive its lease).
+BATCHES_PER_RUN = 20
+
+STAGES = ("likes", "likes_received", "follows", "messages", "user", "done")
+
+# stage -> functions called as fn(user_id, ids) before each batch is deleted
+PURGE_HOOKS = {stage: [] for stage in STAGES}
+
+
+def purge_hook(stage):
+    """Register a function to clean up derived data for a purge stage.
+
+    The function gets the user id and the ids about to be deleted: like
+    ids, message ids, ids of the other users in deleted follows, or
+    `[user_id]` for the "user" stage. It runs in the batch's transaction.
+    """
+
+    def register(fn):
+        PURGE_HOOKS[stage].append(fn)
+        return fn
+
+    return register
+
+
+def delete_account(user):
+    """Mark `user` as deleted and queue the purge of their rows.
+
+    The caller commits.
+    """
+
+    user.deleted_at = datetime.utcnow()
+
+    if not UserDeletion.query.get(user.id):
+        db.session.add(UserDeletion(user_id=user.id))
+
+    jobs.enqueue("purge_user", {"user_id": user.id},
+                 idempotency_key=f"purge_user:{user.id}")
+
+
+def _batch_ids(stage, user_id):
+    """Ids of the next batch of rows to delete for `stage`."""
+
+    if stage == "likes":
+        query = db.session.query(Likes.id).filter(Likes.user_id == user_id)
+
+    elif stage == "likes_received":
+        query = (db.session
+                 .query(Likes.id)
+                 .join(Message, Likes.message_id == Message.id)
+                 .filter(Message.user_id == user_id))
+
+    elif stage == "follows":
+        # Follows are keyed by user pairs, so use the other user's id
+        other_id = db.case(
+            [(Follows.user_following_id == user_id,
+              Follows.user_being_followed_id)],
+            else_=Follows.user_following_id)
+        query = (db.session
+                 .query(other_id)
+                 .filter(or_(Follows.user_following_id == user_id,
+                             Follows.user_being_followed_id == user_id)))
+
+    elif stage == "messages":
+        query = db.session.query(Message.id).filter(Message.user_id == user_id)
+
+    else:
+        query = db.session.query(User.id).filter(User.id == user_id)
+
+    return [row_id for (row_id,) in query.limit(BATCH_SIZE)]
+
+
+def _delete(stage, user_id, ids):
+    """Delete one batch of rows for `stage`; return how many went."""
+
+    if stage in ("likes", "likes_received"):
+        query = Likes.query.filter(Likes.id.in_(ids))
+
+    elif stage == "follows":
+        return (Follows.query
+                .filter(or_(
+                    db.and_(Follows.user_following_id == user_id,
+                            Follows.user_being_followed_id.in_(ids)),
+                    db.and_(Follows.user_being_followed_id == user_id,
+                            Follows.user_following_id.in_(ids))))
+                .delete(synchronize_session=False))
+
+    elif stage == "messages":
+        query = Message.query.filter(Message.id.in_(ids))
+
+    else:
+        query = User.query.filter(User.id.in_(ids))
+
+    return query.delete(synchronize_session=False)
+
+
+def purge_batch(progress):
+    """Delete the next batch of rows for this deletion and commit.
+
+    Moves on to the next stage when the current one has nothing left.
+    """
+
+    stage = progress.stage
+    ids = _batch_ids(stage, progress.user_id)
+
+    if ids:
+        for hook in PURGE_HOOKS[stage]:
+            hook(progress.user_id, ids)
+
+        progress.rows_deleted += _delete(stage, progress.user_id, ids)
+
+    if len(ids) < BATCH_SIZE:
+        progress.stage = STAGES[STAGES.index(stage) + 1]
+
+        if progress.stage == "done":
+            progress.finished_at = datetime.utcnow()
+
+    db.session.commit()
+
+
+@jobs.job("purge_user", max_attempts=10)
+def purge_user(user_id):
+    """Purge a deleted user's rows, a batch at a time."""
+
+    for _ in range(BATCHES_PER_RUN):
+        progress = UserDeletion.query.get(user_id)
+
+        if progress is None or progress.stage == "done":
+            return
+
+        purge_batch(progress)
+
+    if UserDeletion.query.get(user_id).stage != "done":
+        jobs.enqueue("purge_user", {"user_id": user_id})
+        db.session.commit()
@@ -0,0 +1,191 @@
+"""Streaming exports of a user's data, as NDJSON or CSV.
+
+An export is the user's profile, then their messages, likes, followers
+and the users they follow, one record per line. Each section is read in
+id order a chunk at a time (keyset pagination over plain column tuples),
+so memory stays flat however many rows there are. An export only reads,
+so the transaction is committed after each chunk is fetched, before its
+rows go out: no connection or cursor is held while a slow client
+catches up, and the next chunk carries on after the last key sent.
+
+Every record carries a `cursor`; pass the last one received to carry on
+after an interrupted download:
+
+    GET /users/export?format=csv&cursor=likes:81723
+
+or `flask export-user <username> --cursor likes:81723`.
+"""
+
+import csv
+import io
+import json
+import zlib
+
+from models import db, Follows, Likes, Message, User
+
+SECTIONS = ("profile", "messages", "likes", "followers", "following")
+FORMATS = ("ndjson", "csv")
+
+# Rows per query and bytes per write
+CHUNK = 1000
+BUFFER = 64 * 1024
+
+# CSV columns: every field of every section
+FIELDS = ("section", "cursor", "id", "username", "email", "bio", "location",
+          "image_url", "header_image_url", "timestamp", "text", "message_id")
+
+
+def parse_cursor(cursor):
+    """(section, id to continue after) for a cursor; ValueError if it isn't one."""
+
+    if not cursor:
+        return SECTIONS[0], None
+
+    section, _, after = cursor.partition(":")
+    if section not in SECTIONS:
+        raise ValueError(f"Unknown export section {section!r}")
+    return section, int(after)
+
+
+def records(user_id, cursor=None):
+    """Yield the user's records as dicts, starting after `cursor`."""
+
+    section, after = parse_cursor(cursor)
+
+    for name in SECTIONS[SECTIONS.index(section):]:
+        for key, record in _READERS[name](user_id, after):
+            yield dict(section=name, cursor=f"{name}:{key}", **record)
+        after = None
+
+
+def _profile(user_id, after):
+    if after is not None:
+        return
+
+    user = (db.session
+            .query(User.id, User.username, User.email, User.bio, User.location,
+                   User.image_url, User.header_image_url)
+            .filter(User.id == user_id)
+            .one())
+    db.session.commit()
+    yield 0, user._asdict()
+
+
+def _messages(user_id, after):
+    query = (db.session
+             .query(Message.id, Message.timestamp, Message.text)
+             .filter(Message.user_id == user_id))
+    for row in _keyset(query, Message.id, after):
+        yield row.id, dict(row._asdict(), timestamp=row.timestamp.isoformat())
+
+
+def _likes(user_id, after):
+    query = (db.session
+             .query(Likes.id, Likes.message_id, Likes.timestamp)
+             .filter(Likes.user_id == user_id))
+    for row in _keyset(query, Likes.id, after):
+        yield row.id, dict(row._asdict(), timestamp=row.timestamp.isoformat())
+
+
+def _followers(user_id, after):
+    query = (db.session
+             .query(User.id, User.username)
+             .join(Follows, Follows.user_following_id == User.id)
+             .filter(Follows.user_being_followed_id == user_id,
+                     User.deleted_at.is_(None)))
+    for row in _keyset(query, User.id, after):
+        yield row.id, row._asdict()
+
+
+def _following(user_id, after):
+    query = (db.session
+             .query(User.id, User.username)
+             .join(Follows, Follows.user_being_followed_id == User.id)
+             .filter(Follows.user_following_id == user_id,
+                     User.deleted_at.is_(None)))
+    for row in _keyset(query, User.id, after):
+        yield row.id, row._asdict()
+
+
+_READERS = {
+    "profile": _profile,
+    "messages": _messages,
+    "likes": _likes,
+    "followers": _followers,
+    "following": _following,
+}
+
+
+def _keyset(query, key, after):
+    """Yield every row of `query` in `key` order, CHUNK rows per query.
+
+    Each chunk's transaction ends before its rows are yielded, returning
+    the connection to the pool until the next chunk.
+    """
+
+    while True:
+        chunk = query if after is None else query.filter(key > after)
+        rows = chunk.order_by(key).limit(CHUNK).all()
+        db.session.commit()
+
+        for row in rows:
+            after = row[0]
+            yield row
+
+        if len(rows) < CHUNK:
+            return
+
+
+##############################################################################
+# Encoding
+
+
+def encode(records, format="ndjson"):
+    """Yield the records as text in `format`, in pieces of about BUFFER bytes."""
+
+    if format == "csv":
+        lines = _csv_lines(records)
+    elif format == "ndjson":
+        lines = (json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+    else:
+        raise ValueError(f"Unknown export format {format!r}")
+
+    pending = []
+    size = 0
+    for line in lines:
+        pending.append(line)
+        size += len(line)
+        if size >= BUFFER:
+            yield "".join(pending)
+            pending = []
+            size = 0
+
+    if pending:
+        yield "".join(pending)
+
+
+def _csv_lines(records):
+    out = io.StringIO()
+    writer = csv.DictWriter(out, FIELDS)
+
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+
+    yield out.getvalue()
+
+
+def gzipped(pieces):
+    """Gzip text pieces as they come, yielding bytes."""
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for piece in pieces:
+        data = compressor.compress(piece.encode())
+        if data:
+            yield data
+
+    yield compressor.flush()
@@ -0,0 +1,239 @@
+"""Shared test setup: one schema per run, one rolled-back transaction per test.
+
+Test modules subclass `WarblerTestCase`:
+
+    from fixtures import WarblerTestCase, make_user
+
+    class MyTestCase(WarblerTestCase):
+        def test_something(self):
+            user = make_user()
+            resp = self.client.get(f"/users/{user.id}")
+
+The schema is created once per process. Each test then runs inside a
+transaction on a single connection that is rolled back afterwards, so
+nothing a test writes (even through `db.session.commit()` in a view) is
+seen by the next one. Commits and rollbacks in the code under test
+operate on a SAVEPOINT inside that transaction.
+
+Passwords are hashed at the lowest bcrypt cost (see TestingConfig), and
+job workers run their jobs in the calling thread, as that connection
+can't cross threads.
+
+To run in parallel, give each process its own database: with
+pytest-xdist (`pytest -n 4`) the worker name is appended to the database
+name automatically; otherwise set TEST_DB_SUFFIX per process.
+"""
+
+import copy
+import itertools
+import os
+from unittest import TestCase, mock
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+
+from app import create_app, CURR_USER_KEY
+from cache import make_cache
+from models import db, bcrypt, User, Message, Follows, Likes
+import jobs
+
+_app = None
+_counter = itertools.count(1)
+
+
+def database_url():
+    """The database for this test process.
+
+    Adds a per-process suffix (TEST_DB_SUFFIX, or the pytest-xdist worker
+    name) so parallel processes don't share rows.
+    """
+
+    url = make_url(os.environ.get('TEST_DATABASE_URL', "postgresql:///warbler-test"))
+    suffix = os.environ.get('TEST_DB_SUFFIX') or os.environ.get('PYTEST_XDIST_WORKER')
+
+    if suffix and url.database:
+        if url.drivername.startswith("sqlite"):
+            root, ext = os.path.splitext(url.database)
+            url.database = f"{root}-{suffix}{ext}"
+        else:
+            url.database = f"{url.database}-{suffix}"
+
+    return url
+
+
+def _create_database(url):
+    """Create a Postgres database if it doesn't exist yet."""
+
+    if not url.drivername.startswith("postgresql"):
+        return
+
+    server_url = copy.copy(url)
+    server_url.database = "postgres"
+
+    server = create_engine(server_url, isolation_level="AUTOCOMMIT")
+    with server.connect() as conn:
+        exists = conn.execute("SELECT 1 FROM pg_database WHERE datname = %s",
+                              (url.database,)).scalar()
+        if not exists:
+            conn.execute(f'CREATE DATABASE "{url.database}"')
+    server.dispose()
+
+
+def _fix_sqlite_savepoints(engine):
+    """Let pysqlite use SAVEPOINTs by taking over when transactions begin.
+
+    https://docs.sqlalchemy.org/en/13/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
+    """
+
+    @event.listens_for(engine, "connect")
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def do_begin(conn):
+        conn.execute("BEGIN")
+
+
+def get_app():
+    """The test app for this process, with the schema created once."""
+
+    global _app
+
+    if _app is None:
+        url = database_url()
+        _create_database(url)
+
+        _app = create_app("testing", {'SQLALCHEMY_DATABASE_URI': str(url)})
+
+        with _app.app_context():
+            if db.engine.dialect.name == "sqlite":
+                _fix_sqlite_savepoints(db.engine)
+            db.drop_all()
+            db.create_all()
+
+    return _app
+
+
+class InlineExecutor:
+    """Stands in for ThreadPoolExecutor, running everything in this thread."""
+
+    def __init__(self, max_workers=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def map(self, fn, *iterables):
+        return [fn(*args) for args in zip(*iterables)]
+
+
+class WarblerTestCase(TestCase):
+    """Runs each test in a transaction that is rolled back afterwards."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = get_app()
+
+    def setUp(self):
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+
+        # One session for every thread, bound to our connection; views
+        # and workers calling remove() must not throw it away mid-test
+        self.real_session = db.session
+        db.session = db.create_scoped_session(
+            options={"bind": self.connection, "binds": {}, "scopefunc": lambda: 0})
+        db.session.remove = lambda: None
+        db.session.begin_nested()
+
+        @event.listens_for(db.session, "after_transaction_end")
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+        # Cached rows would outlive the rollback
+        self.app.extensions['cache'] = make_cache(self.app.config['CACHE_URL'])
+
+        self.client = self.app.test_client()
+
+        executor = mock.patch.object(jobs, "ThreadPoolExecutor", InlineExecutor)
+        executor.start()
+        self.addCleanup(executor.stop)
+
+    def tearDown(self):
+        db.session.close()
+        db.session = self.real_session
+
+        self.transaction.rollback()
+        self.connection.close()
+        self.ctx.pop()
+
+    def login(self, client, user):
+        """Log `user` in on a test client."""
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+
+##############################################################################
+# Factories
+#
+# Each adds and flushes a row, so it has an id, and returns it. Anything
+# not passed gets a unique default.
+
+_password_hashes = {}
+
+
+def make_user(username=None, email=None, password="password", **kwargs):
+    """A user who can log in with `password`."""
+
+    n = next(_counter)
+
+    # Hash each distinct password once per run
+    if password not in _password_hashes:
+        _password_hashes[password] = (bcrypt
+                                      .generate_password_hash(password)
+                                      .decode('UTF-8'))
+
+    user = User(username=username or f"user{n}",
+                email=email or f"user{n}@test.com",
+                password=_password_hashes[password],
+                **kwargs)
+    db.session.add(user)
+    db.session.flush()
+    return user
+
+
+def make_message(user=None, text=None, **kwargs):
+    """A message by `user` (a new user if not given)."""
+
+    user = user or make_user()
+    msg = Message(text=text or f"warble {next(_counter)}", user_id=user.id, **kwargs)
+    db.session.add(msg)
+    db.session.flush()
+    return msg
+
+
+def make_follow(follower, followed):
+    """Have `follower` follow `followed`."""
+
+    follow = Follows(user_following_id=follower.id, user_being_followed_id=followed.id)
+    db.session.add(follow)
+    db.session.flush()
+    return follow
+
+
+def make_like(user, message):
+    """Have `user` like `message`."""
+
+    like = Likes(user_id=user.id, message_id=message.id)
+    db.session.add(like)
+    db.session.flush()
+    return like
@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, TextAreaField
-from wtforms.validators import DataRequired, Email, Length
+from wtforms import StringField, PasswordField, TextAreaField, FloatField, IntegerField
+from wtforms.validators import DataRequired, Email, Length, NumberRange, Optional
 
 
 class MessageForm(FlaskForm):
@@ -31,4 +31,14 @@ class EditUserForm(FlaskForm):
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     password = PasswordField('Password', validators=[Length(min=6)])
     image_url = StringField('Image URL')
-    header_image_url = StringField('Header Image URL')
\ No newline at end of file
+    header_image_url = StringField('Header Image URL')
+
+
+class ProfilerForm(FlaskForm):
+    """Form for starting a profiler capture."""
+
+    rate = FloatField('Fraction of requests to sample', default=0.1,
+                      validators=[NumberRange(min=0.001, max=1)])
+    endpoint = StringField('Only this endpoint (optional)', validators=[Optional()])
+    duration = IntegerField('Seconds to capture', default=30,
+                            validators=[NumberRange(min=1)])
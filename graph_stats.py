@@ -0,0 +1,222 @@
+"""Follow-graph metrics for every user, computed offline with sparse matrices.
+
+Walking `User.followers` and `User.following` a user at a time would take
+days on a large graph. Instead the `follows` table is streamed once into
+a sparse adjacency matrix A (A[i, j] = 1 when user i follows user j) and
+every metric is a handful of vectorized operations over all users:
+
+    following, followers    row and column counts of A
+    mutuals                 row counts of A * A.T (elementwise)
+    reciprocity             mutuals / following
+    influence               PageRank over A, scaled so the mean is 1
+    cluster                 label propagation over the mutual-follow graph
+
+The results replace the `user_graph_stats` table in one transaction.
+Run with:
+
+    flask graph-stats --workers 2
+
+With more than one worker, PageRank and clustering run in separate
+processes. The command reports the time of each phase and peak memory;
+`python benchmark.py graph --edges 10000000` measures the computation on
+a synthetic graph without a database.
+
+NumPy and SciPy are only needed here, so only the command imports this.
+"""
+
+import itertools
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select
+
+from models import db, Follows, User, UserGraphStats
+
+# Rows per fetch when streaming follows, and per INSERT when saving
+FETCH = 100_000
+WRITE_CHUNK = 10_000
+
+DAMPING = 0.85
+TOLERANCE = 1e-6
+MAX_ITERATIONS = 100
+LABEL_ROUNDS = 20
+
+
+def load_edges():
+    """(follower ids, followed ids) for every follow between live users."""
+
+    query = select([Follows.user_following_id, Follows.user_being_followed_id])
+    result = (db.session.connection()
+              .execution_options(stream_results=True)
+              .execute(query))
+
+    parts = []
+    while True:
+        rows = result.fetchmany(FETCH)
+        if not rows:
+            break
+        parts.append(np.fromiter(itertools.chain.from_iterable(rows),
+                                 dtype=np.int64, count=2 * len(rows)))
+
+    edges = np.concatenate(parts).reshape(-1, 2) if parts else np.empty((0, 2), np.int64)
+
+    # Deleted users are hidden everywhere until their follows are purged
+    deleted = [id for (id,) in db.session.query(User.id).filter(User.deleted_at.isnot(None))]
+    if deleted:
+        edges = edges[~np.isin(edges, deleted).any(axis=1)]
+
+    return edges[:, 0], edges[:, 1]
+
+
+def compute(followers, followed, workers=1):
+    """Compute every metric for the users in the edge lists.
+
+    Returns (user ids, {metric: array}), the arrays in user id order.
+    """
+
+    user_ids, index = np.unique(np.concatenate([followers, followed]), return_inverse=True)
+    n, m = len(user_ids), len(followers)
+    rows, cols = index[:m], index[m:]
+
+    adjacency = sparse.csr_matrix((np.ones(m, dtype=np.float64), (rows, cols)), shape=(n, n))
+    mutual = adjacency.multiply(adjacency.T).tocsr()
+
+    following = np.diff(adjacency.indptr)
+    mutuals = np.diff(mutual.indptr)
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            ranks = pool.submit(pagerank, adjacency)
+            labels = pool.submit(communities, mutual)
+            ranks, labels = ranks.result(), labels.result()
+    else:
+        ranks, labels = pagerank(adjacency), communities(mutual)
+
+    return user_ids, {
+        "followers": np.bincount(cols, minlength=n),
+        "following": following,
+        "mutuals": mutuals,
+        "reciprocity": np.divide(mutuals, following, out=np.zeros(n),
+                                 where=following > 0),
+        "influence": ranks * n,
+        "cluster": user_ids[labels],
+    }
+
+
+def pagerank(adjacency, damping=DAMPING, tolerance=TOLERANCE):
+    """PageRank of each node (summing to 1), by power iteration."""
+
+    n = adjacency.shape[0]
+    if n == 0:
+        return np.zeros(0)
+
+    out_degree = np.diff(adjacency.indptr)
+    dangling = out_degree == 0
+    inverse = np.divide(1.0, out_degree, out=np.zeros(n), where=~dangling)
+
+    # Column-stochastic transition matrix, as CSR for fast products
+    transition = (sparse.diags(inverse) @ adjacency).T.tocsr()
+
+    ranks = np.full(n, 1.0 / n)
+    for _ in range(MAX_ITERATIONS):
+        spread = damping * (transition @ ranks + ranks[dangling].sum() / n)
+        new = spread + (1 - damping) / n
+        change = np.abs(new - ranks).sum()
+        ranks = new
+        if change < n * tolerance:
+            break
+
+    return ranks
+
+
+def communities(mutual, rounds=LABEL_ROUNDS):
+    """Community label (a member's index) of each node, by label propagation.
+
+    Every round, each node takes the label most common among itself and its
+    mutual follows (the smallest on ties), all nodes at once.
+    """
+
+    n = mutual.shape[0]
+    labels = np.arange(n, dtype=np.int64)
+    if n == 0:
+        return labels
+
+    graph = (mutual + sparse.identity(n, format="csr")).tocsr()
+    rows = np.repeat(np.arange(n, dtype=np.int64), np.diff(graph.indptr))
+    cols = graph.indices
+
+    for _ in range(rounds):
+        # Count each (node, neighbour's label) pair with one sort
+        keys = np.sort(rows * n + labels[cols])
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        counts = np.diff(np.r_[starts, len(keys)])
+        nodes, candidates = np.divmod(keys[starts], n)
+
+        # Most frequent per node; the sort is stable, so ties keep the smallest
+        order = np.lexsort((-counts, nodes))
+        first = order[np.r_[True, nodes[order][1:] != nodes[order][:-1]]]
+
+        new = labels.copy()
+        new[nodes[first]] = candidates[first]
+        if np.array_equal(new, labels):
+            break
+        labels = new
+
+    return labels
+
+
+def save(user_ids, metrics, computed_at=None):
+    """Replace `user_graph_stats` with the computed metrics and commit."""
+
+    computed_at = computed_at or datetime.utcnow()
+    names = list(metrics)
+    columns = [metrics[name].tolist() for name in names]
+
+    UserGraphStats.query.delete(synchronize_session=False)
+
+    table = UserGraphStats.__table__
+    for start in range(0, len(user_ids), WRITE_CHUNK):
+        end = start + WRITE_CHUNK
+        db.session.execute(table.insert(), [
+            dict(zip(names, values), user_id=user_id, computed_at=computed_at)
+            for user_id, *values in zip(user_ids[start:end].tolist(),
+                                        *(column[start:end] for column in columns))])
+
+    db.session.commit()
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process and of its finished children, in MB."""
+
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / 1024, children / 1024
+
+
+def run(workers=1):
+    """Load, compute and save; return a report of sizes and timings."""
+
+    report = {}
+    started = time.perf_counter()
+
+    followers, followed = load_edges()
+    report["load_seconds"] = time.perf_counter() - started
+
+    phase = time.perf_counter()
+    user_ids, metrics = compute(followers, followed, workers)
+    report["compute_seconds"] = time.perf_counter() - phase
+
+    phase = time.perf_counter()
+    save(user_ids, metrics)
+    report["save_seconds"] = time.perf_counter() - phase
+
+    report["total_seconds"] = time.perf_counter() - started
+    report["edges"] = len(followers)
+    report["users"] = len(user_ids)
+    report["peak_mb"], report["peak_worker_mb"] = peak_memory_mb()
+
+    return report
@@ -0,0 +1,140 @@
+"""Hot and archive tiers for message timelines.
+
+Nearly every timeline read wants the last few weeks, but `messages` holds
+every warble ever written. So the (id, author, time) of each message
+written in the last HOT_WINDOW is also kept in the small `messages_hot`
+table, and timelines read from there:
+
+    ids = hot_messages.timeline(user_ids, limit=100)
+
+Only when a page reaches back past the window (a quiet account, or
+`before=` a time older than the window) does the read fall through to
+the archive tier, which is `messages` itself, for the older part. The two
+reads split at the window boundary, so they never overlap.
+
+Rows are added to the hot tier as messages are inserted and removed with
+them; every hour the `hot_messages_trim` job drops the rows that
+have aged out of the window (their messages are in the archive already).
+After bulk loads, or if the tier gets out of step, rebuild it with:
+
+    flask hot-messages-rebuild
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, event, select
+
+from deletion import purge_hook
+from metrics import metrics
+from models import db, HotMessage, Message
+import jobs
+
+HOT_WINDOW = timedelta(days=30)
+TRIM_BATCH = 10_000
+
+
+def boundary(now=None):
+    """The oldest timestamp in the hot window."""
+
+    return (now or datetime.utcnow()) - HOT_WINDOW
+
+
+def timeline(user_ids, limit, before=None):
+    """Ids of the newest `limit` messages by `user_ids`, older than `before`."""
+
+    user_ids = list(user_ids)
+    if not user_ids:
+        return []
+
+    cutoff = boundary()
+    ids = []
+
+    if before is None or before > cutoff:
+        ids = [id for (id,) in db.session.execute(hot_query(user_ids, limit, cutoff, before))]
+        metrics.inc("warbler_timeline_reads_total", (("tier", "hot"),))
+
+        if len(ids) == limit:
+            return ids
+
+    query = archive_query(user_ids, limit - len(ids), cutoff, before)
+    metrics.inc("warbler_timeline_reads_total", (("tier", "archive"),))
+
+    return ids + [id for (id,) in db.session.execute(query)]
+
+
+def hot_query(user_ids, limit, cutoff, before=None):
+    """SELECT the newest message ids in the hot tier, back to `cutoff`."""
+
+    table = HotMessage.__table__
+    query = select([table.c.message_id]).where(and_(table.c.user_id.in_(user_ids),
+                                                    table.c.timestamp >= cutoff))
+    if before is not None:
+        query = query.where(table.c.timestamp < before)
+    return query.order_by(table.c.timestamp.desc()).limit(limit)
+
+
+def archive_query(user_ids, limit, cutoff, before=None):
+    """SELECT the newest message ids from before `cutoff` (and `before`)."""
+
+    table = Message.__table__
+    return (select([table.c.id])
+            .where(and_(table.c.user_id.in_(user_ids),
+                        table.c.timestamp < min(before or cutoff, cutoff)))
+            .order_by(table.c.timestamp.desc())
+            .limit(limit))
+
+
+##############################################################################
+# Keeping the hot tier
+
+
+@event.listens_for(Message, "after_insert")
+def _add(mapper, connection, message):
+    if message.timestamp >= boundary():
+        connection.execute(HotMessage.__table__.insert().values(
+            message_id=message.id, user_id=message.user_id, timestamp=message.timestamp))
+
+
+@event.listens_for(Message, "after_delete")
+def _remove(mapper, connection, message):
+    connection.execute(HotMessage.__table__.delete().where(
+        HotMessage.message_id == message.id))
+
+
+@jobs.job("hot_messages_trim", every=timedelta(hours=1))
+def trim():
+    """Drop messages that have aged out of the window from the hot tier."""
+
+    cutoff = boundary()
+
+    while True:
+        ids = [id for (id,) in (db.session
+                                .query(HotMessage.message_id)
+                                .filter(HotMessage.timestamp < cutoff)
+                                .limit(TRIM_BATCH))]
+        if not ids:
+            return
+
+        (HotMessage.query
+         .filter(HotMessage.message_id.in_(ids))
+         .delete(synchronize_session=False))
+        db.session.commit()
+
+
+def rebuild():
+    """Refill the hot tier from `messages`; return how many rows it has."""
+
+    HotMessage.query.delete(synchronize_session=False)
+    db.session.execute(HotMessage.__table__.insert().from_select(
+        ["message_id", "user_id", "timestamp"],
+        db.session
+        .query(Message.id, Message.user_id, Message.timestamp)
+        .filter(Message.timestamp >= boundary())))
+    db.session.commit()
+
+    return HotMessage.query.count()
+
+
+@purge_hook("messages")
+def forget_purged_messages(user_id, ids):
+    HotMessage.query.filter(HotMessage.message_id.in_(ids)).delete(synchronize_session=False)
@@ -0,0 +1,148 @@
+"""Read-through cache of message and user snapshots for rendering lists.
+
+Pages that list messages first query just the ids they need, in order,
+then hydrate them:
+
+    messages = hydration.hydrate_messages(ids)
+
+Snapshots are the few fields the templates show (a message's text,
+timestamp and author; a user's username and image), stored in the app
+cache as plain tuples. `get_many` answers from the cache and loads every
+miss with one `IN` query, so a cold 100-message page costs one query for
+the messages and one for their authors.
+
+Views that change these fields invalidate the snapshots after
+committing. Entries also expire after `TTL` seconds, which bounds how
+long a snapshot read just before a change and written just after it can
+linger.
+"""
+
+import logging
+from collections import namedtuple
+
+from flask import current_app
+from sqlalchemy import select
+
+from cache import CacheError
+from deletion import purge_hook
+from models import db, User, Message
+
+TTL = 3600
+
+log = logging.getLogger(__name__)
+
+UserCard = namedtuple("UserCard", "id username image_url")
+MessageCard = namedtuple("MessageCard", "id text timestamp user_id user")
+
+
+class EntityCache:
+    """Snapshots of some columns of `model`, keyed by id."""
+
+    def __init__(self, name, model, columns, where=None):
+        self.name = name
+        self.model = model
+        self.columns = columns
+        self.where = where
+
+    @property
+    def cache(self):
+        return current_app.extensions['cache'].namespace(self.name)
+
+    def get_many(self, ids):
+        """Return {id: tuple of column values} for the ids that exist."""
+
+        snapshots, misses = self.lookup(ids)
+        if misses:
+            snapshots.update(self.store(db.session.execute(self.select(misses))))
+        return snapshots
+
+    def lookup(self, ids):
+        """({id: snapshot} for the ids in the cache, [ids to load]).
+
+        `get_many` in two halves around the query, for callers (asgi.py)
+        that run `select(misses)` themselves and hand the rows to `store`.
+        """
+
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return {}, []
+
+        try:
+            found = self.cache.get_many([str(id) for id in ids])
+        except CacheError:
+            log.warning("%s cache unavailable", self.name, exc_info=True)
+            found = {}
+
+        snapshots = {int(key): value for key, value in found.items()}
+        return snapshots, [id for id in ids if id not in snapshots]
+
+    def select(self, ids):
+        """A Core SELECT of id and the snapshot columns for `ids`."""
+
+        table = self.model.__table__
+        query = (select([table.c.id] + [table.c[col] for col in self.columns])
+                 .where(table.c.id.in_(ids)))
+        if self.where is not None:
+            query = query.where(self.where)
+        return query
+
+    def store(self, rows):
+        """Cache the snapshots in `rows` (from `select`); return {id: snapshot}."""
+
+        width = len(self.columns)
+        loaded = {row[0]: tuple(row[i] for i in range(1, width + 1)) for row in rows}
+
+        try:
+            self.cache.set_many({str(id): value for id, value in loaded.items()}, ttl=TTL)
+        except CacheError:
+            log.warning("%s cache unavailable", self.name, exc_info=True)
+
+        return loaded
+
+    def invalidate(self, ids):
+        try:
+            self.cache.delete_many([str(id) for id in ids])
+        except CacheError:
+            log.warning("%s cache unavailable", self.name, exc_info=True)
+
+
+users = EntityCache("users", User, ("username", "image_url"),
+                    where=User.deleted_at.is_(None))
+messages = EntityCache("messages", Message, ("text", "timestamp", "user_id"))
+
+
+def get_users(ids):
+    """Return {id: UserCard}, leaving out deleted users."""
+
+    return {id: UserCard(id, *values) for id, values in users.get_many(ids).items()}
+
+
+def hydrate_messages(ids):
+    """Return MessageCards for `ids`, in order, with their authors.
+
+    Messages that no longer exist, or whose author was deleted, are left out.
+    """
+
+    found = messages.get_many(ids)
+    authors = get_users(user_id for (_, _, user_id) in found.values())
+    return message_cards(ids, found, authors)
+
+
+def message_cards(ids, found, authors):
+    """MessageCards for `ids`, from message and author snapshots."""
+
+    cards = []
+    for id in ids:
+        if id not in found:
+            continue
+
+        text, timestamp, user_id = found[id]
+        if user_id in authors:
+            cards.append(MessageCard(id, text, timestamp, user_id, authors[user_id]))
+
+    return cards
+
+
+@purge_hook("messages")
+def forget_purged_messages(user_id, ids):
+    messages.invalidate(ids)
@@ -0,0 +1,404 @@
+"""Resized, cached copies of users' images.
+
+`image_url` and `header_image_url` can point anywhere on the web, and
+pages used to show the full-size originals as 48px thumbnails. The
+`image` template filter points them at `/images/<variant>/<signature>?url=...`
+instead, which serves a resized copy:
+
+    thumb     96x96, cropped          timeline and nav avatars
+    card      200x200, cropped        user cards and profile avatars
+    header    within 1500x500         card and profile headers
+
+(twice the CSS size, for high-density screens) with a year-long,
+immutable Cache-Control.
+
+Each source is fetched once and kept in IMAGE_CACHE_DIR, addressed by
+content so that users sharing an image share its files:
+
+    urls/<ab>/<sha256 of the URL>               sha256 of the source's bytes
+    sources/<ab>/<sha256>                       the original
+    variants/<ab>/<sha256>-<variant>            a resized copy
+
+Once the files written by a worker add up to a twentieth of
+IMAGE_CACHE_MAX_BYTES, it scans the cache and, if it is over the limit,
+removes the least recently used files (by mtime, which reads refresh at
+most hourly) down to 90% of it. Concurrent misses for one URL, from
+threads or from other workers, queue on an flock'd lock file: the first
+fetches and the rest find its result. A failed fetch is remembered for
+FAILURE_TTL seconds, and the route redirects to the default image.
+
+URLs are signed with SECRET_KEY so the route isn't an open proxy. Only
+http(s) sources are fetched, with IMAGE_FETCH_TIMEOUT and a size cap, and
+hosts with private addresses are refused (unless IMAGE_ALLOW_PRIVATE_HOSTS,
+for tests). The connection goes to the very address that was checked, not
+to whatever the name resolves to a moment later, and every redirect is
+resolved and checked the same way. Paths under /static/ are read from the
+app's static folder.
+"""
+
+import contextlib
+import fcntl
+import functools
+import hashlib
+import hmac
+import http.client
+import io
+import ipaddress
+import os
+import posixpath
+import socket
+import ssl
+import tempfile
+import time
+from urllib.parse import urljoin, urlsplit
+
+from flask import current_app, url_for
+from PIL import Image, ImageOps
+
+# Variant: (width, height, crop to fill)
+VARIANTS = {
+    "thumb": (96, 96, True),
+    "card": (200, 200, True),
+    "header": (1500, 500, False),
+}
+
+DEFAULT_IMAGE = "/static/images/default-pic.png"
+DEFAULT_HEADER = "/static/images/warbler-hero.jpg"
+
+MAX_AGE = 365 * 86400
+
+# Refresh a file's mtime on read at most this often, in seconds
+TOUCH_INTERVAL = 3600
+
+# How long to remember that a source couldn't be fetched, in seconds
+FAILURE_TTL = 600
+
+# Redirects followed when fetching a source
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+
+# Refuse to decode images larger than this, in pixels
+MAX_PIXELS = 40_000_000
+
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+
+
+class ImageError(Exception):
+    """A source image couldn't be fetched or decoded."""
+
+
+@functools.lru_cache(maxsize=4096)
+def sign(secret, url):
+    """The signature allowing `url` through the proxy."""
+
+    return hmac.new(secret.encode(), url.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def verify(url, signature):
+    return hmac.compare_digest(sign(current_app.config['SECRET_KEY'], url), signature)
+
+
+def image_filter(url, variant):
+    """Template filter: the proxy URL for `url`'s `variant`."""
+
+    url = url or (DEFAULT_HEADER if variant == "header" else DEFAULT_IMAGE)
+    return url_for("warbler.image_proxy", variant=variant,
+                   signature=sign(current_app.config['SECRET_KEY'], url), url=url)
+
+
+def mimetype(data):
+    return "image/png" if data.startswith(PNG_MAGIC) else "image/jpeg"
+
+
+def resize(data, variant):
+    """`data` resized for `variant`: PNG if it has transparency, else JPEG."""
+
+    width, height, crop = VARIANTS[variant]
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.width * image.height > MAX_PIXELS:
+                raise ImageError(f"Image too large ({image.width}x{image.height})")
+
+            # Let JPEGs decode at a reduced scale; allow for EXIF rotation
+            side = max(width, height)
+            image.draft("RGB", (side, side))
+            image = ImageOps.exif_transpose(image)
+
+            if crop:
+                image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+            else:
+                image.thumbnail((width, height), Image.LANCZOS)
+
+            out = io.BytesIO()
+            if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+                image.convert("RGBA").save(out, "PNG", optimize=True)
+            else:
+                image.convert("RGB").save(out, "JPEG", quality=85, optimize=True,
+                                          progressive=True)
+            return out.getvalue()
+
+    except (OSError, ValueError, Image.DecompressionBombError) as exc:
+        raise ImageError(f"Couldn't decode image: {exc}") from exc
+
+
+class ImageCache:
+    """A size-bounded, content-addressed disk cache of images and their variants."""
+
+    def __init__(self, directory, max_bytes, static_folder=None, timeout=5,
+                 max_source_bytes=10 * 1024 * 1024, allow_private_hosts=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.static_folder = static_folder
+        self.timeout = timeout
+        self.max_source_bytes = max_source_bytes
+        self.allow_private_hosts = allow_private_hosts
+        self.written = 0
+
+        for name in ("urls", "sources", "variants", "locks"):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    def get(self, url, variant):
+        """(bytes, content hash, "hit" or "miss") for `url`'s `variant`.
+
+        Raises ImageError if the source can't be fetched or decoded.
+        """
+
+        key = _sha256(url.encode())
+
+        digest = self._digest(key)
+        if digest:
+            data = self._read(self._path("variants", f"{digest}-{variant}"))
+            if data is not None:
+                return data, digest, "hit"
+
+        with self._locked(key):
+            # Whoever held the lock may have done the work
+            digest = self._digest(key)
+            source = None
+            if digest:
+                data = self._read(self._path("variants", f"{digest}-{variant}"))
+                if data is not None:
+                    return data, digest, "hit"
+                source = self._read(self._path("sources", digest))
+
+            if source is None:
+                try:
+                    source = self.fetch(url)
+                    data = resize(source, variant)
+                except ImageError:
+                    self._write(self._path("urls", key), b"")
+                    raise
+                digest = _sha256(source)
+                self._write(self._path("sources", digest), source)
+                self._write(self._path("urls", key), digest.encode())
+            else:
+                data = resize(source, variant)
+
+            self._write(self._path("variants", f"{digest}-{variant}"), data)
+            return data, digest, "miss"
+
+    def fetch(self, url):
+        """The bytes at `url`, an http(s) URL or a path under /static/."""
+
+        if url.startswith("/static/") and self.static_folder:
+            name = posixpath.normpath(urlsplit(url).path[len("/static/"):])
+            if name.startswith(("..", "/")):
+                raise ImageError(f"Bad static path {url!r}")
+            try:
+                with open(os.path.join(self.static_folder, name), "rb") as f:
+                    return f.read(self.max_source_bytes)
+            except OSError as exc:
+                raise ImageError(f"Couldn't read {url}: {exc}") from exc
+
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ("http", "https") or not parts.hostname:
+                raise ImageError(f"Not an http(s) URL: {url!r}")
+
+            try:
+                status, location, data = self._get(parts, self._check_host(parts.hostname))
+            except (OSError, ValueError, http.client.HTTPException) as exc:
+                raise ImageError(f"Couldn't fetch {url}: {exc}") from exc
+
+            if status in REDIRECT_STATUSES and location:
+                url = urljoin(url, location)
+                continue
+            if status != 200:
+                raise ImageError(f"Couldn't fetch {url}: HTTP {status}")
+            if len(data) > self.max_source_bytes:
+                raise ImageError(f"{url} is over {self.max_source_bytes} bytes")
+            return data
+
+        raise ImageError(f"More than {MAX_REDIRECTS} redirects fetching {url}")
+
+    def _get(self, parts, address):
+        """(status, Location, body) of a GET of URL `parts` from IP `address`."""
+
+        if parts.scheme == "https":
+            conn = _PinnedHTTPSConnection(address, parts.hostname, parts.port,
+                                          timeout=self.timeout)
+        else:
+            conn = _PinnedHTTPConnection(address, parts.hostname, parts.port,
+                                         timeout=self.timeout)
+
+        path = parts.path or "/"
+        if parts.query:
+            path += f"?{parts.query}"
+
+        try:
+            conn.request("GET", path, headers={"User-Agent": "warbler-images"})
+            resp = conn.getresponse()
+            return resp.status, resp.getheader("Location"), resp.read(self.max_source_bytes + 1)
+        finally:
+            conn.close()
+
+    def evict(self):
+        """Remove least recently used files until under the size limit.
+
+        Returns the number of files removed.
+        """
+
+        self.written = 0
+
+        files = []
+        for name in ("urls", "sources", "variants"):
+            for root, _, names in os.walk(os.path.join(self.directory, name)):
+                for filename in names:
+                    path = os.path.join(root, filename)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        if total <= self.max_bytes:
+            return 0
+
+        removed = 0
+        for _, size, path in sorted(files):
+            if total <= 0.9 * self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+                removed += 1
+            total -= size
+
+        return removed
+
+    def _check_host(self, hostname):
+        """The address to connect to for `hostname`, once it has been checked."""
+
+        try:
+            addresses = [info[4][0] for info in socket.getaddrinfo(hostname, None,
+                                                                   type=socket.SOCK_STREAM)]
+        except (OSError, UnicodeError) as exc:
+            raise ImageError(f"Couldn't resolve {hostname}: {exc}") from exc
+        if not addresses:
+            raise ImageError(f"Couldn't resolve {hostname}")
+
+        if not self.allow_private_hosts:
+            for address in addresses:
+                if not ipaddress.ip_address(address.split("%")[0]).is_global:
+                    raise ImageError(f"{hostname} has a non-public address")
+
+        return addresses[0]
+
+    def _digest(self, key):
+        """The content hash stored for URL hash `key`, or None.
+
+        Raises ImageError if fetching it failed less than FAILURE_TTL ago.
+        """
+
+        path = self._path("urls", key)
+        try:
+            with open(path, "rb") as f:
+                digest = f.read().decode()
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+
+        if not digest:
+            if time.time() - mtime < FAILURE_TTL:
+                raise ImageError("Fetching this image failed recently")
+            return None
+
+        self._touch(path, mtime)
+        return digest
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+                self._touch(path, os.fstat(f.fileno()).st_mtime)
+                return data
+        except FileNotFoundError:
+            return None
+
+    def _touch(self, path, mtime):
+        if time.time() - mtime > TOUCH_INTERVAL:
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(path)
+
+    def _write(self, path, data):
+        """Write atomically, so readers never see part of a file."""
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+            raise
+
+        self.written += len(data)
+        if self.written >= self.max_bytes / 20:
+            self.evict()
+
+    def _path(self, kind, name):
+        return os.path.join(self.directory, kind, name[:2], name)
+
+    @contextlib.contextmanager
+    def _locked(self, key):
+        """Hold the lock for URL hash `key`, across threads and processes.
+
+        Locks are striped over 4096 files, so the directory stays small.
+        """
+
+        fd = os.open(os.path.join(self.directory, "locks", key[:3]), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """An HTTP connection to `address`, sending `host` as the Host header."""
+
+    def __init__(self, address, host, port=None, timeout=None):
+        super().__init__(host, port, timeout=timeout)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """As _PinnedHTTPConnection, verifying the certificate against `host`."""
+
+    def __init__(self, address, host, port=None, timeout=None):
+        super().__init__(host, port, timeout=timeout, context=ssl.create_default_context())
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
@@ -0,0 +1,287 @@
+"""Durable background jobs for Warbler.
+
+Jobs live in the `jobs` table, so they survive restarts and work the same
+on SQLite and Postgres. Request handlers call `enqueue()` and return; the
+job row is committed together with whatever else the handler changed.
+
+A `Worker` polls the table, claims due jobs with a lease and runs them on
+a thread pool. Delivery is at-least-once: if a worker dies mid-job, the
+lease expires and another worker picks the job up again. Failed jobs are
+retried with exponential backoff until `max_attempts` is reached.
+
+Jobs registered with `every=` (a timedelta) are periodic: running
+workers queue one per period themselves, so nothing on the request path
+has to.
+
+Run a worker with:
+
+    flask jobs-worker --concurrency 4
+"""
+
+import json
+import os
+import random
+import socket
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, or_
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Job
+
+# name -> (function, max_attempts)
+HANDLERS = {}
+
+# name -> period, for jobs the workers queue themselves
+SCHEDULES = {}
+
+BACKOFF_BASE_SECONDS = 5
+BACKOFF_MAX_SECONDS = 60 * 60
+
+STATUSES = ("queued", "running", "done", "dead")
+
+
+class UnknownJobError(LookupError):
+    """Raised when a job names a handler that isn't registered."""
+
+
+def job(name=None, max_attempts=5, every=None):
+    """Register a function as a job handler.
+
+    The function is called with the job's payload as keyword arguments.
+
+        @job("purge_user")
+        def purge_user(user_id):
+            ...
+
+    With `every`, a timedelta, workers also queue it (with no payload)
+    once per period.
+    """
+
+    def register(fn):
+        HANDLERS[name or fn.__name__] = (fn, max_attempts)
+        if every is not None:
+            SCHEDULES[name or fn.__name__] = every
+        return fn
+
+    return register
+
+
+def enqueue(name, payload=None, idempotency_key=None, delay=0):
+    """Add a job to the current DB session and return it.
+
+    The job is not visible to workers until the caller commits, so it is
+    only queued if the rest of the request's changes are too.
+
+    If `idempotency_key` is given and a job with that key already exists,
+    the existing job is returned instead of queueing a duplicate.
+    """
+
+    if name not in HANDLERS:
+        raise UnknownJobError(name)
+
+    if idempotency_key is not None:
+        existing = Job.query.filter_by(idempotency_key=idempotency_key).first()
+        if existing:
+            return existing
+
+    new_job = Job(
+        name=name,
+        payload=json.dumps(payload or {}),
+        max_attempts=HANDLERS[name][1],
+        idempotency_key=idempotency_key,
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+    )
+
+    if idempotency_key is None:
+        db.session.add(new_job)
+        return new_job
+
+    # Another transaction may insert the same key after our SELECT
+    try:
+        with db.session.begin_nested():
+            db.session.add(new_job)
+        return new_job
+    except IntegrityError:
+        return Job.query.filter_by(idempotency_key=idempotency_key).one()
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying a job that has failed `attempts` times."""
+
+    delay = min(BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def queue_stats():
+    """Count jobs per status, plus the age of the oldest due job."""
+
+    counts = dict.fromkeys(STATUSES, 0)
+    rows = (db.session
+            .query(Job.status, func.count(Job.id))
+            .group_by(Job.status)
+            .all())
+    counts.update(rows)
+
+    oldest = (db.session
+              .query(func.min(Job.run_at))
+              .filter(Job.status == "queued", Job.run_at <= datetime.utcnow())
+              .scalar())
+    lag = (datetime.utcnow() - oldest).total_seconds() if oldest else 0
+
+    return {"counts": counts, "lag_seconds": lag}
+
+
+class Worker:
+    """Claims due jobs and runs them on a thread pool."""
+
+    def __init__(self, app, concurrency=4, poll_interval=1.0,
+                 lease_seconds=300, worker_id=None):
+        self.app = app
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.stopping = threading.Event()
+
+        # name -> the period this worker last queued a periodic job for
+        self.scheduled = {}
+
+    def schedule(self, now=None):
+        """Queue each periodic job once for the current period. The caller commits.
+
+        Every worker does this; the idempotency key makes it one job per
+        period, and remembering the period saves asking again until the next.
+        """
+
+        now = now or datetime.utcnow()
+        for name, every in SCHEDULES.items():
+            period = (now - datetime.min) // every
+            if self.scheduled.get(name) != period:
+                enqueue(name, idempotency_key=f"{name}:{period}")
+                self.scheduled[name] = period
+
+    def claim(self, limit):
+        """Lease up to `limit` due jobs to this worker and return their ids.
+
+        Each job is claimed with a conditional UPDATE, so two workers
+        racing for the same row can't both win.
+        """
+
+        now = datetime.utcnow()
+        claimable = or_(
+            and_(Job.status == "queued", Job.run_at <= now),
+            and_(Job.status == "running", Job.locked_until < now),
+        )
+
+        # Jobs whose lease ran out on their last allowed attempt are dead
+        (Job.query
+         .filter(Job.status == "running",
+                 Job.locked_until < now,
+                 Job.attempts >= Job.max_attempts)
+         .update({"status": "dead",
+                  "last_error": "lease expired",
+                  "finished_at": now},
+                 synchronize_session=False))
+
+        candidates = [job_id for (job_id,) in (db.session
+                                               .query(Job.id)
+                                               .filter(claimable)
+                                               .order_by(Job.run_at)
+                                               .limit(limit))]
+
+        claimed = []
+        for job_id in candidates:
+            won = (Job.query
+                   .filter(Job.id == job_id, claimable)
+                   .update({"status": "running",
+                            "locked_by": self.worker_id,
+                            "locked_until": now + timedelta(seconds=self.lease_seconds),
+                            "attempts": Job.attempts + 1},
+                           synchronize_session=False))
+            if won:
+                claimed.append(job_id)
+
+        db.session.commit()
+        return claimed
+
+    def execute(self, job_id):
+        """Run one claimed job and record the outcome.
+
+        The outcome is written only while the job is still leased to this
+        worker: if the handler outlived the lease and another worker has
+        reclaimed the job, it is that worker's to finish.
+        """
+
+        with self.app.app_context():
+            current = Job.query.get(job_id)
+
+            if current is None or current.locked_by != self.worker_id:
+                return
+
+            try:
+                if current.name not in HANDLERS:
+                    raise UnknownJobError(current.name)
+
+                fn = HANDLERS[current.name][0]
+                fn(**json.loads(current.payload))
+
+            except Exception:
+                db.session.rollback()
+                current = Job.query.get(job_id)
+                outcome = {"last_error": traceback.format_exc(limit=5)}
+
+                if current.attempts >= current.max_attempts:
+                    outcome.update(status="dead", finished_at=datetime.utcnow())
+                else:
+                    outcome.update(status="queued",
+                                   run_at=(datetime.utcnow()
+                                           + timedelta(seconds=backoff(current.attempts))))
+
+            else:
+                outcome = {"status": "done", "finished_at": datetime.utcnow()}
+
+            outcome.update(locked_by=None, locked_until=None)
+            (Job.query
+             .filter(Job.id == job_id, Job.locked_by == self.worker_id)
+             .update(outcome, synchronize_session=False))
+            db.session.commit()
+
+    def run_once(self):
+        """Claim and run one batch of jobs; return how many ran."""
+
+        with self.app.app_context():
+            claimed = self.claim(self.concurrency)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            list(pool.map(self.execute, claimed))
+
+        return len(claimed)
+
+    def run(self):
+        """Process jobs until `stop()` is called."""
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            in_flight = set()
+
+            while not self.stopping.is_set():
+                in_flight = {f for f in in_flight if not f.done()}
+                free = self.concurrency - len(in_flight)
+
+                claimed = []
+                if free:
+                    with self.app.app_context():
+                        self.schedule()
+                        claimed = self.claim(free)
+
+                for job_id in claimed:
+                    in_flight.add(pool.submit(self.execute, job_id))
+
+                if not claimed:
+                    self.stopping.wait(self.poll_interval)
+
+    def stop(self):
+        self.stopping.set()
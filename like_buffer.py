@@ -0,0 +1,331 @@
+"""Write-behind buffering for like toggles (opt in with LIKE_WRITE_BEHIND).
+
+Normally each click on a like button reads, writes and commits on its
+own. With write-behind, `add_remove_like` records the user's intent in
+this worker's `LikeBuffer` and returns; a background thread applies the
+buffered intents every LIKE_FLUSH_INTERVAL seconds (or as soon as
+LIKE_FLUSH_MAX are waiting) in one transaction, with multi-row INSERTs
+and DELETEs. Intents are coalesced per (user, message): liking and then
+unliking before a flush writes nothing.
+
+Intents are stored as the state the user wants ("liked" or "not liked"),
+so applying them is idempotent. Before a toggle returns, its intent is
+appended and fsync'ed to a journal file in LIKE_JOURNAL_DIR, which must
+be on local, persistent disk. Each worker holds an flock on its journals
+while it lives; journals of workers that died before flushing are
+replayed by the next buffer to start.
+
+Users see their own buffered likes right away when served by the worker
+that buffered them (`overlay()`); other workers show them after the next
+flush.
+"""
+
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app
+
+from models import db, Likes, Message, User
+import message_stats
+import outbox
+import trending
+
+INSERT_CHUNK = 500
+
+log = logging.getLogger(__name__)
+
+
+class LikeBuffer:
+    """Buffers like toggles for one worker process."""
+
+    def __init__(self, app, directory, interval=0.2, max_items=500):
+        """Buffer likes for `app`, journalling to `directory`.
+
+        With `interval` None no flush thread is started; call `flush()`.
+        """
+
+        self.app = app
+        self.directory = directory
+        self.interval = interval
+        self.max_items = max_items
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+
+        # (user id, message id) -> (liked, liked before buffering, when)
+        self.pending = {}
+        self.journal = None
+        self.retired = []
+        self.pid = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    def toggle(self, user_id, message_id):
+        """Flip whether `user_id` likes `message_id`; return the new state."""
+
+        self._start()
+        key = (user_id, message_id)
+
+        with self.lock:
+            buffered = key in self.pending
+
+        in_db = buffered or (db.session
+                             .query(Likes.id)
+                             .filter_by(user_id=user_id, message_id=message_id)
+                             .first()) is not None
+
+        with self.lock:
+            if key in self.pending:
+                liked, base, _ = self.pending[key]
+            else:
+                liked = base = in_db
+
+            liked, at = not liked, datetime.utcnow()
+            self._write_journal(user_id, message_id, liked, at)
+
+            # Back where the database is: nothing to write
+            if liked == base:
+                del self.pending[key]
+            else:
+                self.pending[key] = (liked, base, at)
+
+            full = len(self.pending) >= self.max_items
+
+        if full:
+            self.wake.set()
+
+        return liked
+
+    def pending_for(self, user_id):
+        """{message id: liked} for this user's buffered toggles."""
+
+        with self.lock:
+            return {message_id: liked
+                    for (pending_user, message_id), (liked, _, _) in self.pending.items()
+                    if pending_user == user_id}
+
+    def flush(self):
+        """Apply every buffered intent in one transaction; return how many."""
+
+        with self.flush_lock:
+            with self.lock:
+                batch = {key: (liked, at) for key, (liked, _, at) in self.pending.items()}
+                pending = self.pending
+                self.pending = {}
+
+                # Later toggles go to a new journal
+                if self.journal is not None:
+                    self.retired.append(self.journal)
+                    self.journal = None
+                retired = list(self.retired)
+
+            try:
+                if batch:
+                    with self.app.app_context():
+                        apply(batch)
+            except Exception:
+                # Keep the intents (newer toggles win) and their journals
+                with self.lock:
+                    for key, intent in pending.items():
+                        self.pending.setdefault(key, intent)
+                raise
+
+            with self.lock:
+                self.retired = [journal for journal in self.retired
+                                if journal not in retired]
+
+            for journal in retired:
+                _discard(journal)
+
+            return len(batch)
+
+    def recover(self):
+        """Replay the journals of workers that died before flushing them."""
+
+        replayed = 0
+
+        for path in sorted(glob.glob(os.path.join(self.directory, "likes-*.journal"))):
+            try:
+                journal = open(path, "r+")
+            except FileNotFoundError:
+                continue
+
+            try:
+                fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Its worker is alive
+                journal.close()
+                continue
+
+            batch = {}
+            for line in journal:
+                try:
+                    user_id, message_id, liked, at = json.loads(line)
+                except ValueError:
+                    # Torn last line from the crash
+                    continue
+                batch[(user_id, message_id)] = (liked, datetime.fromisoformat(at))
+
+            if batch:
+                with self.app.app_context():
+                    apply(batch)
+
+            log.info("Replayed %d like intent(s) from %s", len(batch), path)
+            replayed += len(batch)
+            _discard(journal)
+
+        return replayed
+
+    def stop(self):
+        """Stop the flush thread and flush what's left."""
+
+        self.interval = None
+        self.wake.set()
+        self.flush()
+
+    def _start(self):
+        """Recover and start flushing, once per process."""
+
+        if self.pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            # Anything inherited across a fork belongs to the parent
+            self.pid = os.getpid()
+            self.pending = {}
+            self.journal = None
+            self.retired = []
+
+        try:
+            self.recover()
+        except Exception:
+            log.exception("Couldn't replay like journals")
+
+        if self.interval is not None:
+            threading.Thread(target=self._run, name="like-buffer", daemon=True).start()
+
+    def _run(self):
+        while self.interval is not None:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Couldn't flush buffered likes; will retry")
+
+    def _write_journal(self, user_id, message_id, liked, at):
+        if self.journal is None:
+            path = os.path.join(self.directory,
+                                f"likes-{os.getpid()}-{uuid.uuid4().hex}.journal")
+            self.journal = open(path, "a")
+            fcntl.flock(self.journal, fcntl.LOCK_EX)
+
+        self.journal.write(json.dumps([user_id, message_id, liked, at.isoformat()]) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+
+def _discard(journal):
+    os.unlink(journal.name)
+    journal.close()
+
+
+def apply(batch):
+    """Make likes match `batch` ({(user id, message id): (liked, when)}) and commit.
+
+    Keeps like counts and trending scores in step, for the changes that
+    were actually needed.
+    """
+
+    user_ids = {user_id for user_id, _ in batch}
+    message_ids = {message_id for _, message_id in batch}
+
+    existing = {(user_id, message_id): (like_id, liked_at)
+                for like_id, user_id, message_id, liked_at
+                in (db.session
+                    .query(Likes.id, Likes.user_id, Likes.message_id, Likes.timestamp)
+                    .filter(Likes.user_id.in_(user_ids),
+                            Likes.message_id.in_(message_ids)))}
+
+    # Skip likes of messages and by users that have gone in the meantime
+    live_users = {id for (id,) in db.session.query(User.id).filter(User.id.in_(user_ids))}
+    live_messages = {id for (id,) in (db.session
+                                      .query(Message.id)
+                                      .filter(Message.id.in_(message_ids)))}
+
+    added = [{"user_id": user_id, "message_id": message_id, "timestamp": at}
+             for (user_id, message_id), (liked, at) in batch.items()
+             if liked and (user_id, message_id) not in existing
+             and user_id in live_users and message_id in live_messages]
+    removed = [(key[1], existing[key]) for key, (liked, _) in batch.items()
+               if not liked and key in existing]
+
+    for start in range(0, len(added), INSERT_CHUNK):
+        db.session.execute(Likes.__table__.insert().values(added[start:start + INSERT_CHUNK]))
+
+    if removed:
+        db.session.execute(Likes.__table__.delete().where(
+            Likes.id.in_([like_id for _, (like_id, _) in removed])))
+
+    deltas = Counter()
+    scores = {}
+
+    for row in added:
+        deltas[row["message_id"]] += 1
+        scores[row["message_id"]] = trending.record_like(row["message_id"], row["timestamp"])
+
+    for message_id, (_, liked_at) in removed:
+        deltas[message_id] -= 1
+        scores[message_id] = trending.record_unlike(message_id, liked_at)
+
+    for message_id, delta in deltas.items():
+        if delta:
+            message_stats.bump(message_id, "likes", delta)
+
+    outbox.emit_many("like.created", [{"user_id": row["user_id"], "message_id": row["message_id"]}
+                                      for row in added])
+    outbox.emit_many("like.deleted", [{"user_id": user_id, "message_id": message_id}
+                                      for (user_id, message_id), (liked, _) in batch.items()
+                                      if not liked and (user_id, message_id) in existing])
+
+    db.session.commit()
+
+    board = current_app.extensions['trending']
+    for message_id, log_score in scores.items():
+        board.update(message_id, log_score)
+
+
+def overlay(user_id, liked_ids, stats):
+    """Apply the user's buffered toggles to their liked ids and like counts.
+
+    Returns the liked ids as a set; `stats` is updated in place.
+    """
+
+    liked_ids = set(liked_ids)
+    buffer = current_app.extensions.get('like_buffer')
+    if buffer is None:
+        return liked_ids
+
+    for message_id, liked in buffer.pending_for(user_id).items():
+        if liked:
+            liked_ids.add(message_id)
+        else:
+            liked_ids.discard(message_id)
+
+        if message_id in stats:
+            counts = stats[message_id]
+            stats[message_id] = counts._replace(likes=counts.likes + (1 if liked else -1))
+
+    return liked_ids
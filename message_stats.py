@@ -0,0 +1,149 @@
+"""Per-message counters (likes; replies and reshares later).
+
+Counting likes per message with COUNT(*) would cost a query per message
+on every page, so each message has a `message_stats` row that is bumped
+in the same transaction as the change it counts:
+
+    message_stats.bump(message.id, "likes", 1)
+
+Pages fetch the counters for all their messages in one query:
+
+    stats = message_stats.get_many(ids)
+    stats[id].likes
+
+If the counters drift (a bug, a manual fix in the database), the
+`reconcile_message_stats` job recounts them from the source tables a
+batch of messages at a time and corrects any that are wrong. Queue it
+with:
+
+    flask stats-reconcile
+"""
+
+import logging
+from collections import namedtuple
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from deletion import purge_hook
+from metrics import metrics
+from models import db, Likes, Message, MessageStats
+import jobs
+
+RECONCILE_BATCH = 1000
+
+log = logging.getLogger(__name__)
+
+Stats = namedtuple("Stats", "likes replies reshares")
+EMPTY = Stats(0, 0, 0)
+
+
+def bump(message_id, counter, amount):
+    """Add `amount` to one of a message's counters. The caller commits."""
+
+    column = getattr(MessageStats, counter)
+
+    if _update(message_id, column, amount):
+        return
+
+    # No row yet; there's nothing to take away from
+    if amount <= 0:
+        return
+
+    try:
+        with db.session.begin_nested():
+            db.session.add(MessageStats(message_id=message_id, **{counter: amount}))
+    except IntegrityError:
+        # Someone else added the row first
+        _update(message_id, column, amount)
+
+
+def _update(message_id, column, amount):
+    return (MessageStats.query
+            .filter(MessageStats.message_id == message_id)
+            .update({column: column + amount}, synchronize_session=False))
+
+
+def get_many(ids):
+    """Return {id: Stats} for every id, with zeros for untouched messages."""
+
+    ids = list(ids)
+    stats = dict.fromkeys(ids, EMPTY)
+
+    if ids:
+        rows = db.session.execute(select_many(ids))
+        stats.update((message_id, Stats(*counters)) for message_id, *counters in rows)
+
+    return stats
+
+
+def select_many(ids):
+    """A Core SELECT of message_id and the counters, in `Stats` order, for `ids`."""
+
+    table = MessageStats.__table__
+    return (select([table.c.message_id, table.c.likes, table.c.replies, table.c.reshares])
+            .where(table.c.message_id.in_(ids)))
+
+
+@jobs.job("reconcile_message_stats")
+def reconcile(after_id=0):
+    """Recount likes for the next batch of messages and fix any drift."""
+
+    ids = [id for (id,) in (db.session
+                            .query(Message.id)
+                            .filter(Message.id > after_id)
+                            .order_by(Message.id)
+                            .limit(RECONCILE_BATCH))]
+    if not ids:
+        return
+
+    # Lock the counters first, so likes in flight either finish before we
+    # count or bump after we've written
+    rows = {row.message_id: row
+            for row in (MessageStats.query
+                        .filter(MessageStats.message_id.in_(ids))
+                        .with_for_update())}
+
+    counts = dict(db.session
+                  .query(Likes.message_id, func.count(Likes.id))
+                  .filter(Likes.message_id.in_(ids))
+                  .group_by(Likes.message_id))
+
+    fixed = 0
+    for message_id in ids:
+        actual = counts.get(message_id, 0)
+        row = rows.get(message_id)
+
+        if row is None and actual:
+            db.session.add(MessageStats(message_id=message_id, likes=actual))
+        elif row is not None and row.likes != actual:
+            row.likes = actual
+        else:
+            continue
+
+        fixed += 1
+
+    if fixed:
+        log.warning("Corrected like counts of %d message(s) after id %d", fixed, after_id)
+        metrics.inc("warbler_message_stats_drift_total", amount=fixed)
+
+    if len(ids) == RECONCILE_BATCH:
+        jobs.enqueue("reconcile_message_stats", {"after_id": ids[-1]})
+
+    db.session.commit()
+
+
+@purge_hook("likes")
+def forget_purged_likes(user_id, ids):
+    for message_id, count in (db.session
+                              .query(Likes.message_id, func.count(Likes.id))
+                              .filter(Likes.id.in_(ids))
+                              .group_by(Likes.message_id)):
+        bump(message_id, "likes", -count)
+
+
+@purge_hook("messages")
+def forget_purged_messages(user_id, ids):
+    (MessageStats.query
+     .filter(MessageStats.message_id.in_(ids))
+     .delete(synchronize_session=False))
@@ -0,0 +1,358 @@
+"""Prometheus-style metrics for Warbler.
+
+Every worker records into plain in-memory dicts, which costs a few
+microseconds per request. When METRICS_DIR is set, each worker also dumps
+its values to `<METRICS_DIR>/metrics-<pid>.json` (at most once every
+`flush_interval` seconds, and whenever it serves a scrape). `/metrics`
+merges the files of all workers, so the numbers are right no matter which
+pre-forked worker answers the scrape:
+
+- counters and histograms are summed over every file, including those of
+  workers that have exited, so totals never go backwards;
+- gauges are summed over live workers only, except those in MAX_GAUGES
+  (boot times, which every worker measures for itself), which take the
+  largest live value.
+
+Clear METRICS_DIR when the server (re)starts, as with Prometheus' own
+multiprocess mode.
+
+Recorded:
+
+    warbler_http_requests_in_flight          gauge
+    warbler_http_request_duration_seconds    histogram {endpoint, method, status}
+    warbler_sql_queries_total                counter {endpoint}
+    warbler_sql_query_seconds_total          counter {endpoint}
+    warbler_db_pool_connections              gauge {state}
+    warbler_bcrypt_in_progress               gauge
+    warbler_bcrypt_seconds                   histogram {operation}
+    warbler_cache_requests_total             counter {cache, result}
+    warbler_boot_seconds                     gauge {phase}
+    warbler_message_stats_drift_total        counter
+    warbler_timeline_reads_total             counter {tier}
+    warbler_rate_limited_total               counter {endpoint, scope}
+    warbler_requests_shed_total              counter {priority}
+    warbler_admission_limit                  gauge
+    warbler_image_requests_total             counter {result}
+    warbler_availability_checks_total        counter {answer}
+    warbler_outbox_lag_events                gauge {consumer}
+    warbler_outbox_failures_total            counter {consumer}
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+# Gauges merged across workers by taking the largest live value, not the sum
+MAX_GAUGES = {"warbler_boot_seconds"}
+
+HELP = {
+    "warbler_http_requests_in_flight": "Requests currently being served.",
+    "warbler_http_request_duration_seconds": "Time to serve a request.",
+    "warbler_sql_queries_total": "SQL statements executed.",
+    "warbler_sql_query_seconds_total": "Time spent executing SQL statements.",
+    "warbler_db_pool_connections": "Database pool connections by state.",
+    "warbler_bcrypt_in_progress": "Password hashes being computed right now.",
+    "warbler_bcrypt_seconds": "Time to hash or check a password.",
+    "warbler_cache_requests_total": "Cache lookups by result.",
+    "warbler_boot_seconds": "Time to import the app, create it and serve its first request.",
+    "warbler_message_stats_drift_total": "Message counters corrected by reconciliation.",
+    "warbler_timeline_reads_total": "Timeline queries by tier (hot or archive).",
+    "warbler_rate_limited_total": "Requests refused with 429 by a rate limit.",
+    "warbler_requests_shed_total": "Requests refused with 503 by the concurrency limit.",
+    "warbler_admission_limit": "Adaptive concurrency limit, summed over workers.",
+    "warbler_image_requests_total": "Image proxy requests by result (hit, miss or error).",
+    "warbler_availability_checks_total": "Username and email checks by what answered them (filter, index or database).",
+    "warbler_outbox_lag_events": "Outbox events a consumer has yet to read.",
+    "warbler_outbox_failures_total": "Outbox consumer batches that failed and were rolled back.",
+}
+
+
+class Metrics:
+    """A process-local metrics registry with optional file-backed sharing."""
+
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.last_flush = 0.0
+        self.engine_getter = None
+        self.served_first_request = False
+
+    def init_app(self, app, engine_getter=None):
+        """Record request, SQL and pool metrics for `app`.
+
+        `engine_getter` returns the SQLAlchemy engine whose pool to report.
+        """
+
+        self.directory = app.config.get('METRICS_DIR', self.directory)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+        self.engine_getter = engine_getter
+
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+
+        if not event.contains(Engine, "before_cursor_execute", self.before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", self.before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", self.after_cursor_execute)
+            event.listen(Engine, "handle_error", self.handle_error)
+
+    ##########################################################################
+    # Recording
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, labels=(), value=0):
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def add(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, labels, value, buckets=DEFAULT_BUCKETS):
+        key = (name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                # One slot per bucket, one for +Inf, then the sum
+                hist = self.histograms[key] = [0] * (len(buckets) + 2)
+            hist[bisect_left(buckets, value)] += 1
+            hist[-1] += value
+
+    def cache_lookup(self, cache, hit):
+        """Record a cache hit or miss."""
+
+        self.inc("warbler_cache_requests_total",
+                 (("cache", cache), ("result", "hit" if hit else "miss")))
+
+    @contextmanager
+    def track_bcrypt(self, operation):
+        """Count a password hash as in progress while the block runs."""
+
+        self.add("warbler_bcrypt_in_progress")
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add("warbler_bcrypt_in_progress", amount=-1)
+            self.observe("warbler_bcrypt_seconds", (("operation", operation),),
+                         time.perf_counter() - started)
+
+    ##########################################################################
+    # Flask and SQLAlchemy hooks
+
+    def before_request(self):
+        g.metrics_started = time.perf_counter()
+        self.add("warbler_http_requests_in_flight")
+
+    def after_request(self, response):
+        started = g.get("metrics_started")
+        if started is None:
+            return response
+
+        took = time.perf_counter() - started
+        self.observe("warbler_http_request_duration_seconds",
+                     (("endpoint", request.endpoint or "none"),
+                      ("method", request.method),
+                      ("status", str(response.status_code))),
+                     took)
+
+        # The first request pays for connecting and compiling templates
+        if not self.served_first_request:
+            self.served_first_request = True
+            self.set("warbler_boot_seconds", (("phase", "first_request"),), took)
+
+        return response
+
+    def teardown_request(self, exc):
+        # Only requests counted in by before_request; one refused by an
+        # earlier hook never was
+        if g.pop("metrics_started", None) is not None:
+            self.add("warbler_http_requests_in_flight", amount=-1)
+
+        if self.directory and time.monotonic() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context,
+                             executemany):
+        took = time.perf_counter() - conn.info["metrics_started"].pop()
+        endpoint = (request.endpoint or "none") if has_request_context() else "none"
+        labels = (("endpoint", endpoint),)
+
+        with self.lock:
+            key = ("warbler_sql_queries_total", labels)
+            self.counters[key] = self.counters.get(key, 0) + 1
+            key = ("warbler_sql_query_seconds_total", labels)
+            self.counters[key] = self.counters.get(key, 0) + took
+
+    def handle_error(self, context):
+        # A statement that raises never reaches after_cursor_execute; drop its
+        # start time so it doesn't stay on the pooled connection. Errors
+        # raised before there is an execution context never recorded one.
+        if context.connection is None or context.execution_context is None:
+            return
+        started = context.connection.info.get("metrics_started")
+        if started:
+            started.pop()
+
+    def record_pool(self):
+        """Sample connection pool usage into gauges."""
+
+        engine = self.engine_getter() if self.engine_getter else None
+        pool = getattr(engine, "pool", None)
+
+        for state, method in (("checked_out", "checkedout"),
+                              ("checked_in", "checkedin"),
+                              ("overflow", "overflow"),
+                              ("size", "size")):
+            if hasattr(pool, method):
+                self.set("warbler_db_pool_connections", (("state", state),),
+                         getattr(pool, method)())
+
+    ##########################################################################
+    # Sharing between processes
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "pid": os.getpid(),
+                "counters": [[n, list(l), v] for (n, l), v in self.counters.items()],
+                "gauges": [[n, list(l), v] for (n, l), v in self.gauges.items()],
+                "histograms": [[n, list(l), list(v)]
+                               for (n, l), v in self.histograms.items()],
+            }
+
+    def flush(self):
+        """Write this process's values to METRICS_DIR."""
+
+        self.last_flush = time.monotonic()
+        self.record_pool()
+
+        data = json.dumps(self.snapshot())
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".metrics-")
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(self.directory, f"metrics-{os.getpid()}.json"))
+
+    def collect(self):
+        """Merge the values of every worker into one snapshot."""
+
+        if not self.directory:
+            self.record_pool()
+            return [self.snapshot()]
+
+        self.flush()
+        snapshots = []
+
+        for name in os.listdir(self.directory):
+            if not (name.startswith("metrics-") and name.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+        return snapshots
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+
+        counters, gauges, histograms = {}, {}, {}
+
+        for snap in self.collect():
+            live = _alive(snap["pid"])
+
+            for name, labels, value in snap["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+
+            for name, labels, value in snap["gauges"]:
+                key = (name, tuple(map(tuple, labels)))
+                value = value if live else 0
+                if name in MAX_GAUGES:
+                    gauges[key] = max(gauges.get(key, 0), value)
+                else:
+                    gauges[key] = gauges.get(key, 0) + value
+
+            for name, labels, values in snap["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    merged[i] += value
+
+        lines = []
+        for kind, series in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({n for n, _ in series}):
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (n, labels), value in sorted(series.items()):
+                    if n == name:
+                        lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+        for name in sorted({n for n, _ in histograms}):
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), values in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(DEFAULT_BUCKETS + ("+Inf",), values[:-1]):
+                    cumulative += count
+                    le = (("le", str(bound)),)
+                    lines.append(f"{name}_bucket{_labels(labels + le)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(values[-1])}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
@@ -5,6 +5,8 @@ from datetime import datetime
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 
+from metrics import metrics
+
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
@@ -13,6 +15,10 @@ class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
+    __table_args__ = (
+        # The primary key serves "who follows X"; this serves "whom does X follow"
+        db.Index('ix_follows_user_following_id', 'user_following_id', 'user_being_followed_id'),
+    )
 
     user_being_followed_id = db.Column(
         db.Integer,
@@ -31,6 +37,10 @@ class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
+    __table_args__ = (
+        # A user's likes, in the order they were made
+        db.Index('ix_likes_user_id_id', 'user_id', 'id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -45,6 +55,13 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
+        index=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
     )
 
 
@@ -93,20 +110,37 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Set when the account is deleted; the rows are purged later, in the
+    # background, and the user is hidden from every read until then.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # Unread rows in `notifications`, kept by notifications.py, so the nav
+    # bar can show it from the row add_user_to_g loads anyway
+    unread_notifications = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=db.and_(Follows.user_following_id == id,
+                              deleted_at.is_(None))
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=db.and_(Follows.user_being_followed_id == id,
+                              deleted_at.is_(None))
     )
 
     likes = db.relationship(
@@ -136,7 +170,8 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        with metrics.track_bcrypt("hash"):
+            hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
 
         user = User(
             username=username,
@@ -159,10 +194,11 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            with metrics.track_bcrypt("check"):
+                is_auth = bcrypt.check_password_hash(user.password, password)
             if is_auth:
                 return user
 
@@ -173,6 +209,10 @@ class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        # Timelines older than the hot window are read from here
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -187,7 +227,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,11 +239,459 @@ class Message(db.Model):
     user = db.relationship('User')
 
 
+class HotMessage(db.Model):
+    """A recent message in the hot timeline partition (see hot_messages.py)."""
+
+    __tablename__ = 'messages_hot'
+    __table_args__ = (
+        db.Index('ix_messages_hot_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        index=True,
+    )
+
+
+class Tag(db.Model):
+    """A hashtag, with the number of messages using it; see tagging.py."""
+
+    __tablename__ = 'tags'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.String(50),
+        nullable=False,
+        unique=True,
+    )
+
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class MessageTag(db.Model):
+    """A hashtag used in a message.
+
+    Keyed by (tag, message) so a tag's timeline is one index range scan.
+    """
+
+    __tablename__ = 'message_tags'
+
+    tag_id = db.Column(
+        db.Integer,
+        db.ForeignKey('tags.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+        index=True,
+    )
+
+
+class Mention(db.Model):
+    """A user @mentioned in a message, keyed like MessageTag."""
+
+    __tablename__ = 'mentions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+        index=True,
+    )
+
+
+class MessageStats(db.Model):
+    """Counters for a message, kept up to date as they change; see message_stats.py."""
+
+    __tablename__ = 'message_stats'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    likes = db.Column(db.Integer, nullable=False, default=0)
+
+    replies = db.Column(db.Integer, nullable=False, default=0)
+
+    reshares = db.Column(db.Integer, nullable=False, default=0)
+
+
+class UserGraphStats(db.Model):
+    """Follow-graph metrics for a user, computed in batch; see graph_stats.py."""
+
+    __tablename__ = 'user_graph_stats'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    followers = db.Column(db.Integer, nullable=False)
+
+    following = db.Column(db.Integer, nullable=False)
+
+    mutuals = db.Column(db.Integer, nullable=False)
+
+    # Mutual follows as a share of the users this user follows
+    reciprocity = db.Column(db.Float, nullable=False)
+
+    # PageRank, scaled so the average user has 1
+    influence = db.Column(db.Float, nullable=False, index=True)
+
+    # Id of a user in the same mutual-follow community
+    cluster = db.Column(db.Integer, nullable=False, index=True)
+
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+
+class MessageScore(db.Model):
+    """A message's time-decayed like score; see trending.py."""
+
+    __tablename__ = 'message_scores'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    log_score = db.Column(
+        db.Float,
+        nullable=False,
+        index=True,
+    )
+
+
+class Job(db.Model):
+    """A unit of background work, queued in the database.
+
+    Jobs are claimed by workers with a lease (`locked_until`); a job whose
+    lease runs out before it finishes is handed to another worker, so
+    handlers must be safe to run more than once.
+    """
+
+    __tablename__ = 'jobs'
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+        default="{}",
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default="queued",
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    idempotency_key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_by = db.Column(
+        db.Text,
+    )
+
+    locked_until = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.name}, {self.status}>"
+
+
+class UserDeletion(db.Model):
+    """Progress of purging a deleted user's rows in the background."""
+
+    __tablename__ = 'user_deletions'
+
+    # Not a foreign key: this row outlives the user it describes
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    stage = db.Column(
+        db.Text,
+        nullable=False,
+        default="likes",
+    )
+
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    def __repr__(self):
+        return f"<UserDeletion #{self.user_id}: {self.stage}, {self.rows_deleted} rows>"
+
+
+class OutboxEvent(db.Model):
+    """A change, written in the same commit as the change; see outbox.py."""
+
+    __tablename__ = 'outbox_events'
+
+    # Consumers read events in id order and remember the last id they saw
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    topic = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+        default="{}",
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    def __repr__(self):
+        return f"<OutboxEvent #{self.id}: {self.topic}>"
+
+
+class OutboxOffset(db.Model):
+    """How far an outbox consumer has read."""
+
+    __tablename__ = 'outbox_offsets'
+
+    consumer = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    position = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class Notification(db.Model):
+    """Likes of a user's message, or new followers, since they last looked.
+
+    A burst of them is one row, updated in place; see notifications.py.
+    """
+
+    __tablename__ = 'notifications'
+
+    __table_args__ = (
+        db.Index('ix_notifications_user_id_updated_at', 'user_id', 'updated_at', 'id'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # Who is notified
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    # "like" or "follow"
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # The liked message. Not a foreign key: rows for deleted messages are
+    # removed by the consumer, which keeps the unread counts right
+    message_id = db.Column(
+        db.Integer,
+        index=True,
+    )
+
+    # The latest user to like or follow; all of them are in notification_actors
+    actor_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # How many users liked or followed, each counted once
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    read = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        index=True,
+    )
+
+    def __repr__(self):
+        return f"<Notification #{self.id}: {self.kind} x{self.count} for user {self.user_id}>"
+
+
+class NotificationActor(db.Model):
+    """A user who liked or followed, counted in a notification.
+
+    Keyed by (notification, actor) so each user counts once per row.
+    """
+
+    __tablename__ = 'notification_actors'
+
+    notification_id = db.Column(
+        db.Integer,
+        db.ForeignKey('notifications.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+
+class DailyActivity(db.Model):
+    """Events per day and topic, projected from the outbox; see activity.py."""
+
+    __tablename__ = 'daily_activity'
+
+    day = db.Column(
+        db.Date,
+        primary_key=True,
+    )
+
+    topic = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    You should call this in your Flask app. Outside of a request, push an
+    app context before using the database.
     """
 
-    db.app = app
     db.init_app(app)
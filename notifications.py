@@ -0,0 +1,261 @@
+"""Notifications of likes and new followers, aggregated as they arrive.
+
+The `notifications` outbox consumer turns `like.created` and
+`follow.created` events (see outbox.py) into rows of `notifications`.
+Bursts collapse into one row, updated in place: a like joins the
+recipient's unread row for the same message, and a follow their unread
+follow row, if that row changed within AGGREGATE_WINDOW; otherwise it
+starts a new row. So a popular warble makes one "alice and 11 others
+liked your warble", not twelve rows. `notification_actors` holds who
+each row counts, so a user is counted once however often they come back.
+
+Each user's `users.unread_notifications` counts their unread rows. The
+consumer adds to it in the transaction that creates them and
+`mark_read()` zeroes it, so the nav bar shows it from the row
+add_user_to_g loads anyway, with no query of its own.
+
+Pages are read latest first, a cursor at a time:
+
+    rows, before = notifications.page(user.id, request.args.get('before'))
+
+Rows of a deleted message go when its `message.deleted` event comes
+through, a user's own rows when they delete their account, and rows not
+updated for RETENTION with the daily `notifications_prune` job. Undoing
+a like or follow leaves its notification be. Rebuild everything from the
+retained events with:
+
+    flask outbox-replay notifications
+"""
+
+from collections import Counter
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from sqlalchemy import and_, func, or_
+
+from models import db, Message, Notification, NotificationActor, User
+import hydration
+import jobs
+import outbox
+
+AGGREGATE_WINDOW = timedelta(hours=24)
+RETENTION = timedelta(days=90)
+PAGE_SIZE = 20
+PRUNE_BATCH = 1000
+
+CURSOR_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+def clear():
+    NotificationActor.query.delete(synchronize_session=False)
+    Notification.query.delete(synchronize_session=False)
+    (User.query
+     .filter(User.unread_notifications != 0)
+     .update({User.unread_notifications: 0}, synchronize_session=False))
+
+
+@outbox.consumer("notifications", reset=clear,
+                 topics={"like.created", "follow.created", "message.deleted", "user.deleted"})
+def notify(events):
+    liked = {event.payload["message_id"] for event in events if event.topic == "like.created"}
+    authors = dict(db.session
+                   .query(Message.id, Message.user_id)
+                   .filter(Message.id.in_(liked))) if liked else {}
+
+    # (recipient, kind, message id, actor, time) for each like and follow
+    notices = []
+    for event in events:
+        if event.topic == "like.created":
+            author = authors.get(event.payload["message_id"])
+            if author is not None and author != event.payload["user_id"]:
+                notices.append((author, "like", event.payload["message_id"],
+                                event.payload["user_id"], event.created_at))
+
+        elif event.topic == "follow.created":
+            notices.append((event.payload["followed_id"], "follow", None,
+                            event.payload["follower_id"], event.created_at))
+
+    if notices:
+        _aggregate(notices)
+
+    # Messages deleted after they were liked; anything liked after its
+    # message was deleted has no author above
+    deleted = {event.payload["message_id"] for event in events
+               if event.topic == "message.deleted"}
+    if deleted:
+        _delete(Notification.query.filter(Notification.message_id.in_(deleted)))
+
+    gone = {event.payload["user_id"] for event in events if event.topic == "user.deleted"}
+    if gone:
+        _delete(Notification.query.filter(Notification.user_id.in_(gone)))
+
+
+def _aggregate(notices):
+    """Fold each notice into its open row, or start one. The caller commits."""
+
+    since = min(at for *_, at in notices) - AGGREGATE_WINDOW
+    open_rows = {}
+    for row in (Notification
+                .query
+                .filter(Notification.user_id.in_({user_id for user_id, *_ in notices}),
+                        Notification.read.is_(False),
+                        Notification.updated_at >= since)
+                .order_by(Notification.updated_at)):
+        open_rows[row.user_id, row.kind, row.message_id] = row
+
+    # Who each open row already counts, by row
+    actors = {row: set() for row in open_rows.values()}
+    ids = {row.id: row for row in open_rows.values()}
+    if ids:
+        for id, actor_id in (db.session
+                             .query(NotificationActor.notification_id, NotificationActor.actor_id)
+                             .filter(NotificationActor.notification_id.in_(ids))):
+            actors[ids[id]].add(actor_id)
+
+    started = Counter()
+    added = []
+    for user_id, kind, message_id, actor_id, at in notices:
+        row = open_rows.get((user_id, kind, message_id))
+
+        if row is not None and row.updated_at >= at - AGGREGATE_WINDOW:
+            # Each user counts once, however often they like, unlike and like again
+            if actor_id not in actors[row]:
+                actors[row].add(actor_id)
+                added.append((row, actor_id))
+                row.count += 1
+            row.actor_id = actor_id
+            row.updated_at = max(row.updated_at, at)
+        else:
+            row = Notification(user_id=user_id, kind=kind, message_id=message_id,
+                               actor_id=actor_id, count=1, read=False,
+                               created_at=at, updated_at=at)
+            db.session.add(row)
+            open_rows[user_id, kind, message_id] = row
+            actors[row] = {actor_id}
+            added.append((row, actor_id))
+            started[user_id] += 1
+
+    for user_id, n in started.items():
+        _add_unread(user_id, n)
+
+    # Every row needs its id first
+    db.session.flush()
+    db.session.bulk_insert_mappings(NotificationActor, [
+        {"notification_id": row.id, "actor_id": actor_id} for row, actor_id in added])
+
+
+def _delete(query):
+    """Delete the notifications `query` selects, taking unread ones off the counts."""
+
+    ids = [id for (id,) in query.with_entities(Notification.id)]
+    if not ids:
+        return 0
+
+    for user_id, n in (db.session
+                       .query(Notification.user_id, func.count(Notification.id))
+                       .filter(Notification.id.in_(ids), Notification.read.is_(False))
+                       .group_by(Notification.user_id)):
+        _add_unread(user_id, -n)
+
+    (NotificationActor.query
+     .filter(NotificationActor.notification_id.in_(ids))
+     .delete(synchronize_session=False))
+    return (Notification.query
+            .filter(Notification.id.in_(ids))
+            .delete(synchronize_session=False))
+
+
+def _add_unread(user_id, n):
+    (User.query
+     .filter(User.id == user_id)
+     .update({User.unread_notifications: User.unread_notifications + n},
+             synchronize_session=False))
+
+
+def mark_read(user):
+    """Mark all of `user`'s notifications read. The caller commits."""
+
+    # The user's row first: the consumer writes it after adding rows, so
+    # a row it adds meanwhile is either marked read here or counted after
+    (User.query
+     .filter(User.id == user.id)
+     .update({User.unread_notifications: 0}, synchronize_session="evaluate"))
+    (Notification.query
+     .filter(Notification.user_id == user.id, Notification.read.is_(False))
+     .update({Notification.read: True}, synchronize_session=False))
+
+
+##############################################################################
+# Reading
+
+
+def page(user_id, before=None, limit=PAGE_SIZE):
+    """A user's notifications, latest first, after cursor `before`.
+
+    Returns (rows, the `before` for the next page or None). Raises
+    ValueError for a malformed cursor.
+    """
+
+    query = Notification.query.filter(Notification.user_id == user_id)
+    if before:
+        at, id = parse_cursor(before)
+        query = query.filter(or_(Notification.updated_at < at,
+                                 and_(Notification.updated_at == at, Notification.id < id)))
+
+    rows = (query
+            .order_by(Notification.updated_at.desc(), Notification.id.desc())
+            .limit(limit + 1)
+            .all())
+
+    if len(rows) > limit:
+        return rows[:limit], cursor(rows[limit - 1])
+    return rows, None
+
+
+def cursor(row):
+    return f"{row.updated_at:{CURSOR_FORMAT}}-{row.id}"
+
+
+def parse_cursor(value):
+    at, _, id = value.partition("-")
+    return datetime.strptime(at, CURSOR_FORMAT), int(id)
+
+
+def cards(rows):
+    """What the page shows of each row, with its latest actor and message.
+
+    Actors who have since been deleted show as None; rows whose message
+    is gone are left out.
+    """
+
+    actors = hydration.get_users({row.actor_id for row in rows})
+    messages = {msg.id: msg for msg in hydration.hydrate_messages(
+        [row.message_id for row in rows if row.message_id is not None])}
+
+    return [SimpleNamespace(id=row.id, kind=row.kind, count=row.count, read=row.read,
+                            updated_at=row.updated_at, actor=actors.get(row.actor_id),
+                            message=messages.get(row.message_id))
+            for row in rows
+            if row.message_id is None or row.message_id in messages]
+
+
+##############################################################################
+# Retention
+
+
+@jobs.job("notifications_prune", every=timedelta(days=1))
+def prune():
+    """Delete notifications that haven't changed for RETENTION."""
+
+    cutoff = datetime.utcnow() - RETENTION
+
+    while True:
+        ids = [id for (id,) in (db.session
+                                .query(Notification.id)
+                                .filter(Notification.updated_at < cutoff)
+                                .limit(PRUNE_BATCH))]
+        if not ids:
+            return
+
+        _delete(Notification.query.filter(Notification.id.in_(ids)))
+        db.session.commit()
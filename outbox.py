@@ -0,0 +1,299 @@
+"""A transactional outbox of changes, and consumers that follow it.
+
+Views record what they changed as events in the `outbox_events` table,
+in the same transaction as the change itself:
+
+    outbox.emit("follow.created", follower_id=g.user.id, followed_id=user.id)
+    db.session.commit()
+
+so an event is published if and only if its change is committed. Topics:
+
+    user.created     user.updated     user.deleted
+    message.created  message.deleted
+    follow.created   follow.deleted
+    like.created     like.deleted
+
+Rows removed by an account purge are published too, from purge hooks.
+
+Read-side structures (counters, feeds, indexes) are kept by consumers,
+which get the events in order, a batch at a time, off the request path:
+
+    @outbox.consumer("follower_counts", topics={"follow.created", "follow.deleted"},
+                     reset=clear_counts)
+    def count(events):
+        for event in events:
+            ...event.topic, event.payload, event.created_at...
+
+Each consumer's position is kept in `outbox_offsets` and advanced in the
+same transaction as the consumer's own writes, so a projection in the
+database sees every event exactly once. A failing batch is rolled back
+and retried. `replay()` calls the consumer's `reset` and starts it again
+from the first retained event, to rebuild a projection.
+
+Events are retained for RETENTION, and then until every registered
+consumer has read them: the daily `outbox_prune` job deletes those older
+than that and below the lowest offset. A consumer that has never run
+holds everything back until it does.
+
+Ids are handed out when an event is inserted but become visible when its
+transaction commits, so a consumer can see id 12 before id 11. When a
+batch has a hole, the consumer stops before it until OUTBOX_GAP_GRACE
+has passed since the event after it was written; by then the missing
+event was rolled back (its id is never used) or is visible. Transactions
+that emit events should take less than that to commit.
+
+Run the consumers with:
+
+    flask outbox-consume
+"""
+
+import json
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, or_
+
+from deletion import purge_hook
+from metrics import metrics
+from models import db, Follows, Likes, OutboxEvent, OutboxOffset
+import jobs
+
+# name -> Consumer
+CONSUMERS = {}
+
+BATCH_SIZE = 500
+GAP_GRACE = timedelta(seconds=10)
+RETENTION = timedelta(days=7)
+PRUNE_BATCH = 1000
+
+Event = namedtuple("Event", "id topic payload created_at")
+Consumer = namedtuple("Consumer", "name fn topics batch_size reset")
+
+log = logging.getLogger(__name__)
+
+
+class UnknownConsumerError(LookupError):
+    """Raised for a consumer name that isn't registered."""
+
+
+def emit(topic, **payload):
+    """Add an event to the current session. The caller commits."""
+
+    db.session.add(OutboxEvent(topic=topic, payload=json.dumps(payload)))
+
+
+def emit_many(topic, payloads):
+    """Add an event per payload dict, in one INSERT. The caller commits."""
+
+    now = datetime.utcnow()
+    rows = [{"topic": topic, "payload": json.dumps(payload), "created_at": now}
+            for payload in payloads]
+    if rows:
+        db.session.execute(OutboxEvent.__table__.insert(), rows)
+
+
+def consumer(name, topics=None, batch_size=BATCH_SIZE, reset=None):
+    """Register a function to be called with batches of events.
+
+    `topics` limits the events it gets (default: all). `reset()`, if
+    given, clears its projection before a replay; it runs in the
+    transaction that rewinds the consumer.
+    """
+
+    def register(fn):
+        CONSUMERS[name] = Consumer(name, fn, frozenset(topics or ()), batch_size, reset)
+        return fn
+
+    return register
+
+
+def consume(name, gap_grace=GAP_GRACE, now=None):
+    """Give consumer `name` its next batch of events and commit.
+
+    Returns the number of events it moved past (including ones on other
+    topics); 0 when it has caught up.
+    """
+
+    spec = _consumer(name)
+    now = now or datetime.utcnow()
+
+    offset = _offset(name)
+    rows = (OutboxEvent
+            .query
+            .filter(OutboxEvent.id > offset.position)
+            .order_by(OutboxEvent.id)
+            .limit(spec.batch_size)
+            .all())
+
+    # Stop before a hole that may yet be filled by a transaction in flight
+    batch = []
+    expected = offset.position + 1
+    for row in rows:
+        if row.id != expected and row.created_at > now - gap_grace:
+            break
+        batch.append(row)
+        expected = row.id + 1
+
+    if not batch:
+        db.session.rollback()
+        return 0
+
+    events = [Event(row.id, row.topic, json.loads(row.payload), row.created_at)
+              for row in batch if not spec.topics or row.topic in spec.topics]
+    if events:
+        spec.fn(events)
+
+    offset.position = batch[-1].id
+    offset.updated_at = datetime.utcnow()
+    db.session.commit()
+
+    return len(batch)
+
+
+def replay(name):
+    """Reset consumer `name`'s projection and rewind it to the first event."""
+
+    spec = _consumer(name)
+    offset = _offset(name)
+
+    if spec.reset is not None:
+        spec.reset()
+    offset.position = 0
+    offset.updated_at = datetime.utcnow()
+    db.session.commit()
+
+
+def lag():
+    """{consumer name: events it has yet to read}."""
+
+    latest = db.session.query(func.max(OutboxEvent.id)).scalar() or 0
+    positions = dict(db.session.query(OutboxOffset.consumer, OutboxOffset.position))
+    return {name: latest - positions.get(name, 0) for name in sorted(CONSUMERS)}
+
+
+def _consumer(name):
+    if name not in CONSUMERS:
+        raise UnknownConsumerError(name)
+    return CONSUMERS[name]
+
+
+def _offset(name):
+    """The consumer's offset row, locked until the transaction ends.
+
+    The lock keeps two runners of one consumer from handling a batch
+    twice (SQLite has no row locks, but allows one writer at a time).
+    """
+
+    offset = (OutboxOffset
+              .query
+              .filter_by(consumer=name)
+              .with_for_update()
+              .first())
+    if offset is None:
+        offset = OutboxOffset(consumer=name, position=0)
+        db.session.add(offset)
+        db.session.flush()
+    return offset
+
+
+class Runner:
+    """Feeds every consumer its events until `stop()` is called."""
+
+    def __init__(self, app, names=None, poll_interval=1.0):
+        self.app = app
+        self.names = names or sorted(CONSUMERS)
+        self.poll_interval = poll_interval
+        self.gap_grace = timedelta(seconds=app.config['OUTBOX_GAP_GRACE'])
+        self.stopping = threading.Event()
+
+    def run_once(self):
+        """Bring every consumer up to date; return how many events they moved past."""
+
+        total = 0
+        with self.app.app_context():
+            for name in self.names:
+                while True:
+                    try:
+                        moved = consume(name, self.gap_grace)
+                    except Exception:
+                        db.session.rollback()
+                        log.exception("Outbox consumer %s failed; will retry", name)
+                        metrics.inc("warbler_outbox_failures_total", (("consumer", name),))
+                        break
+                    total += moved
+                    if not moved:
+                        break
+
+            for name, behind in lag().items():
+                metrics.set("warbler_outbox_lag_events", (("consumer", name),), behind)
+
+        return total
+
+    def run(self):
+        while not self.stopping.is_set():
+            if not self.run_once():
+                self.stopping.wait(self.poll_interval)
+
+    def stop(self):
+        self.stopping.set()
+
+
+##############################################################################
+# Retention
+
+
+@jobs.job("outbox_prune", every=timedelta(days=1))
+def prune(now=None):
+    """Delete events older than RETENTION that every consumer has read."""
+
+    positions = dict(db.session.query(OutboxOffset.consumer, OutboxOffset.position))
+    read = min((positions.get(name, 0) for name in CONSUMERS), default=0)
+    cutoff = (now or datetime.utcnow()) - RETENTION
+
+    deleted = 0
+    while True:
+        ids = [id for (id,) in (db.session
+                                .query(OutboxEvent.id)
+                                .filter(OutboxEvent.id <= read,
+                                        OutboxEvent.created_at < cutoff)
+                                .order_by(OutboxEvent.id)
+                                .limit(PRUNE_BATCH))]
+        if not ids:
+            return deleted
+
+        deleted += (OutboxEvent.query
+                    .filter(OutboxEvent.id.in_(ids))
+                    .delete(synchronize_session=False))
+        db.session.commit()
+
+
+##############################################################################
+# Rows removed by account purges
+
+
+@purge_hook("likes")
+@purge_hook("likes_received")
+def publish_purged_likes(user_id, ids):
+    rows = db.session.query(Likes.user_id, Likes.message_id).filter(Likes.id.in_(ids))
+    emit_many("like.deleted", [{"user_id": liker_id, "message_id": message_id}
+                               for liker_id, message_id in rows])
+
+
+@purge_hook("follows")
+def publish_purged_follows(user_id, ids):
+    rows = (db.session
+            .query(Follows.user_following_id, Follows.user_being_followed_id)
+            .filter(or_(db.and_(Follows.user_following_id == user_id,
+                                Follows.user_being_followed_id.in_(ids)),
+                        db.and_(Follows.user_being_followed_id == user_id,
+                                Follows.user_following_id.in_(ids)))))
+    emit_many("follow.deleted", [{"follower_id": follower_id, "followed_id": followed_id}
+                                 for follower_id, followed_id in rows])
+
+
+@purge_hook("messages")
+def publish_purged_messages(user_id, ids):
+    emit_many("message.deleted", [{"message_id": message_id, "user_id": user_id}
+                                  for message_id in ids])
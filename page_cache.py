@@ -0,0 +1,169 @@
+"""Whole responses cached for visitors who aren't logged in.
+
+Anonymous visitors all see the same page at a given URL, so their GETs of
+the endpoints in PAGE_CACHE_TTLS are answered from the cache, keyed by
+path and query string:
+
+    PAGE_CACHE_TTLS = {
+        "warbler.users_show": (10, 60),
+        ...
+    }
+
+An entry is fresh for the first number of seconds; for the second it is
+still served, "stale while revalidate": the first request to find it
+stale takes a refresh lock in the cache, gets the stale copy like
+everyone else, and once its response has been sent re-renders the page
+and stores it. Responses carry `X-Cache: hit`, `stale` or `miss`.
+
+The lookup runs just before `add_user_to_g`, so a hit costs no database
+query and no connection. Requests with a logged-in user or a pending
+flash message skip the cache, and only 200 responses that didn't touch
+the session are stored.
+
+Views tag what a page shows (`page_cache.tag("user:1")`), and the views
+that change it purge those tags (`page_cache.purge("user:1")`), which
+makes every page stored with them stale at once. Bodies are stored
+zlib-compressed; with shm:// an entry must still fit in a cache slot
+(`slot_size`, default 4KiB), so big pages want larger slots or redis://.
+If the cache fails, pages are rendered as if nothing were cached.
+"""
+
+import logging
+import time
+import zlib
+
+from flask import current_app, g, request, session, Response
+
+from cache import CacheError
+
+# Seconds a refresh may take before another request may start one
+REFRESH_TIMEOUT = 30
+
+# Set in the environ of the request that re-renders a stale page
+REFRESH_ENVIRON_KEY = "warbler.page_cache.refresh"
+
+log = logging.getLogger(__name__)
+
+
+class PageCache:
+    """Serves and stores anonymous visitors' pages."""
+
+    def __init__(self, user_key, app=None):
+        """Cache `app`'s pages; `user_key` is the session key holding the user's id."""
+
+        self.user_key = user_key
+        self.ttls = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttls = dict(app.config['PAGE_CACHE_TTLS'])
+
+        app.extensions['page_cache'] = self
+        app.before_request(self.lookup)
+        app.after_request(self.store)
+
+    @property
+    def cache(self):
+        return current_app.extensions['cache'].namespace("pages")
+
+    def lookup(self):
+        """Answer from the cache if this is an anonymous GET of a cached page."""
+
+        if (request.method not in ("GET", "HEAD") or request.endpoint not in self.ttls
+                or self.user_key in session or "_flashes" in session):
+            return None
+
+        key = request.full_path
+        if request.environ.get(REFRESH_ENVIRON_KEY):
+            g.page_key = key
+            return None
+
+        try:
+            entry = self.cache.get(key)
+        except CacheError:
+            log.warning("Page cache unavailable", exc_info=True)
+            return None
+        if entry is None:
+            g.page_key = key
+            return None
+
+        status, headers, body, stored_at = entry
+        fresh, _ = self.ttls[request.endpoint]
+        result = "hit" if time.time() - stored_at < fresh else "stale"
+
+        response = Response(zlib.decompress(body), status=status, headers=headers)
+        response.headers["X-Cache"] = result
+
+        if result == "stale" and self._lock(key):
+            response.call_on_close(self._refresh_later(key, request.host_url))
+
+        return response
+
+    def store(self, response):
+        """Cache this response if `lookup` found it cacheable and it went well."""
+
+        key = g.pop("page_key", None)
+        if (key is None or response.status_code != 200 or response.is_streamed
+                or session.modified or "Set-Cookie" in response.headers):
+            return response
+
+        fresh, stale = self.ttls[request.endpoint]
+        headers = [(name, value) for name, value in response.headers if name != "X-Cache"]
+        entry = (response.status_code, headers, zlib.compress(response.get_data()), time.time())
+
+        try:
+            self.cache.set(key, entry, ttl=fresh + stale, tags=g.pop("page_tags", ()))
+        except CacheError:
+            log.warning("Page cache unavailable", exc_info=True)
+
+        response.headers["X-Cache"] = "miss"
+        return response
+
+    def purge(self, tags):
+        try:
+            self.cache.invalidate_tags(tags)
+        except CacheError:
+            log.warning("Page cache unavailable", exc_info=True)
+
+    def _lock(self, key):
+        try:
+            return self.cache.add(f"refresh:{key}", True, ttl=REFRESH_TIMEOUT)
+        except CacheError:
+            return False
+
+    def _unlock(self, key):
+        try:
+            self.cache.delete(f"refresh:{key}")
+        except CacheError:
+            pass
+
+    def _refresh_later(self, path, base_url):
+        """A function that re-renders `path` with no session, storing the result."""
+
+        app = current_app._get_current_object()
+
+        def refresh():
+            try:
+                with app.test_request_context(path, base_url=base_url,
+                                              environ_overrides={REFRESH_ENVIRON_KEY: True}):
+                    app.full_dispatch_request()
+            except Exception:
+                log.exception("Refreshing %s failed", path)
+            finally:
+                with app.app_context():
+                    self._unlock(path)
+
+        return refresh
+
+
+def tag(*tags):
+    """Mark the page being rendered as showing `tags`, for `purge` to find."""
+
+    g.page_tags = getattr(g, "page_tags", ()) + tags
+
+
+def purge(*tags):
+    """Make every cached page tagged with any of `tags` stale."""
+
+    current_app.extensions['page_cache'].purge(tags)
@@ -0,0 +1,185 @@
+"""On-demand sampling profiler for a running worker.
+
+An admin starts a capture from /admin/profiler, choosing what fraction of
+requests to sample and, optionally, a single endpoint. While the capture
+runs, a background thread wakes every `interval` seconds, looks at the
+stacks of the threads serving the chosen requests and counts them. Nothing
+is traced, so requests that aren't sampled pay one attribute check.
+
+Samples are aggregated as collapsed stacks ("outer;inner;leaf count" per
+line), which flamegraph.pl, speedscope and similar tools read directly.
+
+Captures are capped in duration and sample count. The sampler also
+watches its own CPU time and backs off its interval if it would use more
+than `max_overhead` of a core.
+
+Each worker process has its own profiler: a capture only sees requests
+served by the worker that received the start request.
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import request
+
+DEFAULT_INTERVAL = 0.005
+MAX_INTERVAL = 0.5
+
+
+class SamplingProfiler:
+    """Samples the stacks of selected in-flight requests."""
+
+    def __init__(self, max_duration=300, max_samples=100_000, max_overhead=0.02):
+        self.max_duration = max_duration
+        self.max_samples = max_samples
+        self.max_overhead = max_overhead
+
+        self.lock = threading.Lock()
+        self.active = False
+        self.rate = 0.0
+        self.endpoint = None
+        self.interval = DEFAULT_INTERVAL
+        self.duration = 0
+        self.stacks = Counter()
+        self.targets = {}
+        self.thread = None
+        self.stopping = threading.Event()
+        self.status = {"state": "idle"}
+
+    def init_app(self, app):
+        """Hook the profiler into `app`'s requests."""
+
+        self.max_duration = app.config.get('PROFILER_MAX_DURATION', self.max_duration)
+        self.max_samples = app.config.get('PROFILER_MAX_SAMPLES', self.max_samples)
+        self.max_overhead = app.config.get('PROFILER_MAX_OVERHEAD', self.max_overhead)
+
+        app.before_request(self.before_request)
+        app.teardown_request(self.teardown_request)
+
+    def before_request(self):
+        if not self.active:
+            return
+
+        if self.endpoint and request.endpoint != self.endpoint:
+            return
+
+        if random.random() < self.rate:
+            self.targets[threading.get_ident()] = request.endpoint
+
+    def teardown_request(self, exc):
+        if self.targets:
+            self.targets.pop(threading.get_ident(), None)
+
+    def start(self, rate=1.0, endpoint=None, duration=30, interval=DEFAULT_INTERVAL):
+        """Begin a capture; returns False if one is already running.
+
+        `rate` is the fraction of (matching) requests to sample, `endpoint`
+        limits sampling to one view function, and `duration` is clamped to
+        `max_duration` seconds.
+        """
+
+        with self.lock:
+            if self.active:
+                return False
+
+            self.rate = min(max(rate, 0.0), 1.0)
+            self.endpoint = endpoint or None
+            self.interval = interval
+            self.duration = min(duration, self.max_duration)
+            self.stacks = Counter()
+            self.targets = {}
+            self.stopping.clear()
+            self.status = {
+                "state": "running",
+                "pid": os.getpid(),
+                "rate": self.rate,
+                "endpoint": self.endpoint,
+                "duration": self.duration,
+                "started_at": time.time(),
+                "samples": 0,
+                "overhead": 0.0,
+                "interval": interval,
+                "stopped_because": None,
+            }
+
+            self.active = True
+            self.thread = threading.Thread(target=self._run, name="sampling-profiler",
+                                           daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self, reason="stopped"):
+        """End the current capture, keeping its samples for download."""
+
+        self.stopping.set()
+        thread = self.thread
+        if thread and thread is not threading.current_thread():
+            thread.join()
+        self._finish(reason)
+
+    def _finish(self, reason):
+        with self.lock:
+            if self.active:
+                self.active = False
+                self.targets = {}
+                self.status["state"] = "finished"
+                self.status["stopped_because"] = reason
+
+    def _run(self):
+        deadline = time.monotonic() + self.duration
+        wall_start = time.monotonic()
+        cpu_used = 0.0
+        samples = 0
+
+        while not self.stopping.wait(self.interval):
+            if time.monotonic() >= deadline:
+                return self._finish("duration limit")
+
+            cpu_start = time.thread_time()
+            frames = sys._current_frames()
+
+            for ident in list(self.targets):
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.stacks[collapse(frame)] += 1
+                    samples += 1
+
+            cpu_used += time.thread_time() - cpu_start
+            overhead = cpu_used / (time.monotonic() - wall_start)
+
+            # Back off rather than exceed the overhead budget
+            if overhead > self.max_overhead:
+                self.interval = min(self.interval * 2, MAX_INTERVAL)
+
+            self.status.update(samples=samples, overhead=round(overhead, 4),
+                               interval=self.interval)
+
+            if samples >= self.max_samples:
+                return self._finish("sample limit")
+
+    def top(self, n=None):
+        """(stack, count) pairs, most frequent first."""
+
+        # dict() copies in one step, so the sampler can keep writing
+        stacks = dict(self.stacks)
+        return sorted(stacks.items(), key=lambda item: item[1], reverse=True)[:n]
+
+    def collapsed(self):
+        """Samples as collapsed-stack text, most frequent first."""
+
+        return "".join(f"{stack} {count}\n" for stack, count in self.top())
+
+
+def collapse(frame):
+    """Render a frame's stack as "outer;...;inner" function names."""
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
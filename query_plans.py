@@ -0,0 +1,275 @@
+"""Capture and check the query plan of every statement every route runs.
+
+Seed the benchmark's synthetic dataset, send each route one request
+through the Flask test client, and EXPLAIN every SELECT, UPDATE and
+DELETE it ran: `EXPLAIN QUERY PLAN` on SQLite, `EXPLAIN (FORMAT JSON)`
+on Postgres.
+
+    DATABASE_URL=sqlite:////tmp/warbler-plans.db python query_plans.py check
+    DATABASE_URL=postgresql:///warbler-plans python query_plans.py check --scale 100k
+    python query_plans.py check --update
+
+`check` reseeds DATABASE_URL (default: warbler-plans; it is dropped and
+recreated) and fails if
+
+- a statement scans a large table in full (SQLite's `SCAN`, Postgres'
+  `Seq Scan`) that EXPECTED_SCANS doesn't allow for its route, or
+- the plans differ from the snapshot in query_plans/<database>-<scale>.txt.
+
+`--update` rewrites the snapshot instead; commit it with the change, so
+a change to any plan's shape shows up in the review as a diff. Postgres
+plans depend on table sizes (the planner rightly scans small tables), so
+check them at the `100k` scale or larger; SQLite's are the same at any
+scale. The test suite checks for unexpected scans on every run, on its
+own small dataset, with either database.
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+from collections import namedtuple
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-plans")
+
+from sqlalchemy import event
+
+import benchmark
+from cache import make_cache
+from models import db
+
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_plans")
+
+# Tables that grow with the site. Small, bounded ones (tags' names,
+# consumer offsets, deletion requests) may be scanned
+LARGE_TABLES = {"users", "messages", "messages_hot", "follows", "likes", "message_stats",
+                "message_tags", "mentions", "message_scores", "user_graph_stats", "jobs",
+                "outbox_events", "daily_activity", "notifications"}
+
+# Endpoint: large tables it may scan in full, and why
+EXPECTED_SCANS = {
+    # The page lists every user, or searches with LIKE '%q%'
+    "warbler.list_users": {"users"},
+    "warbler.api_users": {"users"},
+    # The availability sets are built by streaming every user, by whichever
+    # of these a worker serves first
+    "warbler.signup": {"users"},
+    # Counts jobs by status, and lists the latest (SQLite calls reading
+    # the newest rows backwards until the LIMIT a SCAN too)
+    "warbler.admin_jobs": {"jobs"},
+}
+
+Statement = namedtuple("Statement", "sql plan scans")
+
+_IN_LIST = re.compile(r"\((?:\?|%\(\w+\)s)(?:, (?:\?|%\(\w+\)s))+\)")
+_SQLITE_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+_POSTGRES_SCAN = re.compile(r"^Seq Scan on (\w+)")
+
+
+def normalize(sql):
+    """`sql` on one line, with IN lists of any length written alike."""
+
+    return _IN_LIST.sub("(...)", " ".join(sql.split()))
+
+
+def explain(connection, sql, parameters):
+    """The plan of `sql` as a list of indented lines, and the tables it scans.
+
+    `connection` is a SQLAlchemy connection; `sql` and `parameters` are
+    as the DBAPI got them.
+    """
+
+    cursor = connection.connection.cursor()
+    try:
+        if connection.dialect.name == "sqlite":
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, parameters)
+            return _sqlite_plan(cursor.fetchall())
+
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, parameters)
+        return _postgres_plan(cursor.fetchone()[0])
+    finally:
+        cursor.close()
+
+
+def _sqlite_plan(rows):
+    depths = {0: -1}
+    lines, scans = [], set()
+
+    for id, parent, _, detail in rows:
+        depths[id] = depths.get(parent, -1) + 1
+        lines.append("  " * depths[id] + detail)
+
+        match = _SQLITE_SCAN.match(detail)
+        if match:
+            scans.add(match.group(1))
+
+    return lines, scans
+
+
+def _postgres_plan(document):
+    lines, scans = [], set()
+
+    def walk(node, depth):
+        # Shape only: costs and row estimates change with every ANALYZE
+        line = node["Node Type"]
+        if "Relation Name" in node:
+            line += f" on {node['Relation Name']}"
+        if "Index Name" in node:
+            line += f" using {node['Index Name']}"
+        lines.append("  " * depth + line)
+
+        match = _POSTGRES_SCAN.match(line)
+        if match:
+            scans.add(match.group(1))
+
+        for child in node.get("Plans", ()):
+            walk(child, depth + 1)
+
+    walk(document[0]["Plan"], 0)
+    return lines, scans
+
+
+class Recorder:
+    """Collects the statements executed on `engine` while recording."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self.record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute", self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        first_word = statement.lstrip().split(None, 1)[0].upper()
+        if not executemany and first_word in ("SELECT", "UPDATE", "DELETE", "WITH"):
+            self.statements.append((statement, parameters))
+
+
+def capture(app, builders, ctx, avoid_scans=False):
+    """{endpoint: [Statement]} for one request to each route.
+
+    Each route starts with an empty cache, so it runs every query it can.
+    With `avoid_scans`, Postgres is told to scan a table only when no
+    index will do, so that small tables (as in tests) show the plans
+    large ones would get.
+    """
+
+    plans = {}
+    client = app.test_client(use_cookies=False)
+
+    for endpoint, build in sorted(builders.items()):
+        method, path, data, cookie = build(ctx)
+        app.extensions['cache'] = make_cache("memory://")
+
+        # A streamed body runs its queries as it is read, so read it here
+        with Recorder(db.engine) as recorder:
+            resp = client.open(path, method=method, data=data,
+                               headers={"Cookie": cookie} if cookie else {})
+            resp.get_data()
+            resp.close()
+
+        statements = {}
+        connection = db.session.connection()
+        if avoid_scans and connection.dialect.name == "postgresql":
+            connection.execute("SET LOCAL enable_seqscan = off")
+        for sql, parameters in recorder.statements:
+            key = normalize(sql)
+            if key not in statements:
+                plan, scans = explain(connection, sql, parameters)
+                statements[key] = Statement(key, plan, scans & LARGE_TABLES)
+        plans[endpoint] = list(statements.values())
+
+    return plans
+
+
+def unexpected_scans(plans):
+    """[(endpoint, table, sql)] for full scans EXPECTED_SCANS doesn't allow."""
+
+    return [(endpoint, table, statement.sql)
+            for endpoint, statements in sorted(plans.items())
+            for statement in statements
+            for table in sorted(statement.scans - EXPECTED_SCANS.get(endpoint, set()))]
+
+
+def render(plans):
+    """The snapshot text: each route's statements, each followed by its plan."""
+
+    out = []
+    for endpoint, statements in sorted(plans.items()):
+        out.append(f"== {endpoint}")
+        for statement in statements:
+            out.append(statement.sql)
+            out.extend("    " + line for line in statement.plan)
+        out.append("")
+    return "\n".join(out)
+
+
+def snapshot_path(database, scale):
+    return os.path.join(SNAPSHOT_DIR, f"{database}-{scale}.txt")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    check_cmd = commands.add_parser("check", help="Seed, capture and check every plan.")
+    check_cmd.add_argument("--scale", choices=benchmark.SCALES, default="1k")
+    check_cmd.add_argument("--update", action="store_true",
+                           help="Rewrite the snapshot instead of comparing with it.")
+
+    args = parser.parse_args(argv)
+    app = benchmark.app
+    app.config['ADMIN_USERNAMES'] = (set(app.config['ADMIN_USERNAMES'])
+                                     | {benchmark.BENCH_USERNAME})
+
+    with app.app_context():
+        benchmark.seed(args.scale)
+        database = db.engine.dialect.name
+        if database == "postgresql":
+            db.session.execute("ANALYZE")
+            db.session.commit()
+
+        plans = capture(app, benchmark.route_builders(), benchmark.Context(random.Random(7)))
+        db.session.rollback()
+
+    failed = False
+    for endpoint, table, sql in unexpected_scans(plans):
+        print(f"FULL SCAN of {table} in {endpoint}: {sql}")
+        failed = True
+
+    path = snapshot_path(database, args.scale)
+    text = render(plans)
+    if args.update:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+        print(f"Wrote {path}")
+        return 1 if failed else 0
+
+    try:
+        with open(path) as f:
+            expected = f.read()
+    except FileNotFoundError:
+        print(f"No snapshot at {path}; create it with --update")
+        return 1
+
+    if text != expected:
+        import difflib
+        sys.stdout.writelines(difflib.unified_diff(
+            expected.splitlines(keepends=True), text.splitlines(keepends=True),
+            path, "captured"))
+        print("\nPlans changed; if that's intended, rerun with --update and commit the file.")
+        failed = True
+
+    if not failed:
+        print("Plans match the snapshot; no unexpected full scans.")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""Per-route rate limits, shared by every worker through the cache.
+
+Policies are configured per endpoint in RATE_LIMITS, as "scope
+count/period" strings separated by ";":
+
+    RATE_LIMITS = {
+        "warbler.messages_add": "user 30/minute; ip 120/minute",
+        "warbler.login": "ip 20/minute",
+    }
+
+A "user" policy counts the logged-in user's requests (it doesn't apply to
+anonymous ones), an "ip" policy counts by client address. Only POSTs
+are counted. A request over any of its limits gets a 429 with a
+Retry-After header, and is counted as `warbler_rate_limited_total`.
+
+Limits are sliding windows, approximated from two fixed-window counters
+in the cache: the current window's count plus the previous window's,
+weighted by how much of it still overlaps the sliding window. That is
+one atomic increment and one read per policy, and no database query. Use
+a cache shared by the workers (shm:// or redis://) so that the limits
+hold across all of them; with memory:// each worker counts on its own.
+If the cache fails, requests are let through.
+"""
+
+import logging
+import math
+import re
+import time
+
+from flask import current_app, request, session, Response
+
+from cache import CacheError
+from metrics import metrics
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+POLICY_RE = re.compile(r"^\s*(user|ip)\s+(\d+)\s*/\s*(second|minute|hour|day)\s*$")
+
+log = logging.getLogger(__name__)
+
+
+def parse(spec):
+    """[(scope, limit, period in seconds)] for a policy string."""
+
+    policies = []
+    for part in spec.split(";"):
+        if not part.strip():
+            continue
+
+        match = POLICY_RE.match(part)
+        if match is None:
+            raise ValueError(f"Bad rate limit {part.strip()!r}; expected e.g. 'user 30/minute'")
+
+        scope, limit, period = match.groups()
+        policies.append((scope, int(limit), PERIODS[period]))
+
+    return policies
+
+
+class RateLimiter:
+    """Checks every POST against its endpoint's policies."""
+
+    def __init__(self, user_key, app=None):
+        """Limit `app`; `user_key` is the session key holding the user's id."""
+
+        self.user_key = user_key
+        self.policies = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.policies = {endpoint: parse(spec)
+                         for endpoint, spec in app.config['RATE_LIMITS'].items()}
+
+        app.extensions['ratelimit'] = self
+        app.before_request(self.check)
+
+    def check(self):
+        """Return a 429 response if this request is over a limit."""
+
+        if request.method != "POST":
+            return None
+
+        policies = self.policies.get(request.endpoint)
+        if not policies:
+            return None
+
+        cache = current_app.extensions['cache'].namespace("ratelimit")
+        now = time.time()
+
+        for scope, limit, period in policies:
+            who = session.get(self.user_key) if scope == "user" else request.remote_addr
+            if who is None:
+                continue
+
+            try:
+                retry_after = hit(cache, f"{request.endpoint}:{scope}:{who}",
+                                  limit, period, now)
+            except CacheError:
+                log.warning("Rate limit cache unavailable; letting requests through",
+                            exc_info=True)
+                return None
+
+            if retry_after:
+                metrics.inc("warbler_rate_limited_total",
+                            (("endpoint", request.endpoint), ("scope", scope)))
+                return Response(f"Too many requests; try again in {retry_after} seconds.\n",
+                                status=429, mimetype="text/plain",
+                                headers={"Retry-After": str(retry_after)})
+
+        return None
+
+
+def hit(cache, key, limit, period, now=None):
+    """Count a request against `key`; return 0 if allowed, else seconds to wait."""
+
+    now = now or time.time()
+    window, offset = divmod(now, period)
+    window = int(window)
+
+    previous = cache.get_counts([f"{key}:{window - 1}"]).get(f"{key}:{window - 1}", 0)
+    current = cache.incr(f"{key}:{window}", ttl=2 * period)
+
+    # Share of the previous window still inside the sliding window
+    overlap = 1 - offset / period
+    if previous * overlap + current <= limit:
+        return 0
+
+    if current < limit:
+        # Room in this window once enough of the previous one slides out
+        wait = (1 - (limit - current - 1) / previous) * period - offset
+    else:
+        # Into the next window, until enough of this one slides out
+        wait = (period - offset) + (1 - (limit - 1) / current) * period
+
+    return max(1, math.ceil(wait))
@@ -0,0 +1,196 @@
+"""Hashtags and @mentions, indexed when a message is written.
+
+`messages_add` calls `index_messages()` in the same transaction as the
+new message, which records each #hashtag in `message_tags` and each
+@mention of an existing user in `mentions`, and adds one to the
+`message_count` of every tag used. Both tables are keyed by (tag or
+user, message id), so a tag's or user's timeline is a single index range
+scan, read newest first a page at a time:
+
+    ids, next_before = tagging.tag_page(tag.id, before=request.args.get('before'))
+
+Nothing reads message text to answer these pages. To index messages
+written before this existed (or re-index everything), run:
+
+    flask tags-backfill
+"""
+
+import re
+from collections import Counter
+
+from markupsafe import Markup, escape
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from deletion import purge_hook
+from models import db, Message, MessageTag, Mention, Tag, User
+
+# Not after a word character (or '&', as in the escaped "&#39;"); tags
+# longer than the column are ignored rather than cut short
+TAG_RE = re.compile(r"(?<![\w&])#(\w{1,50})\b")
+MENTION_RE = re.compile(r"(?<![\w@])@([\w-]+)")
+
+PAGE_SIZE = 20
+BACKFILL_CHUNK = 1000
+
+
+def extract(text):
+    """The distinct hashtags (lowercased) and usernames in `text`."""
+
+    tags = list(dict.fromkeys(tag.lower() for tag in TAG_RE.findall(text)))
+    usernames = list(dict.fromkeys(MENTION_RE.findall(text)))
+    return tags, usernames
+
+
+def index_messages(messages):
+    """Index the tags and mentions of [(message id, text)]. The caller commits."""
+
+    extracted = {message_id: extract(text) for message_id, text in messages}
+
+    names = {tag for tags, _ in extracted.values() for tag in tags}
+    usernames = {name for _, names in extracted.values() for name in names}
+
+    tag_ids = _tag_ids(names)
+    user_ids = dict(db.session
+                    .query(User.username, User.id)
+                    .filter(User.username.in_(usernames), User.deleted_at.is_(None))
+                    ) if usernames else {}
+
+    uses = Counter()
+    for message_id, (tags, mentioned) in extracted.items():
+        for tag in tags:
+            db.session.add(MessageTag(tag_id=tag_ids[tag], message_id=message_id))
+            uses[tag_ids[tag]] += 1
+
+        for username in mentioned:
+            if username in user_ids:
+                db.session.add(Mention(user_id=user_ids[username], message_id=message_id))
+
+    _count(uses)
+
+
+def unindex_messages(message_ids):
+    """Take messages out of the tag and mention indexes. The caller commits."""
+
+    uses = (db.session
+            .query(MessageTag.tag_id, func.count(MessageTag.message_id))
+            .filter(MessageTag.message_id.in_(message_ids))
+            .group_by(MessageTag.tag_id))
+    _count({tag_id: -n for tag_id, n in uses})
+
+    (MessageTag.query
+     .filter(MessageTag.message_id.in_(message_ids))
+     .delete(synchronize_session=False))
+    (Mention.query
+     .filter(Mention.message_id.in_(message_ids))
+     .delete(synchronize_session=False))
+
+
+def _tag_ids(names):
+    """{name: id} for tag names, creating the tags that don't exist yet."""
+
+    if not names:
+        return {}
+
+    found = dict(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(names)))
+
+    for name in names - found.keys():
+        try:
+            with db.session.begin_nested():
+                tag = Tag(name=name, message_count=0)
+                db.session.add(tag)
+            found[name] = tag.id
+        except IntegrityError:
+            # Someone else created it first
+            found[name] = db.session.query(Tag.id).filter_by(name=name).scalar()
+
+    return found
+
+
+def _count(uses):
+    for tag_id, n in uses.items():
+        if n:
+            (Tag.query
+             .filter(Tag.id == tag_id)
+             .update({Tag.message_count: Tag.message_count + n},
+                     synchronize_session=False))
+
+
+##############################################################################
+# Reading
+
+
+def tag_page(tag_id, before=None, limit=None):
+    """Ids of a tag's messages, newest first, older than `before`.
+
+    Pages hold `limit` ids (default PAGE_SIZE). Returns (ids, the `before` for the next page or None).
+    """
+
+    query = db.session.query(MessageTag.message_id).filter(MessageTag.tag_id == tag_id)
+    return _page(query, MessageTag.message_id, before, limit)
+
+
+def mention_page(user_id, before=None, limit=None):
+    """Ids of messages mentioning a user, like `tag_page()`."""
+
+    query = db.session.query(Mention.message_id).filter(Mention.user_id == user_id)
+    return _page(query, Mention.message_id, before, limit)
+
+
+def _page(query, column, before, limit):
+    limit = limit or PAGE_SIZE
+    if before is not None:
+        query = query.filter(column < before)
+
+    ids = [id for (id,) in query.order_by(column.desc()).limit(limit + 1)]
+
+    if len(ids) > limit:
+        return ids[:limit], ids[limit - 1]
+    return ids, None
+
+
+def linkify(text):
+    """Escape message text and link its hashtags to their timelines."""
+
+    return Markup(TAG_RE.sub(
+        lambda match: f'<a href="/tags/{match.group(1).lower()}">#{match.group(1)}</a>',
+        str(escape(text))))
+
+
+##############################################################################
+# Backfill and deletion
+
+
+def backfill(chunk=BACKFILL_CHUNK):
+    """Re-index every message, a chunk at a time; return how many."""
+
+    after = 0
+    total = 0
+
+    while True:
+        rows = (db.session
+                .query(Message.id, Message.text)
+                .filter(Message.id > after)
+                .order_by(Message.id)
+                .limit(chunk)
+                .all())
+        if not rows:
+            return total
+
+        ids = [message_id for message_id, _ in rows]
+        unindex_messages(ids)
+        index_messages(rows)
+        db.session.commit()
+
+        after = ids[-1]
+        total += len(rows)
+
+
+@purge_hook("messages")
+def forget_purged_messages(user_id, ids):
+    unindex_messages(ids)
+
+
+@purge_hook("user")
+def forget_mentions(user_id, ids):
+    Mention.query.filter(Mention.user_id == user_id).delete(synchronize_session=False)
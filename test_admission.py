@@ -0,0 +1,94 @@
+"""Admission control tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_admission.py
+
+
+from fixtures import WarblerTestCase, make_user
+from admission import AdmissionController
+
+
+class AdmissionTestCase(WarblerTestCase):
+    """Test shedding by priority and adapting the limit to latency."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.controller = self.app.extensions['admission']
+        state = (self.controller.limit, self.controller.fast, self.controller.slow)
+
+        def restore():
+            self.controller.limit, self.controller.fast, self.controller.slow = state
+
+        self.addCleanup(restore)
+
+    def busy(self, limit, in_flight):
+        """Pretend `in_flight` other requests are running under `limit`."""
+
+        self.controller.limit = limit
+        self.controller.in_flight += in_flight
+        self.addCleanup(setattr, self.controller, "in_flight",
+                        self.controller.in_flight - in_flight)
+
+    def test_sheds_expensive_first(self):
+        """Under load, are expensive routes refused while critical ones run?"""
+
+        user = make_user()
+        self.busy(limit=4, in_flight=2)
+
+        with self.client as c:
+            self.login(c, user)
+
+            resp = c.get("/users")
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers["Retry-After"], "1")
+
+            self.assertEqual(c.get("/tags/birds?before=10").status_code, 503)
+            self.assertEqual(c.get("/").status_code, 200)
+            self.assertEqual(c.get("/login").status_code, 200)
+
+        # Busier still: only critical routes get in
+        self.controller.limit = 3
+        with self.client as c:
+            self.login(c, user)
+            self.assertEqual(c.get("/").status_code, 503)
+            self.assertEqual(c.get("/login").status_code, 200)
+
+    def test_slot_released(self):
+        """Does every admitted request give its slot back?"""
+
+        in_flight = self.controller.in_flight
+        self.client.get("/login")
+        self.client.get("/no-such-page")
+
+        self.assertEqual(self.controller.in_flight, in_flight)
+
+    def test_adapts_to_latency(self):
+        """Does the limit grow while latency holds and shrink when it climbs?"""
+
+        controller = new_controller()
+
+        def run(latency, n, busy=True):
+            for _ in range(n):
+                controller.in_flight = int(controller.limit) if busy else 1
+                controller.release(latency)
+
+        run(0.01, 50)
+        grown = controller.limit
+        self.assertGreater(grown, 40)
+
+        run(0.1, 30)
+        self.assertLess(controller.limit, grown / 4)
+
+        # Idle workers don't grow their limit
+        controller = new_controller()
+        run(0.01, 50, busy=False)
+        self.assertEqual(controller.limit, 20.0)
+
+
+def new_controller():
+    controller = AdmissionController()
+    controller.limit, controller.min_limit, controller.max_limit = 20.0, 2, 200
+    controller.tolerance = 1.5
+    return controller
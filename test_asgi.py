@@ -0,0 +1,136 @@
+"""ASGI read path tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from starlette.testclient import TestClient
+
+from app import CURR_USER_KEY
+from asgi import create_asgi_app
+from models import db, Follows, Likes, Message, MessageStats, User
+
+
+class AsgiTestCase(TestCase):
+    """Test that the async views answer as the Flask ones do.
+
+    The async driver has connections of its own, which can't see the rows
+    of WarblerTestCase's rolled-back transaction, so these tests commit
+    to a throwaway SQLite database instead.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+
+        cls.asgi_app = create_asgi_app("testing", {
+            'SQLALCHEMY_DATABASE_URI':
+                f"sqlite:///{os.path.join(cls.directory.name, 'asgi.db')}",
+            'ADMISSION_CONTROL': False,
+        })
+        cls.app = cls.asgi_app.state.flask_app
+
+        with cls.app.app_context():
+            db.create_all()
+
+            users = [User(username=name, email=f"{name}@test.com", password="x",
+                          bio=f"I am {name}") for name in ("alice", "bob", "carol")]
+            db.session.add_all(users)
+            db.session.flush()
+            alice, bob, carol = users
+
+            db.session.add_all([Follows(user_following_id=alice.id,
+                                        user_being_followed_id=other.id)
+                                for other in (bob, carol)])
+            now = datetime.utcnow()
+            messages = [Message(text=f"warble {n} #song", user_id=user.id,
+                                timestamp=now - timedelta(minutes=10 - n))
+                        for n, user in enumerate((bob, carol, bob, alice))]
+            db.session.add_all(messages)
+            db.session.flush()
+
+            db.session.add(Likes(user_id=alice.id, message_id=messages[0].id))
+            db.session.add(MessageStats(message_id=messages[0].id, likes=1))
+            db.session.commit()
+
+            cls.alice, cls.bob = alice.id, bob.id
+            cls.message_ids = [msg.id for msg in messages]
+            cls.serializer = cls.app.session_interface.get_signing_serializer(cls.app)
+            db.session.remove()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def setUp(self):
+        self.client = TestClient(self.asgi_app)
+        self.client.__enter__()
+        self.addCleanup(self.client.__exit__, None, None, None)
+
+        self.flask_client = self.app.test_client()
+
+    def login(self, user_id):
+        cookies = {self.app.session_cookie_name:
+                   self.serializer.dumps({CURR_USER_KEY: user_id})}
+        self.client.cookies.update(cookies)
+        with self.flask_client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_json_matches_flask(self):
+        """Does each JSON route answer exactly as the Flask app's does?"""
+
+        self.login(self.alice)
+
+        for path in ("/api/timeline", "/api/users", "/api/users?q=car",
+                     f"/api/users/{self.bob}", f"/api/messages/{self.message_ids[0]}",
+                     "/api/users/9999", "/api/messages/9999"):
+            resp = self.client.get(path)
+            expected = self.flask_client.get(path)
+            self.assertEqual(resp.status_code, expected.status_code, path)
+            if resp.status_code == 200:
+                self.assertEqual(resp.json(), expected.get_json(), path)
+
+        timeline = self.client.get("/api/timeline").json()
+        self.assertEqual([msg["id"] for msg in timeline["messages"]],
+                         self.message_ids[2::-1])
+        self.assertEqual(timeline["liked"], [self.message_ids[0]])
+
+    def test_pages(self):
+        """Are the pages rendered from the shared templates, for the logged-in user?"""
+
+        self.assertIn("Sign up", self.client.get("/").text)
+        self.assertEqual(self.client.get("/api/timeline").status_code, 401)
+
+        self.login(self.alice)
+        html = self.client.get("/").text
+        self.assertIn("@alice", html)
+        self.assertIn("warble 2", html)
+        self.assertNotIn("warble 3", html)
+        self.assertIn(f'<a href="/users/{self.alice}/following">2</a>', html)
+
+        html = self.client.get(f"/users/{self.bob}").text
+        self.assertIn("I am bob", html)
+        self.assertIn("Unfollow", html)
+
+        html = self.client.get(f"/messages/{self.message_ids[0]}").text
+        self.assertIn("warble 0", html)
+        self.assertIn('href="/tags/song"', html)
+
+        self.assertIn("@carol", self.client.get("/users?q=car").text)
+        self.assertEqual(self.client.get("/users/9999").status_code, 404)
+
+    def test_other_routes_served_by_flask(self):
+        """Does everything else reach the Flask app?"""
+
+        resp = self.client.get("/login")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Welcome back", resp.text)
+
+        resp = self.client.get("/trending")
+        self.assertEqual(resp.status_code, 200)
@@ -0,0 +1,143 @@
+"""Username and email availability tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_availability.py
+
+
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User
+from fixtures import WarblerTestCase, make_user
+from availability import Availability, NameSet, value_hash
+
+
+class NameSetTestCase(TestCase):
+    """Test the Bloom filter and sorted hashes."""
+
+    def test_membership(self):
+        """Are members found, non-members mostly filtered out, and removals seen?"""
+
+        names = NameSet(value_hash(f"user{n}") for n in range(5000))
+        self.assertTrue(all(value_hash(f"user{n}") in names for n in range(5000)))
+        self.assertTrue(all(names.might_contain(value_hash(f"user{n}")) for n in range(5000)))
+
+        others = [value_hash(f"other{n}") for n in range(10_000)]
+        self.assertFalse(any(h in names for h in others))
+        self.assertLess(sum(names.might_contain(h) for h in others), 300)
+
+        names.remove(value_hash("user7"))
+        self.assertNotIn(value_hash("user7"), names)
+
+        # Growing past its capacity resizes the filter
+        for h in others:
+            names.add(h)
+        self.assertGreaterEqual(names.capacity, len(names))
+        self.assertTrue(all(h in names for h in others))
+
+
+class AvailabilityViewsTestCase(WarblerTestCase):
+    """Test the availability endpoint and the checks on sign-up and profile edits."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = make_user(username="taken", email="taken@test.com")
+        db.session.commit()
+
+        real = self.app.extensions['availability']
+        self.availability = Availability(self.app)
+        self.addCleanup(self.app.extensions.__setitem__, 'availability', real)
+
+    def available(self, client=None, **args):
+        resp = (client or self.app.test_client()).get("/users/available", query_string=args)
+        self.assertEqual(resp.status_code, 200)
+        return resp.json["available"]
+
+    def test_endpoint(self):
+        """Are taken names reported, from memory, and a user's own name free?"""
+
+        # Built with the app, so even the first check is answered without a query
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            self.assertTrue(self.availability.is_taken("username", "taken"))
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(statements, [])
+
+        self.assertFalse(self.available(username="taken"))
+        self.assertFalse(self.available(email="taken@test.com"))
+        self.assertTrue(self.available(username="free"))
+        self.assertEqual(self.client.get("/users/available").status_code, 400)
+
+        with self.client as c:
+            self.login(c, self.user)
+            self.assertTrue(self.available(c, username="taken"))
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            self.assertFalse(self.availability.is_taken("username", "free2"))
+            self.assertTrue(self.availability.is_taken("username", "taken"))
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(statements, [])
+
+    def test_signup_and_rename(self):
+        """Are the sets updated as users sign up and rename, and duplicates refused?"""
+
+        self.assertTrue(self.available(username="newbie"))
+        data = {"username": "newbie", "email": "newbie@test.com", "password": "password"}
+        self.assertEqual(self.client.post("/signup", data=data).status_code, 302)
+        self.assertFalse(self.available(username="newbie"))
+
+        # A taken username is refused before any INSERT
+        data = {"username": "taken", "email": "other@test.com", "password": "password"}
+        resp = self.client.post("/signup", data=data)
+        self.assertIn("Username already taken", resp.get_data(as_text=True))
+        self.assertIsNone(User.query.filter_by(email="other@test.com").first())
+
+        with self.client as c:
+            self.login(c, self.user)
+            edit = {"username": "newbie", "email": "taken@test.com", "password": "password",
+                    "image_url": "", "header_image_url": ""}
+            resp = c.post("/users/profile", data=edit)
+            self.assertIn("Username already taken", resp.get_data(as_text=True))
+
+            edit["username"] = "renamed"
+            self.assertEqual(c.post("/users/profile", data=edit).status_code, 302)
+
+        self.assertTrue(self.available(username="taken"))
+        self.assertFalse(self.available(username="renamed"))
+
+    def test_stale_taken_is_confirmed(self):
+        """Does a name that's gone from the database stop blocking sign-ups?"""
+
+        self.assertFalse(self.available(username="taken"))
+        User.query.filter_by(id=self.user.id).delete()
+        db.session.commit()
+
+        data = {"username": "taken", "email": "taken@test.com", "password": "password"}
+        self.assertEqual(self.client.post("/signup", data=data).status_code, 302)
+
+    def test_database_answers_without_sets(self):
+        """If the startup build failed, does the database answer until a rebuild?"""
+
+        self.availability.sets = None
+
+        self.assertTrue(self.availability.is_taken("username", "taken"))
+        self.assertFalse(self.availability.is_taken("email", "free@test.com"))
+
+    def test_refresh_adds_other_signups(self):
+        """Are users added behind this worker's back picked up by a refresh?"""
+
+        make_user(username="elsewhere", email="elsewhere@test.com")
+        db.session.commit()
+        self.assertFalse(self.availability.is_taken("username", "elsewhere"))
+
+        self.availability.refresh()
+        self.assertTrue(self.availability.is_taken("username", "elsewhere"))
+        self.assertTrue(self.availability.is_taken("email", "elsewhere@test.com"))
@@ -0,0 +1,66 @@
+"""Benchmark harness tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_benchmark.py
+
+
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import benchmark
+
+app = benchmark.app
+
+
+class BenchmarkTestCase(TestCase):
+    """Test the pieces of the benchmark that don't need a dataset."""
+
+    def test_every_route_has_a_builder(self):
+        """Is every route in the app covered by the benchmark?"""
+
+        builders = benchmark.route_builders()
+        endpoints = {rule.endpoint for rule in app.url_map.iter_rules()
+                     if rule.endpoint not in benchmark.IGNORED_ENDPOINTS
+                     and not rule.endpoint.startswith("_debug_toolbar")}
+
+        self.assertEqual(set(builders), endpoints)
+
+    def test_percentile(self):
+        """Does percentile use the nearest rank?"""
+
+        values = list(range(1, 101))
+
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 99), 99)
+        self.assertEqual(benchmark.percentile([5], 95), 5)
+        self.assertIsNone(benchmark.percentile([], 50))
+
+    def test_compare(self):
+        """Are only changes past the threshold reported?"""
+
+        before = {"routes": {
+            "homepage": {"p95_ms": 100, "throughput_rps": 50},
+            "login": {"p95_ms": 10, "throughput_rps": 200},
+            "logout": {"p95_ms": 5, "throughput_rps": 300},
+            "signup": {"p95_ms": None, "throughput_rps": 0.0},
+        }}
+        after = {"routes": {
+            "homepage": {"p95_ms": 105, "throughput_rps": 48},
+            "login": {"p95_ms": 20, "throughput_rps": 100},
+            "logout": {"p95_ms": None, "throughput_rps": 0.0},
+            "signup": {"p95_ms": 30, "throughput_rps": 40},
+            "new_route": {"p95_ms": 1, "throughput_rps": 1},
+        }}
+
+        regressions = benchmark.compare(before, after, threshold=0.10)
+
+        # A route with no latencies now is reported, one with none before skipped
+        self.assertEqual(regressions, [
+            ("login", "p95_ms", 10, 20),
+            ("login", "throughput_rps", 200, 100),
+            ("logout", "p95_ms", 5, None),
+            ("logout", "throughput_rps", 300, 0.0),
+        ])
@@ -0,0 +1,259 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import os
+import socketserver
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from cache import LocalCache, SharedMemoryCache, RedisCache, make_cache, _read_reply
+
+
+class RespStandIn(socketserver.ThreadingTCPServer):
+    """Just enough of a Redis server for RedisCache, backed by a LocalCache."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), RespHandler)
+        self.store = LocalCache()
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        store = self.server.store
+
+        while True:
+            try:
+                args = _read_reply(self.rfile)
+            except EOFError:
+                return
+
+            command = args[0].upper()
+            # Only keys are used as strings; latin-1 decodes any value too
+            keys = [arg.decode("latin-1") for arg in args[1:]]
+
+            if command == b"PING":
+                reply = b"+PONG\r\n"
+
+            elif command == b"MGET":
+                found = store._get_many(keys)
+                reply = b"*%d\r\n" % len(keys) + b"".join(
+                    b"$%d\r\n%s\r\n" % (len(found[key]), found[key]) if key in found
+                    else b"$-1\r\n"
+                    for key in keys)
+
+            elif command == b"SET":
+                options = [arg.upper() for arg in args[3:]]
+                ttl = None
+                if b"PX" in options:
+                    ttl = int(args[3 + options.index(b"PX") + 1]) / 1000
+
+                if b"NX" in options:
+                    stored = store._add(keys[0], args[2], ttl)
+                else:
+                    store._set(keys[0], args[2], ttl)
+                    stored = True
+
+                reply = b"+OK\r\n" if stored else b"$-1\r\n"
+
+            elif command == b"INCRBY":
+                reply = b":%d\r\n" % store._incr(keys[0], int(args[2]), None)
+
+            elif command == b"PEXPIRE":
+                found = store._get_many(keys[:1])
+                if keys[0] in found:
+                    store._set(keys[0], found[keys[0]], int(args[2]) / 1000)
+                reply = b":%d\r\n" % (keys[0] in found)
+
+            elif command == b"DEL":
+                store._delete_many(keys)
+                reply = b":%d\r\n" % len(keys)
+
+            else:
+                reply = b"-ERR unknown command\r\n"
+
+            self.wfile.write(reply)
+
+
+class CacheBehaviour:
+    """Tests every backend must pass; subclasses provide `make()`."""
+
+    def setUp(self):
+        self.cache = self.make()
+
+    def test_get_set_delete(self):
+        """Can values be stored, read back and deleted?"""
+
+        self.cache.set("a", {"text": "hi"})
+        self.cache.set("b", None)
+
+        self.assertEqual(self.cache.get("a"), {"text": "hi"})
+        self.assertEqual(self.cache.get_many(["a", "b", "c"]), {"a": {"text": "hi"}, "b": None})
+
+        self.cache.delete("a")
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.get("a", "default"), "default")
+
+    def test_ttl(self):
+        """Do entries expire?"""
+
+        self.cache.set("short", 1, ttl=0.05)
+        self.cache.set("long", 2, ttl=60)
+        time.sleep(0.1)
+
+        self.assertEqual(self.cache.get_many(["short", "long"]), {"long": 2})
+
+    def test_tags(self):
+        """Does invalidating a tag make its entries stale, and only those?"""
+
+        self.cache.set_many({"m1": 1, "m2": 2}, tags=["user:1"])
+        self.cache.set("m3", 3, tags=["user:2"])
+
+        self.cache.invalidate_tags(["user:1"])
+
+        self.assertEqual(self.cache.get_many(["m1", "m2", "m3"]), {"m3": 3})
+
+        self.cache.set("m1", 10, tags=["user:1"])
+        self.assertEqual(self.cache.get("m1"), 10)
+
+    def test_namespace(self):
+        """Are namespaces kept apart?"""
+
+        users = self.cache.namespace("users")
+        users.set("1", "alice")
+
+        self.assertEqual(users.get("1"), "alice")
+        self.assertIsNone(self.cache.get("1"))
+
+    def test_stampede(self):
+        """Do many concurrent misses compute the value only once?"""
+
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return "hot"
+
+        results = []
+        threads = [threading.Thread(
+                       target=lambda: results.append(self.cache.get_or_set("hot", compute, poll=0.01)))
+                   for _ in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["hot"] * 50)
+
+
+    def test_counters(self):
+        """Do counters add up atomically and expire from their creation?"""
+
+        self.assertEqual(self.cache.incr("hits", ttl=0.2), 1)
+        self.assertEqual(self.cache.incr("hits", 4, ttl=60), 5)
+
+        threads = [threading.Thread(target=lambda: [self.cache.incr("hits") for _ in range(50)])
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.cache.get_counts(["hits", "misses"]), {"hits": 405})
+
+        time.sleep(0.3)
+        self.assertEqual(self.cache.get_counts(["hits"]), {})
+
+
+class LocalCacheTestCase(CacheBehaviour, TestCase):
+
+    def make(self):
+        return LocalCache()
+
+    def test_evicts_least_recently_used(self):
+        """Are the least recently used entries evicted past `max_bytes`?"""
+
+        cache = LocalCache(max_bytes=400)
+        for key in "abc":
+            cache.set(key, "x" * 100)
+
+        cache.get("a")
+        cache.set("d", "x" * 100)
+
+        self.assertEqual(set(cache.get_many("abcd")), {"a", "c", "d"})
+        self.assertLessEqual(cache.size, 400)
+
+
+class SharedMemoryCacheTestCase(CacheBehaviour, TestCase):
+
+    def make(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        return SharedMemoryCache(os.path.join(self.dir.name, "cache"), size=256 * 1024)
+
+    def test_shared_between_instances(self):
+        """Does a second opening of the file (another worker) see the entries?"""
+
+        self.cache.set("shared", [1, 2, 3])
+        other = SharedMemoryCache(self.cache.path, size=256 * 1024)
+
+        self.assertEqual(other.get("shared"), [1, 2, 3])
+
+        other.invalidate_tags(["t"])
+        self.cache.delete("shared")
+        self.assertIsNone(other.get("shared"))
+
+    def test_shared_across_fork(self):
+        """Does a forked worker see entries written by its parent, and vice versa?"""
+
+        self.cache.set("from parent", 1)
+
+        pid = os.fork()
+        if pid == 0:
+            ok = self.cache.get("from parent") == 1
+            self.cache.set("from child", 2)
+            os._exit(0 if ok else 1)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.assertEqual(self.cache.get("from child"), 2)
+
+    def test_too_big(self):
+        """Are values bigger than a slot skipped rather than truncated?"""
+
+        self.cache.set("big", "x" * 10_000)
+        self.assertIsNone(self.cache.get("big"))
+
+
+class RedisCacheTestCase(CacheBehaviour, TestCase):
+
+    def make(self):
+        server = RespStandIn()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        host, port = server.server_address
+        return make_cache(f"redis://{host}:{port}/0")
+
+    def test_make_cache(self):
+        """Are CACHE_URLs parsed?"""
+
+        cache = make_cache("redis://:sekrit@cache.internal:6380/2")
+
+        self.assertIsInstance(cache, RedisCache)
+        self.assertEqual((cache.host, cache.port, cache.db, cache.password),
+                         ("cache.internal", 6380, 2, "sekrit"))
+        self.assertIsInstance(make_cache("memory://?max_bytes=1024"), LocalCache)
@@ -0,0 +1,104 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_deletion.py
+
+
+from models import db, User, Message, Follows, Likes, UserDeletion
+from fixtures import WarblerTestCase, make_user, make_message, make_follow, make_like
+import deletion
+import jobs
+
+
+class DeletionTestCase(WarblerTestCase):
+    """Test marking accounts deleted and purging them in batches."""
+
+    def setUp(self):
+        """Make a user with messages, likes and follows."""
+
+        super().setUp()
+
+        self.gone = make_user("gone")
+        self.other = make_user("other")
+        self.gone_id = self.gone.id
+        self.other_id = self.other.id
+
+        for i in range(5):
+            make_like(self.other, make_message(self.gone))
+        make_like(self.gone, make_message(self.other))
+        make_follow(self.other, self.gone)
+        make_follow(self.gone, self.other)
+        db.session.commit()
+
+        self.batch_size = deletion.BATCH_SIZE
+        deletion.BATCH_SIZE = 2
+
+    def tearDown(self):
+        deletion.BATCH_SIZE = self.batch_size
+        super().tearDown()
+
+    def delete_gone(self):
+        with self.client as c:
+            self.login(c, self.gone)
+
+            return c.post("/users/delete")
+
+    def test_delete_hides_user(self):
+        """Is a deleted user hidden before their rows are purged?"""
+
+        resp = self.delete_gone()
+        self.assertEqual(resp.status_code, 302)
+
+        # Rows are still there...
+        self.assertEqual(Message.query.filter_by(user_id=self.gone_id).count(), 5)
+
+        # ...but nobody can see them
+        self.assertEqual(self.client.get(f"/users/{self.gone_id}").status_code, 404)
+        self.assertNotIn("@gone", str(self.client.get("/users").data))
+        self.assertFalse(User.authenticate("gone", "password"))
+
+        other = User.query.get(self.other_id)
+        self.assertEqual(other.following, [])
+        self.assertEqual(other.followers, [])
+
+    def test_purge_in_batches(self):
+        """Does the purge job remove every row and record progress?"""
+
+        self.delete_gone()
+
+        progress = UserDeletion.query.get(self.gone_id)
+        self.assertEqual(progress.stage, "likes")
+
+        worker = jobs.Worker(self.app, concurrency=1, worker_id="test-worker")
+        while worker.run_once():
+            pass
+
+        progress = UserDeletion.query.get(self.gone_id)
+        self.assertEqual(progress.stage, "done")
+        self.assertIsNotNone(progress.finished_at)
+        self.assertEqual(progress.rows_deleted, 5 + 1 + 5 + 2 + 1)
+
+        self.assertIsNone(User.query.get(self.gone_id))
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertIsNotNone(User.query.get(self.other_id))
+
+    def test_purge_hooks(self):
+        """Are purge hooks given each batch before it is deleted?"""
+
+        seen = []
+
+        def hook(user_id, ids):
+            seen.append((user_id, Message.query.filter(Message.id.in_(ids)).count()))
+
+        deletion.PURGE_HOOKS["messages"].append(hook)
+        try:
+            self.delete_gone()
+            db.session.commit()
+            deletion.purge_user(self.gone_id)
+        finally:
+            deletion.PURGE_HOOKS["messages"].remove(hook)
+
+        self.assertEqual(seen, [(self.gone_id, 2), (self.gone_id, 2), (self.gone_id, 1)])
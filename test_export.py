@@ -0,0 +1,96 @@
+"""Data export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+
+import csv
+import gzip
+import io
+import json
+from unittest import mock
+
+from models import db
+from fixtures import WarblerTestCase, make_user, make_message, make_follow, make_like
+import export
+
+
+class ExportTestCase(WarblerTestCase):
+    """Test streaming a user's data and resuming from a cursor."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = make_user("exporter")
+        self.other = make_user("other")
+        self.messages = [make_message(self.user, f"note {i}") for i in range(5)]
+        make_like(self.user, make_message(self.other))
+        make_follow(self.user, self.other)
+        make_follow(self.other, self.user)
+        db.session.commit()
+
+        chunk = export.CHUNK
+        export.CHUNK = 2
+        self.addCleanup(setattr, export, "CHUNK", chunk)
+
+    def get(self, query="", **headers):
+        with self.client as c:
+            self.login(c, self.user)
+            return c.get(f"/users/export{query}", headers=headers)
+
+    def test_ndjson(self):
+        """Are all sections exported in order, across chunks?"""
+
+        resp = self.get()
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+
+        records = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([r["section"] for r in records],
+                         ["profile"] + ["messages"] * 5 + ["likes", "followers", "following"])
+        self.assertEqual(records[0]["username"], "exporter")
+        self.assertEqual([r["text"] for r in records[1:6]], [f"note {i}" for i in range(5)])
+        self.assertEqual(records[-1]["username"], "other")
+
+    def test_csv_gzip_resume(self):
+        """Does a gzipped CSV carry on from a cursor?"""
+
+        cursor = f"messages:{self.messages[2].id}"
+        resp = self.get(f"?format=csv&cursor={cursor}", **{"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+
+        rows = list(csv.DictReader(io.StringIO(gzip.decompress(resp.data).decode())))
+        self.assertEqual([row["text"] for row in rows if row["section"] == "messages"],
+                         ["note 3", "note 4"])
+        self.assertEqual(rows[-1]["section"], "following")
+
+    def test_transaction_ends_per_chunk(self):
+        """Is the transaction committed before each chunk's rows go out?"""
+
+        seen = []
+        commit = db.session.commit
+        with mock.patch.object(db.session, "commit",
+                               side_effect=lambda: (seen.append("commit"), commit())):
+            for record in export.records(self.user.id, "messages:0"):
+                if record["section"] == "messages":
+                    seen.append(record["text"])
+
+        self.assertEqual(seen[:8], ["commit", "note 0", "note 1", "commit", "note 2", "note 3",
+                                    "commit", "note 4"])
+
+    def test_bad_requests(self):
+        """Are unknown formats and cursors refused, and strangers sent away?"""
+
+        self.assertEqual(self.get("?format=xml").status_code, 400)
+        self.assertEqual(self.get("?cursor=passwords:1").status_code, 400)
+        self.assertEqual(self.app.test_client().get("/users/export").status_code, 302)
+
+    def test_cli(self):
+        """Does the CLI write the same records?"""
+
+        result = self.app.test_cli_runner().invoke(
+            args=["export-user", "exporter", "--cursor", "likes:0"])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        sections = [json.loads(line)["section"] for line in result.output.splitlines()]
+        self.assertEqual(sections, ["likes", "followers", "following"])
@@ -0,0 +1,60 @@
+"""Follow-graph analytics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_graph_stats.py
+
+
+from datetime import datetime
+
+import numpy as np
+
+from models import db, UserGraphStats
+from fixtures import WarblerTestCase, make_user, make_follow
+import graph_stats
+
+
+class GraphStatsTestCase(WarblerTestCase):
+    """Test computing and saving follow-graph metrics."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.a, self.b, self.c, self.d, gone = [make_user() for _ in range(5)]
+        for follower, followed in [(self.a, self.b), (self.b, self.a), (self.b, self.c),
+                                   (self.c, self.b), (self.d, self.a), (gone, self.d)]:
+            make_follow(follower, followed)
+        gone.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+    def test_command(self):
+        """Does the command save each user's counts, influence and cluster?"""
+
+        result = self.app.test_cli_runner().invoke(args=["graph-stats"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("4 user(s), 5 follow(s)", result.output)
+
+        stats = {row.user_id: row for row in UserGraphStats.query}
+        a, b, c, d = (stats[user.id] for user in (self.a, self.b, self.c, self.d))
+
+        self.assertEqual([(s.followers, s.following, s.mutuals) for s in (a, b, c, d)],
+                         [(2, 1, 1), (2, 2, 2), (1, 1, 1), (0, 1, 0)])
+        self.assertEqual([s.reciprocity for s in (a, b, c, d)], [1, 1, 1, 0])
+
+        self.assertEqual({a.cluster, b.cluster, c.cluster}, {self.a.id})
+        self.assertEqual(d.cluster, self.d.id)
+
+        self.assertAlmostEqual(sum(s.influence for s in stats.values()), 4)
+        self.assertGreater(b.influence, c.influence)
+        self.assertGreater(a.influence, d.influence)
+
+    def test_workers(self):
+        """Does a process pool give the same results?"""
+
+        followers, followed = graph_stats.load_edges()
+        ids, alone = graph_stats.compute(followers, followed)
+        pooled_ids, pooled = graph_stats.compute(followers, followed, workers=2)
+
+        np.testing.assert_array_equal(ids, pooled_ids)
+        for name in alone:
+            np.testing.assert_allclose(alone[name], pooled[name])
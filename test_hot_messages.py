@@ -0,0 +1,79 @@
+"""Hot/archive timeline tier tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_hot_messages.py
+
+
+from datetime import datetime, timedelta
+
+from models import db, HotMessage
+from fixtures import WarblerTestCase, make_user, make_message, make_follow
+import hot_messages
+import jobs
+
+
+class HotMessagesTestCase(WarblerTestCase):
+    """Test reading timelines across the hot window."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.author = make_user("author")
+        self.reader = make_user("reader")
+        make_follow(self.reader, self.author)
+
+        self.now = now = datetime.utcnow()
+        self.recent = [make_message(self.author, f"recent {i}",
+                                    timestamp=now - timedelta(days=i)).id
+                       for i in range(3)]
+        self.old = [make_message(self.author, f"old {i}",
+                                 timestamp=now - timedelta(days=100 + i)).id
+                    for i in range(2)]
+        db.session.commit()
+
+    def test_tiers(self):
+        """Are only recent messages hot, and do pages fall through in order?"""
+
+        self.assertEqual({row.message_id for row in HotMessage.query},
+                         set(self.recent))
+
+        self.assertEqual(hot_messages.timeline([self.author.id], limit=2), self.recent[:2])
+        self.assertEqual(hot_messages.timeline([self.author.id], limit=10),
+                         self.recent + self.old)
+        self.assertEqual(hot_messages.timeline(
+            [self.author.id], limit=10, before=self.now - timedelta(days=100)),
+            self.old[1:])
+
+        with self.client as c:
+            self.login(c, self.reader)
+            html = c.get("/").get_data(as_text=True)
+
+        self.assertLess(html.index("recent 2"), html.index("old 0"))
+
+    def test_trim_and_rebuild(self):
+        """Does the trim job drop aged rows, and rebuild restore the tier?"""
+
+        hot_messages.HOT_WINDOW, window = timedelta(hours=12), hot_messages.HOT_WINDOW
+        try:
+            worker = jobs.Worker(self.app, concurrency=1, worker_id="test-worker")
+            worker.schedule()
+            db.session.commit()
+            worker.run_once()
+
+            self.assertEqual([row.message_id for row in HotMessage.query], self.recent[:1])
+            self.assertEqual(hot_messages.timeline([self.author.id], limit=10),
+                             self.recent + self.old)
+        finally:
+            hot_messages.HOT_WINDOW = window
+
+        self.assertEqual(hot_messages.rebuild(), 3)
+
+    def test_delete(self):
+        """Does deleting a message take it out of the hot tier?"""
+
+        with self.client as c:
+            self.login(c, self.author)
+            c.post(f"/messages/{self.recent[0]}/delete")
+
+        self.assertIsNone(HotMessage.query.get(self.recent[0]))
@@ -0,0 +1,104 @@
+"""Hydration cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_hydration.py
+
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from models import db, Message
+from fixtures import WarblerTestCase, make_user, make_message, make_follow
+import hydration
+
+
+class HydrationTestCase(WarblerTestCase):
+    """Test caching message and user snapshots."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.author = make_user("author")
+        self.reader = make_user("reader")
+        make_follow(self.reader, self.author)
+        self.messages = [make_message(self.author) for _ in range(5)]
+        db.session.commit()
+
+        self.ids = [msg.id for msg in self.messages]
+
+    @contextmanager
+    def count_queries(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            # Leave out the test harness's own savepoints
+            if "SAVEPOINT" not in statement:
+                statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+
+    def test_get_many(self):
+        """Are misses loaded in one query and then served from the cache?"""
+
+        with self.count_queries() as cold:
+            cards = hydration.hydrate_messages(self.ids)
+
+        self.assertEqual([card.id for card in cards], self.ids)
+        self.assertEqual(cards[0].user.username, "author")
+        self.assertEqual(len(cold), 2)
+
+        with self.count_queries() as warm:
+            hydration.hydrate_messages(self.ids)
+
+        self.assertEqual(warm, [])
+
+        extra_id = make_message(self.author).id
+        db.session.commit()
+
+        with self.count_queries() as partial:
+            cards = hydration.hydrate_messages(self.ids + [extra_id])
+
+        self.assertEqual(len(cards), 6)
+        self.assertEqual(len(partial), 1)
+
+    def test_invalidated_by_views(self):
+        """Do deleting a message and editing a profile update what's shown?"""
+
+        hydration.hydrate_messages(self.ids)
+
+        with self.client as c:
+            self.login(c, self.author)
+
+            c.post(f"/messages/{self.ids[0]}/delete")
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "renamed@test.com",
+                                           "image_url": "",
+                                           "header_image_url": "",
+                                           "password": "password"})
+
+        cards = hydration.hydrate_messages(self.ids)
+
+        self.assertEqual([card.id for card in cards], self.ids[1:])
+        self.assertEqual(cards[0].user.username, "renamed")
+
+    def test_deleted_author_hidden(self):
+        """Are messages by a deleted user left out, even once cached?"""
+
+        with self.client as c:
+            self.login(c, self.reader)
+            self.assertIn("@author", c.get("/").get_data(as_text=True))
+
+            self.login(c, self.author)
+            c.post("/users/delete")
+
+            self.login(c, self.reader)
+            self.assertNotIn("@author", c.get("/").get_data(as_text=True))
+
+        self.assertEqual(hydration.hydrate_messages(self.ids), [])
+        self.assertEqual(Message.query.count(), 5)
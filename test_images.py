@@ -0,0 +1,263 @@
+"""Image proxy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+
+import io
+import os
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from PIL import Image
+
+from app import create_app
+from models import db
+from fixtures import WarblerTestCase, make_user, make_message
+import images
+
+
+def make_image(size, color="teal", format="JPEG"):
+    out = io.BytesIO()
+    Image.new("RGB", size, color).save(out, format)
+    return out.getvalue()
+
+
+class StandInServer:
+    """A local HTTP server serving `files` and `redirects`, counting requests per path."""
+
+    def __init__(self, files, delay=0):
+        self.files = files
+        self.redirects = {}
+        self.hits = {}
+        self.delay = delay
+
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.hits[self.path] = stand_in.hits.get(self.path, 0) + 1
+                time.sleep(stand_in.delay)
+                if self.path in stand_in.redirects:
+                    self.send_response(302)
+                    self.send_header("Location", stand_in.redirects[self.path])
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                data = stand_in.files.get(self.path)
+                if data is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server.server_port}{path}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ImageProxyTestCase(WarblerTestCase):
+    """Test fetching once, resizing, collapsing misses and evicting."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.server = StandInServer({"/avatar.jpg": make_image((640, 480)),
+                                     "/header.jpg": make_image((3000, 600), "navy")})
+        self.addCleanup(self.server.close)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = self.new_cache(directory.name, max_bytes=10 * 1024 * 1024)
+
+        real = self.app.extensions['images']
+        self.app.extensions['images'] = self.cache
+        self.addCleanup(self.app.extensions.__setitem__, 'images', real)
+
+    def new_cache(self, directory, max_bytes):
+        return images.ImageCache(directory, max_bytes, static_folder=self.app.static_folder,
+                                 allow_private_hosts=True)
+
+    def proxied(self, url, variant):
+        with self.app.test_request_context():
+            return images.image_filter(url, variant)
+
+    def test_fetches_once(self):
+        """Are variants resized, cached for long, and the source fetched once?"""
+
+        user = make_user(image_url=self.server.url("/avatar.jpg"),
+                         header_image_url=self.server.url("/header.jpg"))
+        make_message(user)
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, user)
+            html = c.get("/").get_data(as_text=True)
+        self.assertIn(self.proxied(user.image_url, "thumb").replace("&", "&amp;"), html)
+        self.assertIn(self.proxied(user.header_image_url, "header").replace("&", "&amp;"), html)
+
+        for _ in range(2):
+            resp = self.client.get(self.proxied(user.image_url, "thumb"))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "image/jpeg")
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (96, 96))
+
+        resp = self.client.get(self.proxied(user.image_url, "card"))
+        self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (200, 200))
+        self.assertEqual(self.server.hits, {"/avatar.jpg": 1})
+
+        resp = self.client.get(self.proxied(user.header_image_url, "header"))
+        self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (1500, 300))
+
+        # Users sharing an image share its files
+        resp = self.client.get(self.proxied(None, "thumb"))
+        self.assertEqual(resp.status_code, 200)
+        self.client.get(self.proxied(images.DEFAULT_IMAGE + "?v=2", "thumb"))
+        variants = os.listdir(os.path.join(self.cache.directory, "variants"))
+        self.assertEqual(sum(len(os.listdir(os.path.join(self.cache.directory, "variants", d)))
+                             for d in variants), 4)
+
+    def test_refused(self):
+        """Are unsigned URLs, private hosts and failures turned away?"""
+
+        url = self.server.url("/avatar.jpg")
+        self.assertEqual(self.client.get(f"/images/thumb/bad?url={url}").status_code, 404)
+        self.assertEqual(self.client.get(self.proxied(url, "huge")).status_code, 404)
+
+        strict = images.ImageCache(self.cache.directory, self.cache.max_bytes)
+        with self.assertRaises(images.ImageError):
+            strict.get(url, "thumb")
+        self.assertEqual(self.server.hits, {})
+
+        # A missing image falls back to the default, and isn't retried for a while
+        missing = self.server.url("/missing.jpg")
+        for _ in range(2):
+            resp = self.client.get(self.proxied(missing, "thumb"))
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location.split("/images/")[1],
+                             self.proxied(images.DEFAULT_IMAGE, "thumb").split("/images/")[1])
+        self.assertEqual(self.server.hits, {"/missing.jpg": 1})
+
+    def test_connects_to_checked_address(self):
+        """Is the address checked the one connected to, and every redirect checked too?"""
+
+        public = "93.184.216.34"
+        answers = {"img.example": public, "internal.example": "10.0.0.1"}
+        connected = []
+        getaddrinfo, create_connection = socket.getaddrinfo, socket.create_connection
+
+        def resolve(host, *args, **kwargs):
+            if host not in answers:
+                return getaddrinfo(host, *args, **kwargs)
+            address = answers[host]
+            # Rebinding: the next lookup of the name gets a private address
+            answers["img.example"] = "127.0.0.1"
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, 0))]
+
+        def connect(address, *args, **kwargs):
+            connected.append(address)
+            if address[0] != public:
+                raise OSError(f"Unreachable {address}")
+            return create_connection(("127.0.0.1", self.server.server.server_port),
+                                     *args, **kwargs)
+
+        strict = images.ImageCache(self.cache.directory, self.cache.max_bytes)
+        with mock.patch("socket.getaddrinfo", resolve), \
+                mock.patch("socket.create_connection", connect):
+            self.assertEqual(strict.fetch("http://img.example/avatar.jpg"),
+                             self.server.files["/avatar.jpg"])
+            self.assertEqual(connected, [(public, 80)])
+
+            with self.assertRaises(images.ImageError):
+                strict.fetch("http://img.example/avatar.jpg")
+
+            answers["img.example"] = public
+            self.server.redirects["/moved.jpg"] = "http://internal.example/avatar.jpg"
+            with self.assertRaisesRegex(images.ImageError, "non-public"):
+                strict.fetch("http://img.example/moved.jpg")
+
+        self.assertEqual(connected, [(public, 80)] * 2)
+        self.assertEqual(self.server.hits, {"/avatar.jpg": 1, "/moved.jpg": 1})
+
+    def test_production_needs_secret_key(self):
+        """Does production refuse to start with no SECRET_KEY of its own?"""
+
+        environ = {name: value for name, value in os.environ.items() if name != "SECRET_KEY"}
+        with mock.patch.dict(os.environ, environ, clear=True):
+            with self.assertRaisesRegex(RuntimeError, "SECRET_KEY"):
+                create_app("production")
+
+    def test_collapses_misses(self):
+        """Do concurrent misses for one image make one fetch?"""
+
+        self.server.delay = 0.2
+        url = self.server.url("/avatar.jpg")
+        results = []
+
+        def get():
+            results.append(self.cache.get(url, "thumb")[2])
+
+        threads = [threading.Thread(target=get) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.server.hits, {"/avatar.jpg": 1})
+        self.assertEqual(sorted(results), ["hit"] * 7 + ["miss"])
+
+    def test_evicts_least_recently_used(self):
+        """Does the cache stay under its size, dropping the oldest files first?"""
+
+        for n in range(6):
+            self.server.files[f"/{n}.jpg"] = make_image((400, 400), (n * 40, 0, 0))
+
+        cache = self.cache
+        for n in range(6):
+            cache.get(self.server.url(f"/{n}.jpg"), "thumb")
+            # Age each image's files by when it was cached
+            for path in all_files(cache.directory):
+                if os.path.getmtime(path) > 1_000_000:
+                    os.utime(path, (100 * (n + 1), 100 * (n + 1)))
+
+        # Room for about three images' worth of files, and the first used again
+        cache.max_bytes = cache_bytes(cache.directory) * 3.5 / 6
+        self.assertEqual(cache.get(self.server.url("/0.jpg"), "thumb")[2], "hit")
+
+        self.assertGreater(cache.evict(), 0)
+        self.assertLessEqual(cache_bytes(cache.directory), cache.max_bytes)
+
+        cache.get(self.server.url("/0.jpg"), "thumb")
+        cache.get(self.server.url("/5.jpg"), "thumb")
+        self.assertEqual(self.server.hits["/0.jpg"], 1)
+        self.assertEqual(self.server.hits["/5.jpg"], 1)
+
+        cache.get(self.server.url("/1.jpg"), "thumb")
+        self.assertEqual(self.server.hits["/1.jpg"], 2)
+
+
+def all_files(directory):
+    for kind in ("urls", "sources", "variants"):
+        for root, _, names in os.walk(os.path.join(directory, kind)):
+            yield from (os.path.join(root, name) for name in names)
+
+
+def cache_bytes(directory):
+    return sum(os.path.getsize(path) for path in all_files(directory))
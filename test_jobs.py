@@ -0,0 +1,191 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+from datetime import datetime, timedelta
+from unittest import mock
+
+from sqlalchemy.orm import Query
+
+from models import db, User, Job
+from fixtures import WarblerTestCase, make_user
+import jobs
+
+calls = []
+
+
+@jobs.job("record_call", max_attempts=3)
+def record_call(value):
+    calls.append(value)
+
+
+@jobs.job("always_fails", max_attempts=2)
+def always_fails():
+    raise RuntimeError("boom")
+
+
+@jobs.job("outlives_lease")
+def outlives_lease():
+    # As if the lease ran out meanwhile and another worker reclaimed the job
+    (Job.query
+     .filter_by(name="outlives_lease")
+     .update({"locked_by": "other-worker"}, synchronize_session=False))
+    db.session.commit()
+
+
+class JobTestCase(WarblerTestCase):
+    """Test queueing and running background jobs."""
+
+    def setUp(self):
+        """Make a worker."""
+
+        super().setUp()
+        calls.clear()
+
+        self.worker = jobs.Worker(self.app, concurrency=1, worker_id="test-worker")
+
+    def test_enqueue_and_run(self):
+        """Does a committed job get run and marked done?"""
+
+        jobs.enqueue("record_call", {"value": 7})
+        db.session.commit()
+
+        self.assertEqual(self.worker.run_once(), 1)
+        self.assertEqual(calls, [7])
+
+        job = Job.query.one()
+        self.assertEqual(job.status, "done")
+        self.assertEqual(job.attempts, 1)
+
+    def test_uncommitted_job_not_run(self):
+        """Is a job rolled back with its request never run?"""
+
+        jobs.enqueue("record_call", {"value": 7})
+        db.session.rollback()
+
+        self.assertEqual(self.worker.run_once(), 0)
+        self.assertEqual(calls, [])
+
+    def test_idempotency_key(self):
+        """Does enqueueing with the same key reuse the first job?"""
+
+        first = jobs.enqueue("record_call", {"value": 1}, idempotency_key="k")
+        db.session.commit()
+        second = jobs.enqueue("record_call", {"value": 2}, idempotency_key="k")
+        db.session.commit()
+
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(Job.query.count(), 1)
+
+    def test_idempotency_key_race(self):
+        """Does a key inserted after the check return that job, not fail?"""
+
+        first = jobs.enqueue("record_call", {"value": 1}, idempotency_key="k")
+        db.session.commit()
+
+        # As if another worker committed it between our SELECT and INSERT
+        with mock.patch.object(Query, "first", return_value=None):
+            second = jobs.enqueue("record_call", {"value": 2}, idempotency_key="k")
+        db.session.commit()
+
+        self.assertEqual(second.id, first.id)
+        self.assertEqual(Job.query.count(), 1)
+
+    def test_periodic(self):
+        """Do workers queue a periodic job once per period between them?"""
+
+        jobs.job("periodic", every=timedelta(hours=1))(lambda: calls.append("tick"))
+        self.addCleanup(jobs.HANDLERS.pop, "periodic")
+        self.addCleanup(jobs.SCHEDULES.pop, "periodic")
+
+        now = datetime(2024, 5, 1, 12, 30)
+        other = jobs.Worker(self.app, concurrency=1, worker_id="other-worker")
+        for worker, at in ((self.worker, now), (other, now),
+                           (self.worker, now + timedelta(minutes=20))):
+            worker.schedule(at)
+            db.session.commit()
+        self.assertEqual(Job.query.filter_by(name="periodic").count(), 1)
+
+        self.worker.schedule(now + timedelta(minutes=40))
+        db.session.commit()
+        self.assertEqual(Job.query.filter_by(name="periodic").count(), 2)
+
+    def test_reclaimed_job_left_alone(self):
+        """Does a worker that lost its lease leave the new holder's lease be?"""
+
+        jobs.enqueue("outlives_lease")
+        db.session.commit()
+
+        self.assertEqual(self.worker.run_once(), 1)
+
+        job = Job.query.one()
+        self.assertEqual((job.status, job.locked_by), ("running", "other-worker"))
+        self.assertIsNotNone(job.locked_until)
+
+    def test_unknown_job(self):
+        """Is enqueueing an unregistered job refused?"""
+
+        with self.assertRaises(jobs.UnknownJobError):
+            jobs.enqueue("no_such_job")
+
+    def test_retry_then_dead(self):
+        """Is a failing job retried with backoff, then given up on?"""
+
+        jobs.enqueue("always_fails")
+        db.session.commit()
+
+        self.worker.run_once()
+        job = Job.query.one()
+        self.assertEqual(job.status, "queued")
+        self.assertGreater(job.run_at, datetime.utcnow())
+        self.assertIn("boom", job.last_error)
+
+        # Not due yet, so nothing to claim
+        self.assertEqual(self.worker.run_once(), 0)
+
+        job = Job.query.one()
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        self.worker.run_once()
+
+        job = Job.query.one()
+        self.assertEqual(job.status, "dead")
+        self.assertEqual(job.attempts, 2)
+
+    def test_expired_lease_redelivered(self):
+        """Does a job held by a crashed worker get run again?"""
+
+        job = jobs.enqueue("record_call", {"value": 3})
+        job.status = "running"
+        job.attempts = 1
+        job.locked_by = "crashed-worker"
+        job.locked_until = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+
+        self.assertEqual(self.worker.run_once(), 1)
+        self.assertEqual(calls, [3])
+        self.assertEqual(Job.query.one().attempts, 2)
+
+    def test_admin_page_requires_admin(self):
+        """Can only admins see the job status page?"""
+
+        user = make_user("jobadmin")
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, user)
+
+            resp = c.get("/admin/jobs")
+            self.assertEqual(resp.status_code, 302)
+
+            self.app.config['ADMIN_USERNAMES'] = {"jobadmin"}
+            try:
+                resp = c.get("/admin/jobs")
+            finally:
+                self.app.config['ADMIN_USERNAMES'] = set()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Background jobs", str(resp.data))
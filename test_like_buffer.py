@@ -0,0 +1,109 @@
+"""Write-behind like buffer tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_like_buffer.py
+
+
+import shutil
+import tempfile
+
+from models import db, Likes
+from fixtures import WarblerTestCase, make_user, make_message, make_follow
+from like_buffer import LikeBuffer
+import message_stats
+
+
+class LikeBufferTestCase(WarblerTestCase):
+    """Test buffering, coalescing, flushing and replaying like toggles."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.fan = make_user("fan")
+        self.author = make_user("author")
+        make_follow(self.fan, self.author)
+        self.msg_id = make_message(self.author).id
+        db.session.commit()
+
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+        self.buffer = self.new_buffer()
+        self.app.extensions['like_buffer'] = self.buffer
+
+    def tearDown(self):
+        del self.app.extensions['like_buffer']
+        super().tearDown()
+
+    def new_buffer(self):
+        return LikeBuffer(self.app, self.dir, interval=None)
+
+    def toggle(self):
+        with self.client as c:
+            self.login(c, self.fan)
+            return c.post(f"/users/add_like/{self.msg_id}")
+
+    def test_pending_visible_then_flushed(self):
+        """Does the user see their like before it is written, and is it written?"""
+
+        self.toggle()
+        self.assertEqual(Likes.query.count(), 0)
+
+        with self.client as c:
+            self.login(c, self.fan)
+            html = c.get("/").get_data(as_text=True)
+
+        self.assertIn("btn-primary", html)
+        self.assertIn('<i class="fa fa-thumbs-up"></i> 1', html)
+
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(Likes.query.filter_by(user_id=self.fan.id).count(), 1)
+        self.assertEqual(message_stats.get_many([self.msg_id])[self.msg_id].likes, 1)
+
+    def test_coalesce(self):
+        """Does a like followed by an unlike write nothing?"""
+
+        self.toggle()
+        self.toggle()
+
+        self.assertEqual(self.buffer.pending, {})
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+
+        self.toggle()
+        self.buffer.flush()
+        self.toggle()
+        self.buffer.flush()
+
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(message_stats.get_many([self.msg_id])[self.msg_id].likes, 0)
+
+    def test_replay_after_crash(self):
+        """Are a dead worker's journalled toggles applied, exactly once?"""
+
+        self.toggle()
+
+        # The worker dies: its flock goes with it
+        journal = self.buffer.journal.name
+        shutil.copy(journal, journal + ".copy")
+        self.buffer.journal.close()
+
+        survivor = self.new_buffer()
+        self.assertEqual(survivor.recover(), 1)
+        self.assertEqual(Likes.query.count(), 1)
+
+        # Replaying the same intents again changes nothing
+        shutil.move(journal + ".copy", journal)
+        survivor.recover()
+
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(message_stats.get_many([self.msg_id])[self.msg_id].likes, 1)
+
+    def test_live_journal_left_alone(self):
+        """Is a journal still locked by a live worker skipped?"""
+
+        self.toggle()
+
+        self.assertEqual(self.new_buffer().recover(), 0)
+        self.assertEqual(Likes.query.count(), 0)
@@ -4,39 +4,22 @@
 #
 #   python3 -m unittest test_message_model.py 
 
-import os 
-from unittest import TestCase 
-from sqlalchemy import exc 
+from models import db, User, Message
+from fixtures import WarblerTestCase
 
-from models import db, User, Message, Follows 
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test" 
-
-from app import app 
-
-db.create_all()
-
-class MessageModelTestCase(TestCase):
+class MessageModelTestCase(WarblerTestCase):
     """Test model for messages."""
     
     def setUp(self):
-        """Create test client""" 
+        """Create a user to write messages""" 
         
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
+        super().setUp()
         
         u1 = User.signup("testuser1", "test1@test.com", "HASHED_PASSWORD", None)
         u1.id = 9999
         db.session.commit()
         
-        self.client = app.test_client()
-        
-    def tearDown(self):
-        """Rollback test client to previous session"""
-        res = super().tearDown()
-        db.session.rollback()
-        
     def test_message_model(self):
         """Successfully create a message instance"""
         message = Message(text="Test Message", user_id=9999)
@@ -0,0 +1,74 @@
+"""Message counter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_message_stats.py
+
+
+from models import db, MessageStats
+from fixtures import WarblerTestCase, make_user, make_message, make_follow, make_like
+import jobs
+import message_stats
+
+
+class MessageStatsTestCase(WarblerTestCase):
+    """Test keeping and reconciling per-message like counts."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.author = make_user("author")
+        self.fans = [make_user() for _ in range(3)]
+        make_follow(self.fans[0], self.author)
+        self.messages = [make_message(self.author) for _ in range(3)]
+        db.session.commit()
+
+        self.ids = [msg.id for msg in self.messages]
+
+    def toggle_like(self, user, message_id):
+        with self.client as c:
+            self.login(c, user)
+            c.post(f"/users/add_like/{message_id}")
+
+    def test_like_toggle_counts(self):
+        """Do liking and unliking keep the count, shown on the pages?"""
+
+        for fan in self.fans:
+            self.toggle_like(fan, self.ids[0])
+        self.toggle_like(self.fans[2], self.ids[0])
+
+        stats = message_stats.get_many(self.ids)
+        self.assertEqual(stats[self.ids[0]].likes, 2)
+        self.assertEqual(stats[self.ids[1]], message_stats.EMPTY)
+
+        with self.client as c:
+            self.login(c, self.fans[0])
+            html = c.get(f"/messages/{self.ids[0]}").get_data(as_text=True)
+            self.assertIn('<i class="fa fa-thumbs-up"></i> 2', html)
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn('<i class="fa fa-thumbs-up"></i> 2', html)
+
+    def test_reconcile(self):
+        """Does the reconciliation job fix drifted counts, in batches?"""
+
+        make_like(self.fans[0], self.messages[0])
+        make_like(self.fans[1], self.messages[0])
+        make_like(self.fans[0], self.messages[2])
+        db.session.add(MessageStats(message_id=self.ids[1], likes=7))
+        db.session.commit()
+
+        batch = message_stats.RECONCILE_BATCH
+        message_stats.RECONCILE_BATCH = 2
+        try:
+            jobs.enqueue("reconcile_message_stats")
+            db.session.commit()
+
+            worker = jobs.Worker(self.app, concurrency=1, worker_id="test-worker")
+            while worker.run_once():
+                pass
+        finally:
+            message_stats.RECONCILE_BATCH = batch
+
+        stats = message_stats.get_many(self.ids)
+        self.assertEqual([stats[id].likes for id in self.ids], [2, 0, 1])
@@ -0,0 +1,131 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import json
+import os
+import tempfile
+
+from sqlalchemy.exc import DBAPIError
+
+from models import User, db
+from fixtures import WarblerTestCase
+from metrics import Metrics, metrics
+
+
+class MetricsTestCase(WarblerTestCase):
+    """Test recording and rendering metrics."""
+
+    def test_histogram_render(self):
+        """Are histogram buckets cumulative, with sum and count?"""
+
+        m = Metrics()
+        labels = (("endpoint", "homepage"),)
+        m.observe("warbler_http_request_duration_seconds", labels, 0.003)
+        m.observe("warbler_http_request_duration_seconds", labels, 0.2)
+        m.observe("warbler_http_request_duration_seconds", labels, 30)
+
+        text = m.render()
+
+        self.assertIn('warbler_http_request_duration_seconds_bucket'
+                      '{endpoint="homepage",le="0.005"} 1', text)
+        self.assertIn('warbler_http_request_duration_seconds_bucket'
+                      '{endpoint="homepage",le="0.25"} 2', text)
+        self.assertIn('warbler_http_request_duration_seconds_bucket'
+                      '{endpoint="homepage",le="+Inf"} 3', text)
+        self.assertIn('warbler_http_request_duration_seconds_count'
+                      '{endpoint="homepage"} 3', text)
+        self.assertIn("# TYPE warbler_http_request_duration_seconds histogram", text)
+
+    def test_merges_worker_files(self):
+        """Are counters summed across workers, and dead workers' gauges dropped?"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            m = Metrics(directory=directory)
+            m.inc("warbler_sql_queries_total", (("endpoint", "homepage"),), 2)
+            m.add("warbler_http_requests_in_flight", amount=1)
+
+            # A worker that has since exited
+            dead = {"pid": 2 ** 22 + 1,
+                    "counters": [["warbler_sql_queries_total",
+                                  [["endpoint", "homepage"]], 5]],
+                    "gauges": [["warbler_http_requests_in_flight", [], 4]],
+                    "histograms": []}
+            with open(os.path.join(directory, "metrics-dead.json"), "w") as f:
+                json.dump(dead, f)
+
+            text = m.render()
+
+        self.assertIn('warbler_sql_queries_total{endpoint="homepage"} 7', text)
+        self.assertIn('warbler_http_requests_in_flight 1', text)
+
+    def test_boot_seconds_max(self):
+        """Are boot times merged by max across live workers, not summed?"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            m = Metrics(directory=directory)
+            m.set("warbler_boot_seconds", (("phase", "import"),), 2)
+
+            # Another worker that is still running
+            other = {"pid": os.getppid(),
+                     "counters": [],
+                     "gauges": [["warbler_boot_seconds", [["phase", "import"]], 3]],
+                     "histograms": []}
+            with open(os.path.join(directory, "metrics-other.json"), "w") as f:
+                json.dump(other, f)
+
+            text = m.render()
+
+        self.assertIn('warbler_boot_seconds{phase="import"} 3', text)
+
+    def test_failed_statement_timer_dropped(self):
+        """Does a statement that raises leave no start time on its connection?"""
+
+        with db.engine.connect() as conn:
+            with self.assertRaises(DBAPIError):
+                conn.execute("SELECT * FROM no_such_table")
+
+            self.assertEqual(conn.info.get("metrics_started"), [])
+
+    def test_label_escaping(self):
+        """Are quotes in label values escaped?"""
+
+        m = Metrics()
+        m.inc("warbler_cache_requests_total", (("cache", 'a"b'), ("result", "hit")))
+
+        self.assertIn('cache="a\\"b"', m.render())
+
+    def test_metrics_endpoint(self):
+        """Does /metrics report requests and SQL per route?"""
+
+        client = self.client
+        client.get("/users")
+
+        resp = client.get("/metrics")
+        text = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('endpoint="warbler.list_users",method="GET",status="200"', text)
+        self.assertIn('warbler_sql_queries_total{endpoint="warbler.list_users"}', text)
+
+    def test_metrics_token(self):
+        """Is a bearer token required once one is configured?"""
+
+        self.app.config['METRICS_TOKEN'] = "sekrit"
+        try:
+            client = self.client
+            self.assertEqual(client.get("/metrics").status_code, 401)
+            resp = client.get("/metrics", headers={"Authorization": "Bearer sekrit"})
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            self.app.config['METRICS_TOKEN'] = None
+
+    def test_bcrypt_tracked(self):
+        """Is password hashing timed?"""
+
+        User.signup("metricuser", "metric@test.com", "password", None)
+
+        self.assertIn('warbler_bcrypt_seconds_count{operation="hash"}', metrics.render())
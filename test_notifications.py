@@ -0,0 +1,139 @@
+"""Notification feed tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+
+from datetime import datetime, timedelta
+
+from models import db, Notification, NotificationActor, User
+from fixtures import WarblerTestCase, make_user, make_message
+import notifications
+import outbox
+
+
+class NotificationsTestCase(WarblerTestCase):
+    """Test aggregating likes and follows into notifications."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.author = make_user("author")
+        self.fans = [make_user(f"fan{n}") for n in range(3)]
+        self.message = make_message(self.author, text="notable warble")
+        db.session.commit()
+
+    def notify(self, *events, at=None):
+        """Feed the consumer (topic, payload) events, all at `at`."""
+
+        at = at or datetime.utcnow()
+        notifications.notify([outbox.Event(n, topic, payload, at)
+                              for n, (topic, payload) in enumerate(events)])
+        db.session.commit()
+
+    def unread(self):
+        return db.session.query(User.unread_notifications).filter_by(id=self.author.id).scalar()
+
+    def test_bursts_aggregate(self):
+        """Do likes and follows from the views collapse into one row each, counted once?"""
+
+        for fan in self.fans:
+            with self.client as c:
+                self.login(c, fan)
+                c.post(f"/users/add_like/{self.message.id}")
+                c.post(f"/users/follow/{self.author.id}")
+
+        while outbox.consume("notifications"):
+            pass
+
+        rows = Notification.query.filter_by(user_id=self.author.id).order_by(Notification.kind)
+        self.assertEqual([(row.kind, row.count, row.actor_id) for row in rows],
+                         [("follow", 3, self.fans[2].id), ("like", 3, self.fans[2].id)])
+        self.assertEqual(self.unread(), 2)
+
+        with self.client as c:
+            self.login(c, self.author)
+            self.assertIn(b'<span class="badge badge-danger">2</span>', c.get("/").data)
+
+            html = c.get("/notifications").data
+            self.assertIn(b"@fan2</a>", html)
+            self.assertIn(b"and 2 others", html)
+            self.assertIn(b"liked your", html)
+            self.assertIn(b"list-group-item-info", html)
+            self.assertNotIn(b"badge-danger", html)
+
+        self.assertEqual(self.unread(), 0)
+
+        # A like after they've looked starts a new row
+        self.notify(("like.created", {"user_id": self.fans[0].id,
+                                      "message_id": self.message.id}))
+        self.assertEqual(Notification.query.filter_by(user_id=self.author.id).count(), 3)
+        self.assertEqual(self.unread(), 1)
+
+    def test_actors_count_once(self):
+        """Does a user who likes again after someone else still count once?"""
+
+        like = lambda fan: ("like.created", {"user_id": fan.id, "message_id": self.message.id})
+        self.notify(like(self.fans[0]), like(self.fans[1]))
+        self.notify(like(self.fans[0]))
+        self.notify(like(self.fans[1]), like(self.fans[2]), like(self.fans[0]))
+
+        [row] = Notification.query.filter_by(user_id=self.author.id)
+        self.assertEqual((row.count, row.actor_id), (3, self.fans[0].id))
+        self.assertEqual(NotificationActor.query.filter_by(notification_id=row.id).count(), 3)
+
+        self.notify(("message.deleted", {"message_id": self.message.id,
+                                         "user_id": self.author.id}))
+        self.assertEqual(NotificationActor.query.count(), 0)
+
+    def test_window_and_deletion(self):
+        """Does a like outside the window start a row, and a deleted message take its rows?"""
+
+        like = ("like.created", {"user_id": self.fans[0].id, "message_id": self.message.id})
+        earlier = datetime.utcnow() - notifications.AGGREGATE_WINDOW - timedelta(minutes=1)
+        self.notify(like, at=earlier)
+        self.notify(like, ("like.created", {"user_id": self.author.id,
+                                            "message_id": self.message.id}))
+        self.notify(("follow.created", {"follower_id": self.fans[1].id,
+                                        "followed_id": self.author.id}))
+
+        self.assertEqual(Notification.query.filter_by(kind="like").count(), 2)
+        self.assertEqual(self.unread(), 3)
+
+        self.notify(("message.deleted", {"message_id": self.message.id,
+                                         "user_id": self.author.id}))
+        self.assertEqual([row.kind for row in Notification.query], ["follow"])
+        self.assertEqual(self.unread(), 1)
+
+    def test_pages_and_prune(self):
+        """Do cursors page through every row once, and the prune job drop old ones?"""
+
+        start = datetime.utcnow() - timedelta(days=1)
+        for n in range(5):
+            db.session.add(Notification(user_id=self.author.id, kind="follow",
+                                        actor_id=self.fans[0].id, updated_at=start))
+        db.session.add(Notification(user_id=self.author.id, kind="follow",
+                                    actor_id=self.fans[1].id,
+                                    updated_at=start - notifications.RETENTION))
+        self.author.unread_notifications = 6
+        db.session.commit()
+
+        seen, before = [], None
+        while True:
+            rows, before = notifications.page(self.author.id, before, limit=2)
+            seen.extend(row.id for row in rows)
+            if before is None:
+                break
+
+        expected = [row.id for row in (Notification.query
+                                       .order_by(Notification.updated_at.desc(),
+                                                 Notification.id.desc()))]
+        self.assertEqual(seen, expected)
+
+        with self.assertRaises(ValueError):
+            notifications.page(self.author.id, "yesterday")
+
+        notifications.prune()
+        self.assertEqual(Notification.query.count(), 5)
+        self.assertEqual(self.unread(), 5)
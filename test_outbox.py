@@ -0,0 +1,146 @@
+"""Outbox and consumer tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_outbox.py
+
+
+import json
+from datetime import datetime, timedelta
+
+from models import db, DailyActivity, OutboxEvent, OutboxOffset, User
+from fixtures import WarblerTestCase, make_user, make_message
+import jobs
+import outbox
+
+
+class OutboxTestCase(WarblerTestCase):
+    """Test publishing changes and feeding them to consumers."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = make_user()
+        self.other = make_user()
+        db.session.commit()
+
+    def events(self):
+        return [(row.topic, json.loads(row.payload))
+                for row in OutboxEvent.query.order_by(OutboxEvent.id)]
+
+    def test_views_publish(self):
+        """Does each change commit its event, and a purge publish what it removes?"""
+
+        msg = make_message(self.other)
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.user)
+            c.post(f"/users/follow/{self.other.id}")
+            c.post(f"/users/add_like/{msg.id}")
+            c.post("/messages/new", data={"text": "hello"})
+            c.post("/users/profile", data={"username": "renamed", "email": self.user.email,
+                                           "password": "password", "image_url": "",
+                                           "header_image_url": ""})
+            c.post("/users/delete")
+
+        mine = db.session.query(OutboxEvent.payload).filter_by(topic="message.created").scalar()
+        self.assertEqual(self.events(), [
+            ("follow.created", {"follower_id": self.user.id, "followed_id": self.other.id}),
+            ("like.created", {"user_id": self.user.id, "message_id": msg.id}),
+            ("message.created", {"message_id": json.loads(mine)["message_id"],
+                                 "user_id": self.user.id}),
+            ("user.updated", {"user_id": self.user.id,
+                              "fields": ["header_image_url", "image_url", "username"]}),
+            ("user.deleted", {"user_id": self.user.id}),
+        ])
+
+        OutboxEvent.query.delete()
+        worker = jobs.Worker(self.app, concurrency=1, worker_id="test-worker")
+        while worker.run_once():
+            pass
+
+        self.assertEqual(sorted(topic for topic, _ in self.events()),
+                         ["follow.deleted", "like.deleted", "message.deleted"])
+
+    def test_consume_and_replay(self):
+        """Does a consumer see each event once, and rebuild the same on replay?"""
+
+        for _ in range(3):
+            outbox.emit("message.created", message_id=1, user_id=self.user.id)
+        outbox.emit("follow.created", follower_id=self.user.id, followed_id=self.other.id)
+        db.session.commit()
+
+        self.assertEqual(outbox.consume("daily_activity"), 4)
+        self.assertEqual(outbox.consume("daily_activity"), 0)
+        self.assertEqual(outbox.lag()["daily_activity"], 0)
+
+        counts = {row.topic: row.count for row in DailyActivity.query}
+        self.assertEqual(counts, {"message.created": 3, "follow.created": 1})
+
+        outbox.replay("daily_activity")
+        self.assertEqual(DailyActivity.query.count(), 0)
+        self.assertEqual(outbox.lag()["daily_activity"], 4)
+
+        outbox.consume("daily_activity")
+        self.assertEqual({row.topic: row.count for row in DailyActivity.query}, counts)
+
+    def test_waits_for_gaps(self):
+        """Does a consumer wait for a missing id, then move on once it's old?"""
+
+        now = datetime.utcnow()
+        for id in (1, 2, 4):
+            db.session.add(OutboxEvent(id=id, topic="user.created", payload="{}",
+                                       created_at=now))
+        db.session.commit()
+
+        self.assertEqual(outbox.consume("daily_activity", now=now), 2)
+        self.assertEqual(outbox.consume("daily_activity", now=now), 0)
+
+        later = now + outbox.GAP_GRACE + timedelta(seconds=1)
+        self.assertEqual(outbox.consume("daily_activity", now=later), 1)
+        self.assertEqual(OutboxOffset.query.get("daily_activity").position, 4)
+
+    def test_failed_batch_retried(self):
+        """Is a failing batch rolled back, leaving the consumer where it was?"""
+
+        seen = []
+
+        @outbox.consumer("flaky", topics={"user.created"})
+        def flaky(events):
+            seen.extend(event.payload["user_id"] for event in events)
+            make_user()
+            if len(seen) == 1:
+                raise RuntimeError("projection unavailable")
+
+        self.addCleanup(outbox.CONSUMERS.pop, "flaky")
+
+        outbox.emit("user.created", user_id=7)
+        db.session.commit()
+        users = User.query.count()
+
+        runner = outbox.Runner(self.app, ["flaky"])
+        self.assertEqual(runner.run_once(), 0)
+        self.assertEqual(User.query.count(), users)
+
+        self.assertEqual(runner.run_once(), 1)
+        self.assertEqual(seen, [7, 7])
+
+    def test_prune(self):
+        """Are old events deleted once every consumer has read them, and only then?"""
+
+        old = datetime.utcnow() - outbox.RETENTION - timedelta(hours=1)
+        for id in (1, 2, 3):
+            db.session.add(OutboxEvent(id=id, topic="user.created", payload="{}",
+                                       created_at=old))
+        db.session.add(OutboxEvent(id=4, topic="user.created", payload="{}"))
+        db.session.commit()
+
+        self.assertEqual(outbox.consume("daily_activity"), 4)
+        self.assertEqual(outbox.prune(), 0)
+
+        runner = outbox.Runner(self.app)
+        self.assertEqual(runner.run_once(), 4 * (len(outbox.CONSUMERS) - 1))
+
+        self.assertEqual(outbox.prune(), 3)
+        self.assertEqual([row.id for row in OutboxEvent.query], [4])
@@ -0,0 +1,109 @@
+"""Anonymous page cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_page_cache.py
+
+
+from sqlalchemy import event
+
+from models import db, User
+from fixtures import WarblerTestCase, make_user, make_message, make_like
+
+
+class PageCacheTestCase(WarblerTestCase):
+    """Test caching whole pages for visitors who aren't logged in."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = make_user("author", bio="first bio")
+        self.message = make_message(self.user, text="cached warble")
+        self.liker = make_user()
+        make_like(self.liker, self.message)
+        db.session.commit()
+
+    def test_hit_needs_no_query(self):
+        """Is a repeated anonymous GET served from the cache, without any SQL?"""
+
+        path = f"/users/{self.user.id}"
+        resp = self.client.get(path)
+        self.assertEqual(resp.headers["X-Cache"], "miss")
+
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            cached = self.client.get(path)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+
+        self.assertEqual(cached.headers["X-Cache"], "hit")
+        self.assertEqual(cached.data, resp.data)
+        self.assertEqual(statements, [])
+
+        # Another query string is another page; logged-in users skip the cache
+        self.assertEqual(self.client.get(path + "?page=2").headers["X-Cache"], "miss")
+        with self.client as c:
+            self.login(c, self.user)
+            resp = c.get(path)
+        self.assertNotIn("X-Cache", resp.headers)
+        self.assertIn(b"Edit Profile", resp.data)
+
+    def test_purged_by_edits(self):
+        """Does editing a profile or deleting a message purge the pages showing it?"""
+
+        profile, message = f"/users/{self.user.id}", f"/messages/{self.message.id}"
+        anonymous = self.app.test_client()
+        for path in (profile, message):
+            anonymous.get(path)
+            self.assertEqual(anonymous.get(path).headers["X-Cache"], "hit")
+
+        with self.client as c:
+            self.login(c, self.user)
+            c.post("/users/profile", data={"username": "renamed", "email": self.user.email,
+                                           "password": "password", "image_url": "",
+                                           "header_image_url": ""})
+
+        resp = anonymous.get(message)
+        self.assertEqual(resp.headers["X-Cache"], "miss")
+        self.assertIn(b"@renamed", resp.data)
+        self.assertIn(b"@renamed", anonymous.get(profile).data)
+
+        with self.client as c:
+            self.login(c, self.user)
+            c.post(f"/messages/{self.message.id}/delete")
+
+        self.assertEqual(anonymous.get(message).status_code, 404)
+        self.assertNotIn(b"cached warble", anonymous.get(profile).data)
+
+    def test_stale_while_revalidate(self):
+        """Is a stale page served once more, and re-rendered after the response?"""
+
+        page_cache = self.app.extensions['page_cache']
+        ttls = page_cache.ttls
+        page_cache.ttls = dict(ttls, **{"warbler.users_show": (0, 60)})
+        self.addCleanup(setattr, page_cache, "ttls", ttls)
+
+        path = f"/users/{self.user.id}"
+        self.client.get(path)
+        User.query.get(self.user.id).bio = "second bio"
+        db.session.commit()
+
+        stale = self.client.get(path)
+        self.assertEqual(stale.headers["X-Cache"], "stale")
+        self.assertIn(b"first bio", stale.data)
+
+        # Only the first request to find it stale refreshes it
+        self.assertIn(b"first bio", self.client.get(path).data)
+
+        stale.close()
+        refreshed = self.client.get(path)
+        self.assertEqual(refreshed.headers["X-Cache"], "stale")
+        self.assertIn(b"second bio", refreshed.data)
+
+    def test_like_count_is_profile_users(self):
+        """Does a profile count its own user's likes, for anyone viewing it?"""
+
+        self.assertIn(f'/users/{self.liker.id}/likes">1</a>'.encode(),
+                      self.client.get(f"/users/{self.liker.id}").data)
@@ -0,0 +1,126 @@
+"""Sampling profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+
+import threading
+import time
+from unittest import TestCase
+
+from models import db
+from fixtures import WarblerTestCase, make_user
+from profiler import SamplingProfiler
+
+
+def busy_wait(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+class SamplingProfilerTestCase(TestCase):
+    """Test the sampler itself."""
+
+    def test_samples_target_thread(self):
+        """Are only the registered threads sampled?"""
+
+        prof = SamplingProfiler()
+        prof.start(rate=1.0, duration=5, interval=0.001)
+
+        def target():
+            prof.targets[threading.get_ident()] = "test"
+            busy_wait(0.2)
+            prof.targets.pop(threading.get_ident())
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        busy_wait(0.1)
+        thread.join()
+        prof.stop()
+
+        self.assertEqual(prof.status["state"], "finished")
+        self.assertGreater(prof.status["samples"], 0)
+        for stack, count in prof.top():
+            self.assertIn("busy_wait", stack)
+            self.assertIn("target", stack)
+
+        self.assertIn("busy_wait", prof.collapsed())
+
+    def test_duration_limit(self):
+        """Does a capture stop itself at the duration cap?"""
+
+        prof = SamplingProfiler(max_duration=0.05)
+        prof.start(duration=60, interval=0.01)
+        prof.thread.join(timeout=2)
+
+        self.assertFalse(prof.active)
+        self.assertEqual(prof.status["stopped_because"], "duration limit")
+
+    def test_one_capture_at_a_time(self):
+        """Is a second capture refused while one is running?"""
+
+        prof = SamplingProfiler()
+        self.assertTrue(prof.start(duration=5))
+        self.assertFalse(prof.start(duration=5))
+        prof.stop()
+
+
+class ProfilerViewTestCase(WarblerTestCase):
+    """Test the admin profiler pages."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.admin = make_user("profadmin")
+        db.session.commit()
+
+        self.profiler = self.app.extensions['profiler']
+        self.app.config['ADMIN_USERNAMES'] = {"profadmin"}
+
+    def tearDown(self):
+        self.app.config['ADMIN_USERNAMES'] = set()
+        if self.profiler.active:
+            self.profiler.stop()
+        super().tearDown()
+
+    def test_requires_admin(self):
+        """Are non-admins kept out?"""
+
+        self.app.config['ADMIN_USERNAMES'] = set()
+
+        with self.client as c:
+            self.login(c, self.admin)
+
+            self.assertEqual(c.get("/admin/profiler").status_code, 302)
+            self.assertEqual(c.get("/admin/profiler/download").status_code, 302)
+
+    def test_capture_and_download(self):
+        """Can an admin start, stop and download a capture?"""
+
+        with self.client as c:
+            self.login(c, self.admin)
+
+            resp = c.post("/admin/profiler",
+                          data={"rate": 1, "endpoint": "list_users", "duration": 10})
+            self.assertEqual(resp.status_code, 302)
+            self.assertTrue(self.profiler.active)
+            self.assertEqual(self.profiler.endpoint, "warbler.list_users")
+
+            c.get("/users")
+            c.post("/admin/profiler/stop")
+            self.assertFalse(self.profiler.active)
+
+            resp = c.get("/admin/profiler/download")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("attachment", resp.headers["Content-Disposition"])
+
+    def test_unknown_endpoint(self):
+        """Is an endpoint that doesn't exist refused?"""
+
+        with self.client as c:
+            self.login(c, self.admin)
+
+            c.post("/admin/profiler", data={"rate": 1, "endpoint": "nope", "duration": 10})
+            self.assertFalse(self.profiler.active)
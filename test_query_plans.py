@@ -0,0 +1,72 @@
+"""Query plan tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+
+import random
+
+from models import db
+from fixtures import WarblerTestCase, make_user, make_message, make_follow, make_like
+import benchmark
+import query_plans
+
+
+class QueryPlanTestCase(WarblerTestCase):
+    """Test that no route scans a large table it isn't expected to."""
+
+    def test_no_unexpected_scans(self):
+        """Does every statement of every route use an index on large tables?"""
+
+        bench = make_user(username=benchmark.BENCH_USERNAME)
+        users = [make_user() for _ in range(6)]
+        for user in users[:3]:
+            make_follow(bench, user)
+            make_follow(user, bench)
+        messages = [make_message(user, text="morning #song @user1") for user in users + [bench]]
+        for message in messages[:4]:
+            make_like(bench, message)
+        db.session.commit()
+
+        self.app.config['ADMIN_USERNAMES'] = {benchmark.BENCH_USERNAME}
+        self.addCleanup(self.app.config.__setitem__, 'ADMIN_USERNAMES', set())
+
+        builders = benchmark.route_builders()
+        plans = query_plans.capture(self.app, builders, benchmark.Context(random.Random(7)),
+                                    avoid_scans=True)
+
+        self.assertEqual(set(plans), set(builders))
+        self.assertTrue(plans["warbler.homepage"])
+
+        # A streamed body's queries count too
+        self.assertTrue(any("FROM likes" in statement.sql
+                            for statement in plans["warbler.export_user"]))
+        self.assertEqual(query_plans.unexpected_scans(plans), [])
+
+    def test_flags_scans(self):
+        """Is a scan of a large table reported, and an index search not?"""
+
+        connection = db.session.connection()
+        if connection.dialect.name == "sqlite":
+            param, params = "?", ("2020-01-01",)
+        else:
+            param, params = "%(t)s", {"t": "2020-01-01"}
+            connection.execute("SET LOCAL enable_seqscan = off")
+
+        _, scans = query_plans.explain(
+            connection, f"SELECT id FROM likes WHERE timestamp > {param}", params)
+        self.assertEqual(scans, {"likes"})
+
+        plan, scans = query_plans.explain(
+            connection, f"SELECT id FROM likes WHERE message_id = {param}", params)
+        self.assertEqual(scans, set())
+        self.assertIn("likes", plan[0])
+
+    def test_normalize(self):
+        """Are IN lists of any length written alike?"""
+
+        self.assertEqual(query_plans.normalize("SELECT id\n  FROM users WHERE id IN (?, ?, ?)"),
+                         "SELECT id FROM users WHERE id IN (...)")
+        self.assertEqual(query_plans.normalize("WHERE id IN (%(id_1)s, %(id_2)s)"),
+                         "WHERE id IN (...)")
@@ -0,0 +1,124 @@
+"""Rate limiting tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+from unittest import TestCase
+
+from app import create_app
+from cache import LocalCache
+from models import db, Message
+from fixtures import WarblerTestCase, make_user
+from metrics import metrics
+import ratelimit
+
+
+class SlidingWindowTestCase(TestCase):
+    """Test the sliding-window arithmetic."""
+
+    def test_parse(self):
+        """Are policy strings parsed, and bad ones refused?"""
+
+        self.assertEqual(ratelimit.parse("user 30/minute; ip 5 / second"),
+                         [("user", 30, 60), ("ip", 5, 1)])
+        with self.assertRaises(ValueError):
+            ratelimit.parse("user 30 per minute")
+
+    def test_window_slides(self):
+        """Does the previous window's count fade out as the window slides?"""
+
+        cache = LocalCache()
+        start = 6000.0
+
+        # The fourth is refused until 4 * (1 - t / 60) + 1 <= 3 in the next
+        # window, at t = 30: 57 + 30 seconds on
+        self.assertEqual([ratelimit.hit(cache, "k", 3, 60, start + i) for i in range(4)],
+                         [0, 0, 0, 87])
+
+        # Halfway through the next window, 4 * 0.5 + 1 fits; one more doesn't
+        # until the previous window has slid out entirely
+        self.assertEqual(ratelimit.hit(cache, "k", 3, 60, start + 90), 0)
+        self.assertEqual(ratelimit.hit(cache, "k", 3, 60, start + 90), 30)
+
+
+class RateLimitViewsTestCase(WarblerTestCase):
+    """Test limits on the write endpoints."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = make_user()
+        self.other = make_user()
+        db.session.commit()
+
+        limiter = self.app.extensions['ratelimit']
+        policies = limiter.policies
+        limiter.policies = dict(policies, **{
+            "warbler.messages_add": ratelimit.parse("user 2/minute"),
+            "warbler.login": ratelimit.parse("ip 1/hour"),
+        })
+        self.addCleanup(setattr, limiter, "policies", policies)
+
+    def post(self, user, text="limited"):
+        with self.client as c:
+            self.login(c, user)
+            return c.post("/messages/new", data={"text": text})
+
+    def test_per_user(self):
+        """Is each user limited separately, with a Retry-After?"""
+
+        self.assertEqual([self.post(self.user).status_code for _ in range(2)], [302, 302])
+
+        resp = self.post(self.user)
+        self.assertEqual(resp.status_code, 429)
+        self.assertGreaterEqual(int(resp.headers["Retry-After"]), 1)
+
+        self.assertEqual(self.post(self.other).status_code, 302)
+        self.assertEqual(Message.query.filter_by(text="limited").count(), 3)
+
+        # Reading the form isn't a write
+        with self.client as c:
+            self.login(c, self.user)
+            self.assertEqual(c.get("/messages/new").status_code, 200)
+
+    def test_per_ip(self):
+        """Are anonymous requests limited by address?"""
+
+        data = {"username": self.user.username, "password": "wrong"}
+        self.assertEqual(self.client.post("/login", data=data).status_code, 200)
+        self.assertEqual(self.client.post("/login", data=data).status_code, 429)
+
+    def test_refusals_measured(self):
+        """Is a 429 timed, and left out of the requests in flight?"""
+
+        in_flight = ("warbler_http_requests_in_flight", ())
+        refused = ("warbler_http_request_duration_seconds",
+                   (("endpoint", "warbler.login"), ("method", "POST"), ("status", "429")))
+        before = metrics.gauges.get(in_flight, 0)
+        timed = sum(metrics.histograms.get(refused, [0])[:-1])
+
+        data = {"username": self.user.username, "password": "wrong"}
+        for _ in range(3):
+            self.client.post("/login", data=data)
+
+        self.assertEqual(metrics.gauges.get(in_flight), before)
+        self.assertEqual(sum(metrics.histograms[refused][:-1]), timed + 2)
+
+    def test_behind_proxy(self):
+        """With a trusted proxy, are "ip" limits per forwarded client address?"""
+
+        app = create_app("testing", {
+            'SQLALCHEMY_DATABASE_URI': self.app.config['SQLALCHEMY_DATABASE_URI'],
+            'TRUSTED_PROXIES': 1,
+            'RATE_LIMITS': {"warbler.login": "ip 1/hour"},
+        })
+        client = app.test_client()
+
+        def login(address):
+            return client.post("/login", environ_base={"REMOTE_ADDR": "10.0.0.1"},
+                               headers={"X-Forwarded-For": address}).status_code
+
+        self.assertEqual([login("198.51.100.1"), login("198.51.100.2")], [200, 200])
+        self.assertEqual(login("198.51.100.1"), 429)
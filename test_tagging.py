@@ -0,0 +1,115 @@
+"""Hashtag and mention tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tagging.py
+
+
+from models import db, Message, MessageTag, Mention, Tag
+from fixtures import WarblerTestCase, make_user, make_message
+import tagging
+
+
+class TaggingTestCase(WarblerTestCase):
+    """Test indexing tags and mentions and paging through them."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.author = make_user("author")
+        self.friend = make_user("friend")
+        db.session.commit()
+
+    def post(self, text):
+        with self.client as c:
+            self.login(c, self.author)
+            c.post("/messages/new", data={"text": text})
+        return Message.query.filter_by(text=text).one().id
+
+    def test_extract(self):
+        """Are tags lowercased and repeats dropped, and emails not mentions?"""
+
+        self.assertEqual(tagging.extract("#Birds #birds at a#b me@x.com @friend &#39;"),
+                         (["birds"], ["friend"]))
+
+    def test_post_indexes(self):
+        """Does posting record tags, counts and mentions of real users?"""
+
+        msg_id = self.post("Dawn #Chorus with @friend and @nobody")
+        self.post("more #chorus")
+
+        tag = Tag.query.filter_by(name="chorus").one()
+        self.assertEqual(tag.message_count, 2)
+        self.assertEqual(Mention.query.filter_by(message_id=msg_id).one().user_id,
+                         self.friend.id)
+
+        with self.client as c:
+            html = c.get(f"/messages/{msg_id}").get_data(as_text=True)
+            self.assertIn('<a href="/tags/chorus">#Chorus</a>', html)
+
+            html = c.get("/tags/Chorus").get_data(as_text=True)
+            self.assertIn("2 warbles", html)
+            self.assertIn("Dawn", html)
+
+            html = c.get(f"/users/{self.friend.id}/mentions").get_data(as_text=True)
+            self.assertIn("Dawn", html)
+
+            self.assertEqual(c.get("/tags/nothing").status_code, 404)
+
+    def test_pages(self):
+        """Do the pages walk the tag newest first without overlap?"""
+
+        ids = [self.post(f"number {i} #count") for i in range(5)]
+
+        page_size = tagging.PAGE_SIZE
+        tagging.PAGE_SIZE = 2
+        try:
+            seen = []
+            url = "/tags/count"
+            with self.client as c:
+                while url:
+                    resp = c.get(url)
+                    self.assertEqual(resp.status_code, 200)
+                    html = resp.get_data(as_text=True)
+                    seen += sorted((id for id in ids if f'href="/messages/{id}"' in html),
+                                   key=lambda id: html.index(f'href="/messages/{id}"'))
+                    url = _next_url(html)
+        finally:
+            tagging.PAGE_SIZE = page_size
+
+        self.assertEqual(seen, ids[::-1])
+
+    def test_delete_unindexes(self):
+        """Does deleting a message take it out of its tags and mentions?"""
+
+        msg_id = self.post("gone #soon @friend")
+
+        with self.client as c:
+            self.login(c, self.author)
+            c.post(f"/messages/{msg_id}/delete")
+
+        self.assertEqual(Tag.query.filter_by(name="soon").one().message_count, 0)
+        self.assertEqual(MessageTag.query.count(), 0)
+        self.assertEqual(Mention.query.count(), 0)
+
+    def test_backfill(self):
+        """Does the backfill index old messages, and running it twice change nothing?"""
+
+        for text in ("old #news", "older #news @friend", "untagged"):
+            make_message(self.author, text)
+        db.session.commit()
+
+        self.assertEqual(tagging.backfill(chunk=2), 3)
+        self.assertEqual(tagging.backfill(chunk=2), 3)
+
+        self.assertEqual(Tag.query.filter_by(name="news").one().message_count, 2)
+        self.assertEqual(MessageTag.query.count(), 2)
+        self.assertEqual(Mention.query.count(), 1)
+
+
+def _next_url(html):
+    marker = 'class="btn btn-outline-secondary btn-sm mt-2">Older'
+    if marker not in html:
+        return None
+    href = html[:html.index(marker)].rsplit('href="', 1)[1]
+    return href.split('"', 1)[0].replace("&amp;", "&")
@@ -0,0 +1,111 @@
+"""Trending tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+from datetime import datetime, timedelta
+
+from models import db, MessageScore
+from fixtures import WarblerTestCase, make_user, make_message, make_like
+import trending
+
+
+class TrendingTestCase(WarblerTestCase):
+    """Test time-decayed scores and the trending page."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.author = make_user("author")
+        self.fans = [make_user() for _ in range(3)]
+        self.messages = [make_message(self.author) for _ in range(3)]
+        db.session.commit()
+
+        self.ids = [msg.id for msg in self.messages]
+        self.board = self.app.extensions['trending'] = trending.TrendingBoard(size=2)
+
+    def like(self, user, message_id):
+        with self.client as c:
+            self.login(c, user)
+            return c.post(f"/users/add_like/{message_id}")
+
+    def test_decay(self):
+        """Is a like worth half as much a half-life later?"""
+
+        now = datetime.utcnow()
+        log_score = trending.like_weight(now - timedelta(seconds=trending.HALF_LIFE))
+
+        self.assertAlmostEqual(trending.score(log_score, now), 0.5)
+
+    def test_like_and_unlike(self):
+        """Do likes raise a score and unliking take it back out?"""
+
+        self.like(self.fans[0], self.ids[0])
+        self.like(self.fans[1], self.ids[0])
+
+        score = trending.score(MessageScore.query.get(self.ids[0]).log_score)
+        self.assertAlmostEqual(score, 2, places=3)
+
+        self.like(self.fans[0], self.ids[0])
+        score = trending.score(MessageScore.query.get(self.ids[0]).log_score)
+        self.assertAlmostEqual(score, 1, places=3)
+
+        self.like(self.fans[1], self.ids[0])
+        self.assertIsNone(MessageScore.query.get(self.ids[0]))
+
+    def test_ranking(self):
+        """Are recent likes ranked above old ones, and the board bounded?"""
+
+        old = datetime.utcnow() - timedelta(seconds=2 * trending.HALF_LIFE)
+        for fan in self.fans:
+            make_like(fan, self.messages[0]).timestamp = old
+        make_like(self.fans[0], self.messages[1])
+        make_like(self.fans[1], self.messages[1])
+        make_like(self.fans[0], self.messages[2])
+        db.session.commit()
+
+        self.assertEqual(trending.rebuild(), 3)
+        self.assertEqual(self.board.top(), [self.ids[1], self.ids[2]])
+
+        # A like made by this process moves the message up right away
+        self.like(self.fans[2], self.ids[2])
+        self.like(self.fans[1], self.ids[2])
+        self.assertEqual(self.board.top(), [self.ids[2], self.ids[1]])
+
+        resp = self.client.get("/trending")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertLess(html.index(f"/messages/{self.ids[2]}"),
+                        html.index(f"/messages/{self.ids[1]}"))
+        self.assertNotIn(f"/messages/{self.ids[0]}\"", html)
+
+    def test_rebuild_matches_incremental(self):
+        """Does a rebuild reproduce the scores kept up by liking?"""
+
+        for fan in self.fans:
+            self.like(fan, self.ids[0])
+        self.like(self.fans[0], self.ids[1])
+
+        incremental = {row.message_id: row.log_score for row in MessageScore.query}
+        trending.rebuild()
+        rebuilt = {row.message_id: row.log_score for row in MessageScore.query}
+
+        self.assertEqual(incremental.keys(), rebuilt.keys())
+        for message_id, log_score in rebuilt.items():
+            self.assertAlmostEqual(log_score, incremental[message_id])
+
+    def test_prune(self):
+        """Are decayed scores pruned?"""
+
+        db.session.add(MessageScore(message_id=self.ids[0],
+                                    log_score=trending.threshold() - 1))
+        db.session.add(MessageScore(message_id=self.ids[1],
+                                    log_score=trending.threshold() + 1))
+        db.session.commit()
+
+        trending.prune()
+
+        self.assertEqual([row.message_id for row in MessageScore.query], [self.ids[1]])
@@ -1,27 +1,16 @@
 """User View Tests."""
 
-import os 
-from unittest import TestCase 
-from models import db, connect_db, Message, User, Follows 
+from models import db, Message, User, Follows 
+from app import CURR_USER_KEY 
+from fixtures import WarblerTestCase 
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test" 
-
-from app import app, CURR_USER_KEY 
-
-db.create_all()
-
-app.config['WTF_CSRF_ENABLED'] = False 
-
-class UserViewTestCase(TestCase):
+class UserViewTestCase(WarblerTestCase):
     """Test views for Users."""
     
     def setUp(self):
         """Create test client, add sample data."""
         
-        db.drop_all()
-        db.create_all()
-        
-        self.client = app.test_client()
+        super().setUp()
 
         self.testuser = User.signup(username="testuser",
                                     email="test@test.com",
@@ -41,11 +30,6 @@ class UserViewTestCase(TestCase):
         self.u4 = User.signup("testing", "test4@test.com", "password", None)
 
         db.session.commit()
-        
-    def tearDown(self):
-        response = super().tearDown()
-        db.session.rollback()
-        return response 
     
     def test_show_users(self):
         """Can anybody see the users page?"""
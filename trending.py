@@ -0,0 +1,233 @@
+"""Trending warbles: messages ranked by time-decayed likes.
+
+A like is worth 1 when it is made and half as much every HALF_LIFE
+seconds after; a message's score is the sum over its likes. Because every
+score decays at the same rate, the ranking only changes when someone
+likes or unlikes, so we store each message's score in a form that doesn't
+decay:
+
+    log_score = log(sum over likes of exp(DECAY * (liked_at - EPOCH)))
+
+and the score right now is exp(log_score - DECAY * (now - EPOCH)). Liking
+and unliking update one `message_scores` row in the same transaction as
+the like itself; nothing is recomputed per request.
+
+Each process keeps the top TOP_K messages in a sorted list
+(`TrendingBoard`), updated by its own likes and re-read from the table
+every SWEEP_SECONDS, dropping messages whose score has decayed below
+MIN_SCORE. An hourly job prunes such rows from the table.
+
+If the table is lost or gets out of step, rebuild it from `likes` with:
+
+    flask trending-rebuild
+"""
+
+import math
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from deletion import purge_hook
+from models import db, Likes, MessageScore
+import jobs
+
+HALF_LIFE = 6 * 60 * 60
+DECAY = math.log(2) / HALF_LIFE
+EPOCH = datetime(2020, 1, 1)
+
+# Below this, a message is no longer trending (one like, four half-lives on)
+MIN_SCORE = 1 / 16
+
+TOP_K = 100
+SWEEP_SECONDS = 60
+
+# Likes older than this add less than a millionth each; rebuild skips them
+REBUILD_WINDOW = timedelta(seconds=20 * HALF_LIFE)
+
+
+def like_weight(liked_at):
+    """The log of a like's contribution to `log_score`."""
+
+    return DECAY * (liked_at - EPOCH).total_seconds()
+
+
+def threshold(now=None):
+    """The lowest `log_score` that is still trending at `now`."""
+
+    return like_weight(now or datetime.utcnow()) + math.log(MIN_SCORE)
+
+
+def score(log_score, now=None):
+    """A message's decayed score at `now`."""
+
+    return math.exp(log_score - like_weight(now or datetime.utcnow()))
+
+
+def _logaddexp(a, b):
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+
+##############################################################################
+# Maintaining scores
+
+
+def record_like(message_id, liked_at):
+    """Add a like to the message's score and return the new `log_score`.
+
+    The caller commits.
+    """
+
+    weight = like_weight(liked_at)
+    row = MessageScore.query.with_for_update().get(message_id)
+
+    if row is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(MessageScore(message_id=message_id, log_score=weight))
+            return weight
+        except IntegrityError:
+            # Someone else scored the message first
+            row = MessageScore.query.with_for_update().get(message_id)
+
+    row.log_score = _logaddexp(row.log_score, weight)
+    return row.log_score
+
+
+def record_unlike(message_id, liked_at):
+    """Take a like back out of the message's score; return the new `log_score`.
+
+    Returns None if the message is no longer trending. The caller commits.
+    """
+
+    row = MessageScore.query.with_for_update().get(message_id)
+    if row is None:
+        return None
+
+    weight = like_weight(liked_at)
+    remaining = (row.log_score + math.log1p(-math.exp(weight - row.log_score))
+                 if weight < row.log_score else None)
+
+    if remaining is None or remaining < threshold():
+        db.session.delete(row)
+        return None
+
+    row.log_score = remaining
+    return remaining
+
+
+@jobs.job("trending_prune", every=timedelta(hours=1))
+def prune():
+    """Delete the scores of messages that are no longer trending."""
+
+    (MessageScore.query
+     .filter(MessageScore.log_score < threshold())
+     .delete(synchronize_session=False))
+    db.session.commit()
+
+
+def rebuild(batch_size=10_000):
+    """Recompute every score from `likes`; return how many are trending."""
+
+    now = datetime.utcnow()
+    scores = {}
+
+    likes = (db.session
+             .query(Likes.message_id, Likes.timestamp)
+             .filter(Likes.timestamp >= now - REBUILD_WINDOW)
+             .yield_per(batch_size))
+
+    for message_id, liked_at in likes:
+        weight = like_weight(liked_at)
+        scores[message_id] = (_logaddexp(scores[message_id], weight)
+                              if message_id in scores else weight)
+
+    lowest = threshold(now)
+    rows = [{"message_id": message_id, "log_score": log_score}
+            for message_id, log_score in scores.items()
+            if log_score >= lowest]
+
+    MessageScore.query.delete(synchronize_session=False)
+    for start in range(0, len(rows), batch_size):
+        db.session.bulk_insert_mappings(MessageScore, rows[start:start + batch_size])
+    db.session.commit()
+
+    return len(rows)
+
+
+@purge_hook("likes")
+@purge_hook("likes_received")
+def forget_purged_likes(user_id, ids):
+    for message_id, liked_at in (db.session
+                                 .query(Likes.message_id, Likes.timestamp)
+                                 .filter(Likes.id.in_(ids))):
+        record_unlike(message_id, liked_at)
+
+
+@purge_hook("messages")
+def forget_purged_messages(user_id, ids):
+    (MessageScore.query
+     .filter(MessageScore.message_id.in_(ids))
+     .delete(synchronize_session=False))
+
+
+##############################################################################
+# The top of the table, in memory
+
+
+class TrendingBoard:
+    """The `size` highest scores, kept sorted in this process."""
+
+    def __init__(self, size=TOP_K, sweep_seconds=SWEEP_SECONDS):
+        self.size = size
+        self.sweep_seconds = sweep_seconds
+        self.lock = threading.Lock()
+        self.scores = {}          # message id -> log_score
+        self.ranked = []          # (-log_score, message id), best first
+        self.swept_at = None
+
+    def top(self, n=TOP_K):
+        """Ids of the `n` top trending messages, best first."""
+
+        if self.swept_at is None or time.monotonic() - self.swept_at > self.sweep_seconds:
+            self.sweep()
+
+        lowest = threshold()
+        with self.lock:
+            return [message_id for neg, message_id in self.ranked[:n] if -neg >= lowest]
+
+    def sweep(self):
+        """Re-read the top of the table, leaving out decayed scores."""
+
+        rows = (db.session
+                .query(MessageScore.message_id, MessageScore.log_score)
+                .filter(MessageScore.log_score >= threshold())
+                .order_by(MessageScore.log_score.desc())
+                .limit(self.size)
+                .all())
+
+        with self.lock:
+            self.scores = dict(rows)
+            self.ranked = sorted((-log_score, message_id) for message_id, log_score in rows)
+            self.swept_at = time.monotonic()
+
+    def update(self, message_id, log_score):
+        """Apply a score change made by this process (None: removed)."""
+
+        with self.lock:
+            old = self.scores.pop(message_id, None)
+            if old is not None:
+                del self.ranked[bisect_left(self.ranked, (-old, message_id))]
+
+            if log_score is None:
+                return
+
+            insort(self.ranked, (-log_score, message_id))
+            self.scores[message_id] = log_score
+
+            while len(self.ranked) > self.size:
+                _, dropped = self.ranked.pop()
+                del self.scores[dropped]